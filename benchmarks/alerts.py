@@ -0,0 +1,170 @@
+"""
+Delivery check of the alert queue against a local SMTP server
+
+An ``AlertQueue`` is pointed at a ``smtpd.DebuggingServer`` on a free local
+port, which prints the mails it receives and can be told to reject some of
+them. The check verifies that mails are delivered over a reused connection,
+that a mail the server rejects temporarily is retried later without holding
+up the mails queued after it, that a mail the server rejects for good is
+dropped without retries, and that mails queued while the server is down
+are delivered once it is up. The exit status is non-zero if any of that fails.
+
+Run from the project root::
+
+    python -m benchmarks.alerts
+
+This check requires gevent.
+"""
+
+from __future__ import print_function, division
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import smtpd
+import socket
+import asyncore
+import argparse
+import threading
+
+import gevent
+
+from monitoring.utils.smtpclient import SMTPClient
+from monitoring.monitoring.alerts import AlertQueue
+
+
+RECIPIENTS = ['alerts@example.com']
+
+
+class Server(smtpd.DebuggingServer):
+    """ Debugging server that records the subjects of the mails it accepts,
+    and rejects mails by subject with the configured replies """
+
+    def __init__(self, localaddr, replies=None):
+        smtpd.DebuggingServer.__init__(self, localaddr, None)
+        # subject: list of replies given to the next attempts to send it
+        self.replies = replies or {}
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        subject = subject_of(data)
+        replies = self.replies.get(subject)
+        if replies:
+            return replies.pop(0)
+        smtpd.DebuggingServer.process_message(self, peer, mailfrom, rcpttos,
+                                              data)
+        self.received.append(subject)
+
+
+def subject_of(data):
+    for line in data.splitlines():
+        if line.startswith('Subject: '):
+            return line[len('Subject: '):]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, replies=None):
+    server = Server(('127.0.0.1', port), replies)
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def alert_queue(port, retry_delay):
+    client = SMTPClient('127.0.0.1', port, False, '', '', timeout=2)
+    queue = AlertQueue(client, size=10, retries=3, retry_delay=retry_delay,
+                       max_retry_delay=retry_delay * 4, idle_timeout=60)
+    queue.start()
+    return queue
+
+
+def wait_for(condition, timeout):
+    deadline = gevent.get_hub().loop.now() + timeout
+    while not condition() and gevent.get_hub().loop.now() < deadline:
+        gevent.sleep(0.05)
+    return condition()
+
+
+def check_rejections(retry_delay):
+    """ Return list of failures when the server rejects mails """
+    failures = []
+    port = free_port()
+    server = start_server(port, {
+        'temporary': ['451 Try again later', '451 Try again later'],
+        'permanent': ['554 Rejected'],
+    })
+    queue = alert_queue(port, retry_delay)
+    for subject in ('temporary', 'permanent', 'first', 'second'):
+        queue.put(RECIPIENTS, subject, 'Body of {}'.format(subject))
+    if not wait_for(lambda: 'first' in server.received and
+                    'second' in server.received, retry_delay):
+        failures.append('mails after a rejected one were held up: received '
+                        '{}'.format(server.received))
+    if not wait_for(lambda: 'temporary' in server.received,
+                    retry_delay * 10):
+        failures.append('temporarily rejected mail was not retried')
+    stats = queue.stats()
+    queue.stop()
+    if 'permanent' in server.received or server.replies['permanent']:
+        failures.append('permanently rejected mail was retried')
+    if server.received != ['first', 'second', 'temporary']:
+        failures.append('unexpected mails received: {}'.format(
+            server.received))
+    if (stats['sent'], stats['retried'], stats['failed']) != (3, 2, 1):
+        failures.append('unexpected counts: {}'.format(stats))
+    if stats['connects'] != 4:
+        # one connection for the first mail and a fresh one after each of
+        # the three rejections
+        failures.append('expected 4 connections, made {}'.format(
+            stats['connects']))
+    server.close()
+    return failures
+
+
+def check_outage(retry_delay):
+    """ Return list of failures when the server is down at first """
+    failures = []
+    port = free_port()
+    queue = alert_queue(port, retry_delay)
+    for subject in ('during outage 1', 'during outage 2'):
+        queue.put(RECIPIENTS, subject, 'Body of {}'.format(subject))
+    gevent.sleep(retry_delay / 2)
+    server = start_server(port)
+    if not wait_for(lambda: len(server.received) == 2, retry_delay * 10):
+        failures.append('mails queued during the outage were not delivered: '
+                        'received {}'.format(server.received))
+    stats = queue.stats()
+    queue.stop()
+    if stats['failed'] or stats['depth']:
+        failures.append('unexpected counts: {}'.format(stats))
+    server.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser('check delivery of alert mails')
+    parser.add_argument('--retry-delay', type=float, default=0.5,
+                        help='seconds before the first retry')
+    args = parser.parse_args()
+
+    failures = (check_rejections(args.retry_delay) +
+                check_outage(args.retry_delay))
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+    print('Alert mails delivered as expected', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
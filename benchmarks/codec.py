@@ -0,0 +1,185 @@
+"""
+Compare the bitarray datagram codec with the precompiled integer codec
+
+Run from the project root::
+
+    python -m benchmarks.codec
+
+With ``--check``, the codecs are instead checked against each other on the
+given number of random streams, with carousel counts that do and do not fit
+the 31-bit carousel slot. Each stream is also decoded with one of its
+markers corrupted, which the strict decoders must reject and the
+resynchronizing decoder must skip just that datagram of::
+
+    python -m benchmarks.codec --check 1000
+
+The exit status is non-zero if any check fails.
+"""
+
+from __future__ import print_function
+
+import sys
+import random
+import timeit
+import logging
+import argparse
+
+from bitarray import bitarray
+
+from monitoring.core import serializer
+
+from .heartbeats import generate_heartbeats
+
+
+def legacy_encode(heartbeats):
+    return serializer.to_stream(heartbeats).tobytes()
+
+
+def legacy_decode(stream):
+    ba = bitarray()
+    ba.frombytes(stream)
+    return serializer.from_stream(ba)
+
+
+class WarningCounter(logging.Handler):
+    """ Counts warnings instead of printing them """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def random_heartbeats(rnd, seed):
+    """ Return a few heartbeats, some with more than 31 carousels """
+    heartbeats = generate_heartbeats(rnd.randint(1, 8), clients=2, seed=seed)
+    for heartbeat in heartbeats:
+        count = rnd.choice((None, rnd.randint(7, 31), rnd.randint(32, 100)))
+        if count is not None:
+            heartbeat['carousel_count'] = count
+            heartbeat['carousel_status'] = [rnd.random() < 0.5
+                                            for _ in range(count)]
+    return heartbeats
+
+
+def without_timestamps(heartbeats):
+    # Timestamps are relative to decoding time, so they differ slightly
+    # between decoders
+    return [dict((key, value) for key, value in heartbeat.items()
+                 if key != 'timestamp') for heartbeat in heartbeats]
+
+
+def check_stream(rnd, heartbeats, warnings):
+    """ Return list of failures of decoding a stream of heartbeats and a
+    corrupted copy of it """
+    failures = []
+    stream = legacy_encode(heartbeats)
+    ba = bitarray()
+    ba.frombytes(stream)
+    starts = ba.search(serializer.START_MARKER)
+    ends = ba.search(serializer.END_MARKER)
+    if len(starts) != len(heartbeats) or len(ends) != len(heartbeats):
+        # Carousel bits happen to contain a marker, which the legacy decoder
+        # does not frame either
+        return failures
+    if serializer.pack_stream(heartbeats) != stream:
+        failures.append('packed stream differs')
+    expected = without_timestamps(serializer.from_stream(ba))
+    unpacked = serializer.unpack_stream(stream)
+    if unpacked is None or without_timestamps(unpacked) != expected:
+        failures.append('unpacked heartbeats differ')
+    if without_timestamps(serializer.iter_stream_str(stream)) != expected:
+        failures.append('iterated heartbeats differ')
+
+    pos = rnd.choice((starts, ends))[rnd.randrange(len(heartbeats))]
+    pos += rnd.randrange(len(serializer.START_MARKER))
+    ba[pos] = not ba[pos]
+    corrupt = ba.tobytes()
+    if serializer.unpack_stream(corrupt) is not None:
+        failures.append('corrupt stream unpacked')
+    try:
+        serializer.from_stream_str(corrupt)
+        failures.append('corrupt stream decoded')
+    except ValueError:
+        pass
+    logged = warnings.count
+    try:
+        decoded = len(list(serializer.iter_stream_str(corrupt)))
+    except ValueError:
+        decoded = 0
+    if decoded != len(heartbeats) - 1:
+        failures.append('{} of {} heartbeats iterated from corrupt '
+                        'stream'.format(decoded, len(heartbeats)))
+    if decoded and warnings.count == logged:
+        failures.append('no warning about the corrupt stream')
+    return failures
+
+
+def check(streams, seed):
+    """ Check codecs on random streams, return number of failed streams """
+    rnd = random.Random(seed)
+    warnings = WarningCounter()
+    logging.getLogger().addHandler(warnings)
+    failed = 0
+    for i in range(streams):
+        heartbeats = random_heartbeats(rnd, seed + i)
+        failures = check_stream(rnd, heartbeats, warnings)
+        if failures:
+            failed += 1
+            print('stream {}: {}'.format(i, ', '.join(failures)),
+                  file=sys.stderr)
+    return failed
+
+
+def best_of(fn, arg, repeat, number):
+    timer = timeit.Timer(lambda: fn(arg))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark heartbeat stream codecs')
+    parser.add_argument('--size', '-n', type=int, default=1000,
+                        help='number of heartbeats per stream')
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help='number of timing runs (best one is used)')
+    parser.add_argument('--number', type=int, default=3,
+                        help='calls per timing run')
+    parser.add_argument('--check', metavar='STREAMS', type=int,
+                        help='check the codecs on random streams instead')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the check')
+    args = parser.parse_args()
+
+    if args.check:
+        failed = check(args.check, args.seed)
+        if failed:
+            print('{} of {} streams failed'.format(failed, args.check),
+                  file=sys.stderr)
+            sys.exit(1)
+        print('All {} streams decoded as expected'.format(args.check),
+              file=sys.stderr)
+        return
+
+    heartbeats = generate_heartbeats(args.size, clients=1)
+    stream = legacy_encode(heartbeats)
+    assert serializer.pack_stream(heartbeats) == stream
+    assert serializer.unpack_stream(stream) is not None
+
+    rows = (
+        ('encode', legacy_encode, serializer.pack_stream, heartbeats),
+        ('decode', legacy_decode, serializer.unpack_stream, stream),
+    )
+    print('{} heartbeats, {} bytes'.format(args.size, len(stream)))
+    for name, legacy, packed, arg in rows:
+        t_legacy = best_of(legacy, arg, args.repeat, args.number)
+        t_packed = best_of(packed, arg, args.repeat, args.number)
+        print('{:<8}legacy {:>9.2f} ms  packed {:>9.2f} ms  '
+              'speedup {:.1f}x'.format(name, t_legacy * 1000,
+                                       t_packed * 1000,
+                                       t_legacy / t_packed))
+
+
+if __name__ == '__main__':
+    main()
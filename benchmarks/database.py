@@ -0,0 +1,101 @@
+"""
+Scratch PostgreSQL schemas for the benchmarks that need a database
+
+Requires psycopg2.
+"""
+
+import os
+import pkgutil
+import importlib
+import contextlib
+
+import psycopg2
+import psycopg2.extras
+
+
+MIGRATIONS = 'monitoring.monitoring.migrations.monitoring'
+
+
+class BenchmarkDB(object):
+    """ Provides the part of the database API that migrations and the
+    ``monitoring`` app use, on top of a single cursor
+
+    Transactions are not managed here, callers commit or roll back the
+    connection as a whole.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def executescript(self, sql):
+        self.cursor.execute(sql)
+
+    def execute(self, sql, *params):
+        self.cursor.execute(sql, *params)
+
+    def executemany(self, sql, params):
+        self.cursor.executemany(sql, params)
+
+    def fetchone(self, sql, *params):
+        self.cursor.execute(sql, *params)
+        return self.cursor.fetchone()
+
+    def fetchall(self, sql, *params):
+        self.cursor.execute(sql, *params)
+        return self.cursor.fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+
+
+def migration_names():
+    package = importlib.import_module(MIGRATIONS)
+    return sorted(name for _, name, _ in
+                  pkgutil.iter_modules(package.__path__))
+
+
+def migrate(db):
+    """ Apply all ``monitoring`` migrations in order """
+    for name in migration_names():
+        migration = importlib.import_module('{}.{}'.format(MIGRATIONS, name))
+        migration.up(db, {})
+
+
+def connect(dsn, schema=None):
+    """ Return connection and ``BenchmarkDB`` using ``schema`` """
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    if schema:
+        cursor.execute('set search_path to {};'.format(schema))
+    return conn, BenchmarkDB(cursor)
+
+
+@contextlib.contextmanager
+def scratch_schema(dsn, prefix, keep=False):
+    """ Create a migrated schema and yield its connection, database and name
+
+    Unless ``keep`` is set, nothing is committed, so that rolling back at the
+    end drops the schema as well. Kept schemas are committed and have to be
+    dropped by the caller.
+    """
+    schema = '{}_{}'.format(prefix, os.getpid())
+    conn, db = connect(dsn)
+    db.execute('create schema {0}; set search_path to {0};'.format(schema))
+    try:
+        migrate(db)
+        if keep:
+            conn.commit()
+        yield conn, db, schema
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def drop_schema(dsn, schema):
+    conn, db = connect(dsn)
+    try:
+        db.execute('drop schema if exists {} cascade;'.format(schema))
+        conn.commit()
+    finally:
+        conn.close()
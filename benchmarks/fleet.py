@@ -0,0 +1,206 @@
+"""
+Synthetic fleet of clients for the reporting benchmarks
+
+Clients are spread evenly over the presets in ``satdata.PRESETS`` and report
+every ``cadence`` seconds. Each client is either healthy or shows one kind of
+failure for the whole period, in proportions given by the failure mix, and
+any datapoint may show a random failure as well. Rows are generated the way
+``heartbeat.get_payload()`` stores them and loaded with ``COPY``.
+
+To load a fleet into a schema of its own and keep it::
+
+    python -m benchmarks.fleet --dsn 'dbname=monitoring_test' \\
+        --clients 10000 --mix no_signal_lock=0.05 zero_bitrate=0.02
+
+Requires psycopg2.
+"""
+
+from __future__ import print_function, division
+
+import io
+import time
+import uuid
+import random
+import argparse
+
+from monitoring.core.satdata import PRESETS
+from monitoring.monitoring.heartbeat import service_ok
+from monitoring.monitoring.partitions import DAY, create_partitions
+
+from .database import scratch_schema
+
+
+FAILURES = ('no_signal_lock', 'no_carousels', 'zero_bitrate')
+
+DEFAULT_MIX = {
+    'no_signal_lock': 0.05,
+    'no_carousels': 0.03,
+    'zero_bitrate': 0.02,
+}
+
+# Probability of a failure in any single datapoint of a healthy client
+DEFAULT_NOISE = 0.05
+
+COPY_COLUMNS = ('client_key', 'signal_lock', 'service_lock',
+                'signal_strength', 'bitrate', 'snr', 'service_ok',
+                'tuner_key', 'tuner_preset', 'carousels_count',
+                'carousels_mask', 'timestamp', 'reported', 'timeslot')
+
+
+def parse_mix(pairs):
+    """ Return failure mix from ``name=fraction`` pairs """
+    mix = dict((name, 0.0) for name in FAILURES)
+    for pair in pairs:
+        name, _, fraction = pair.partition('=')
+        if name not in mix:
+            raise ValueError('Unknown failure {}'.format(name))
+        mix[name] = float(fraction)
+    if sum(mix.values()) > 1:
+        raise ValueError('Failure fractions add up to more than 1')
+    return mix
+
+
+def pick_failure(rnd, mix):
+    value = rnd.random()
+    for name in FAILURES:
+        value -= mix.get(name, 0)
+        if value < 0:
+            return name
+    return None
+
+
+def datapoint(rnd, failure):
+    """ Return datapoint fields of a client showing ``failure`` """
+    signal_lock = failure != 'no_signal_lock'
+    carousel_count = rnd.randint(1, 5) if signal_lock else 0
+    statuses = [rnd.random() < 0.8 for _ in range(carousel_count)]
+    if carousel_count and not any(statuses):
+        statuses[0] = True
+    if failure == 'no_carousels':
+        statuses = [False] * carousel_count
+    if signal_lock and failure != 'zero_bitrate':
+        bitrate = rnd.randint(20000, 400000)
+    else:
+        bitrate = 0
+    return {
+        'signal_lock': signal_lock,
+        'service_lock': signal_lock and failure is None,
+        'signal_strength': rnd.randint(40, 100) if signal_lock else 0,
+        'snr': rnd.uniform(0.5, 3) if signal_lock else 0,
+        'bitrate': bitrate,
+        'carousel_count': carousel_count,
+        'carousel_status': statuses,
+    }
+
+
+def generate_rows(clients, now=None, history=1200, cadence=60, mix=None,
+                  noise=DEFAULT_NOISE, seed=0):
+    """ Yield ``stats`` rows of ``clients`` clients for ``history`` seconds
+    before ``now``
+
+    Clients are numbered from 0, which is also their ``client_key``.
+    """
+    rnd = random.Random(seed)
+    now = now or time.time()
+    mix = DEFAULT_MIX if mix is None else mix
+    for client in range(clients):
+        preset = PRESETS[client % len(PRESETS)][1]
+        failure = pick_failure(rnd, mix)
+        # Clients do not all report at the same second
+        timestamp = now - history + rnd.uniform(0, cadence)
+        while timestamp < now:
+            if failure is None and rnd.random() < noise:
+                data = datapoint(rnd, rnd.choice(FAILURES))
+            else:
+                data = datapoint(rnd, failure)
+            mask = 0
+            for i, status in enumerate(data['carousel_status']):
+                mask |= int(status) << i
+            reported = timestamp + rnd.uniform(0, 2)
+            yield {
+                'client_key': client,
+                'signal_lock': data['signal_lock'],
+                'service_lock': data['service_lock'],
+                'signal_strength': data['signal_strength'],
+                'bitrate': data['bitrate'],
+                'snr': data['snr'],
+                'service_ok': service_ok(data),
+                'tuner_key': 1,
+                'tuner_preset': preset,
+                'carousels_count': data['carousel_count'],
+                'carousels_mask': mask,
+                'timestamp': int(timestamp),
+                'reported': int(reported),
+                'timeslot': int(timestamp // 30),
+            }
+            timestamp += cadence
+
+
+def copy_rows(cursor, table, columns, rows, chunk=100000):
+    """ Load rows with ``COPY`` in chunks, return number of rows """
+    count = 0
+    buf = io.BytesIO()
+    for row in rows:
+        buf.write(('\t'.join(str(row[c]) for c in columns) + '\n').encode())
+        count += 1
+        if count % chunk == 0:
+            buf.seek(0)
+            cursor.copy_from(buf, table, columns=columns)
+            buf = io.BytesIO()
+    buf.seek(0)
+    cursor.copy_from(buf, table, columns=columns)
+    return count
+
+
+def load_fleet(db, clients, now=None, history=1200, cadence=60, mix=None,
+               noise=DEFAULT_NOISE, seed=0):
+    """ Load a fleet into the migrated schema ``db`` uses, return number of
+    stats rows """
+    now = now or time.time()
+    rnd = random.Random(seed)
+    cursor = db.cursor
+    copy_rows(cursor, 'clients', ('id', 'uuid'), (
+        {'id': i, 'uuid': uuid.UUID(int=rnd.getrandbits(128), version=4)}
+        for i in range(clients)))
+    db.execute("insert into tuners (id, vendor, model) "
+               "values (1, '0bda', '2838');")
+    # Migrations create partitions from today on
+    create_partitions(db, now - history, now // DAY * DAY)
+    count = copy_rows(cursor, 'stats', COPY_COLUMNS, generate_rows(
+        clients, now, history, cadence, mix, noise, seed))
+    db.execute('analyze stats;')
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser('load synthetic fleet')
+    parser.add_argument('--dsn', required=True,
+                        help='PostgreSQL connection string')
+    parser.add_argument('--clients', '-n', type=int, default=10000,
+                        help='number of clients')
+    parser.add_argument('--history', type=int, default=1200,
+                        help='seconds of history to generate')
+    parser.add_argument('--cadence', type=int, default=60,
+                        help='seconds between heartbeats of a client')
+    parser.add_argument('--mix', metavar='NAME=FRACTION', nargs='+',
+                        default=[], help='fractions of failing clients '
+                        '({})'.format(', '.join(FAILURES)))
+    parser.add_argument('--noise', type=float, default=DEFAULT_NOISE,
+                        help='failure probability of any datapoint')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix) if args.mix else None
+    with scratch_schema(args.dsn, 'fleet', keep=True) as (conn, db, schema):
+        start = time.time()
+        count = load_fleet(db, args.clients, history=args.history,
+                           cadence=args.cadence, mix=mix, noise=args.noise,
+                           seed=args.seed)
+        conn.commit()
+    print('Loaded {} rows of {} clients into schema {} in {:.1f} s'.format(
+        count, args.clients, schema, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
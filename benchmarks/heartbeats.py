@@ -0,0 +1,40 @@
+"""
+Synthetic heartbeat generator shared by the benchmarks
+"""
+
+import time
+import uuid
+import random
+
+
+def generate_heartbeats(count, clients=1, seed=0, interval=60):
+    """ Return ``count`` heartbeats as ``client/monitor.py`` collects them
+
+    Heartbeats are spread over ``clients`` client IDs and spaced
+    ``interval`` seconds apart, oldest first.
+    """
+    rnd = random.Random(seed)
+    client_ids = [str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+                  for _ in range(clients)]
+    presets = [rnd.randint(1, 6) for _ in range(clients)]
+    now = time.time()
+    heartbeats = []
+    for i in range(count):
+        signal_lock = rnd.random() < 0.9
+        carousel_count = rnd.randint(0, 12) if signal_lock else 0
+        heartbeats.append({
+            'client_id': client_ids[i % clients],
+            'timestamp': now - (count - i) * interval,
+            'tuner_vendor': '0bda',
+            'tuner_model': '2838',
+            'tuner_preset': presets[i % clients],
+            'signal_lock': signal_lock,
+            'service_lock': signal_lock and rnd.random() < 0.9,
+            'signal_strength': rnd.randint(0, 100) if signal_lock else 0,
+            'snr': rnd.uniform(0, 3) if signal_lock else 0,
+            'bitrate': rnd.randint(0, 400000) if signal_lock else 0,
+            'carousel_count': carousel_count,
+            'carousel_status': [rnd.random() < 0.7
+                                for _ in range(carousel_count)],
+        })
+    return heartbeats
@@ -0,0 +1,577 @@
+"""
+End-to-end heartbeat load test against a local server
+
+Simulates a fleet of ``client/monitor.py`` clients posting to the server
+and measures how it copes as the fleet grows. Each simulated client behaves
+like the client script:
+
+- it collects a heartbeat every ``HEARTBEAT_PERIOD`` seconds, plus a random
+  collection time of up to ``--jitter`` seconds
+- once the oldest buffered heartbeat is more than ``TRANSMIT_PERIOD``
+  seconds old, it drops heartbeats older than that and posts the rest as a
+  stream built with ``to_stream_str()``
+- when a post fails it keeps the buffer and tries again with the next
+  heartbeat
+
+Clients start at random points of that cycle. Every ``--burst-interval``
+seconds a ``--burst-fraction`` of them post within ``--burst-spread``
+seconds of each other, the way clients do when they reconnect after an
+outage.
+
+The fleet is grown in steps (``--clients``), each running for
+``--duration`` seconds. For each step the request throughput, latency
+percentiles and responses by status are reported, along with the number of
+rows the server stored when ``--dsn`` is given, and its ingest counters.
+
+To start the server with ``monitoring/config.ini`` and drive it::
+
+    python -m benchmarks.load --start --dsn 'dbname=monitoring' \\
+        --clients 1000 2000 5000 10000 --duration 600 --output load.json
+
+The started server sends alerts to a local ``smtpd.DebuggingServer``, which
+writes them to ``--server-log``, instead of the configured SMTP host and
+recipients. Use a database that may be filled with synthetic heartbeats.
+Other settings of the started server are given with ``--set``, e.g. to
+compare latencies with reports computed in and out of the server process::
+
+    python -m benchmarks.load --start --set reporting.process=no \\
+        --output inline.json
+    python -m benchmarks.load --start --set reporting.process=yes \\
+        --output process.json
+
+Clients are greenlets spread over ``--processes`` worker processes, so that
+the load generator does not become the bottleneck. How late clients posted
+compared to their schedule is reported as ``send_lag_s``. When it grows,
+latencies are no longer trustworthy, and more processes are needed.
+
+``--speedup`` runs client time faster than real time, so that a short step
+covers several transmit periods. Streams carry heartbeat times relative to
+when they are posted, so the server then sees consecutive posts of a client
+overlap, and stores fewer rows than heartbeats were sent.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import socket
+import urllib
+import httplib
+import platform
+import argparse
+import tempfile
+import itertools
+import contextlib
+import subprocess
+import collections
+import multiprocessing
+
+import gevent
+from gevent.event import Event
+
+from monitoring.core.satdata import PRESETS
+from monitoring.core.serializer import to_stream_str, STREAM_V1, STREAM_V2
+
+
+# Timings of the client script (see ``client/monitor.py``)
+HEARTBEAT_PERIOD = 60
+TRANSMIT_PERIOD = 5 * 60
+
+STEPS = (100, 1000, 5000)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+ENDPOINTS = {
+    'v1': '/heartbeat/v1/',
+    'v2': '/heartbeat/v2/',
+}
+
+STATS_PATH = '/heartbeat/stats/'
+
+# Seconds to wait for a started server to respond
+START_TIMEOUT = 120
+
+# Settings a started server gets on top of ``monitoring/config.ini``. Alerts
+# raised by the synthetic fleet go to a local SMTP server that only logs them.
+SERVER_SETTINGS = (
+    ('email.host', '127.0.0.1'),
+    ('email.secure', 'no'),
+    ('email.username', ''),
+    ('email.password', ''),
+    ('reporting.recipients', 'load@localhost'),
+)
+
+
+class Clock(object):
+    """ Client time, running ``speedup`` times faster than real time """
+
+    def __init__(self, start, speedup=1):
+        self.start = start
+        self.speedup = speedup
+
+    def now(self):
+        return self.start + (time.time() - self.start) * self.speedup
+
+    def real(self, moment):
+        """ Return the real time at which client time reaches ``moment`` """
+        return self.start + (moment - self.start) / self.speedup
+
+
+class Results(object):
+    """ Measurements of the clients in one worker process """
+
+    def __init__(self):
+        self.latencies = []
+        self.send_lags = []
+        self.statuses = collections.Counter()
+        self.heartbeats = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {
+            'latencies': self.latencies,
+            'send_lags': self.send_lags,
+            'statuses': dict(self.statuses),
+            'heartbeats': self.heartbeats,
+            'bytes': self.bytes,
+        }
+
+
+def heartbeat(rnd, client_id, preset, timestamp):
+    """ Return a heartbeat like the ones ``collect_data()`` returns """
+    signal_lock = rnd.random() < 0.95
+    carousel_count = rnd.randint(1, 5) if signal_lock else 0
+    return {
+        'client_id': client_id,
+        'timestamp': timestamp,
+        'tuner_vendor': '0bda',
+        'tuner_model': '2838',
+        'tuner_preset': preset,
+        'signal_lock': signal_lock,
+        'service_lock': signal_lock and rnd.random() < 0.95,
+        'signal_strength': rnd.randint(40, 100) if signal_lock else 0,
+        'snr': rnd.uniform(0.5, 3) if signal_lock else 0,
+        'bitrate': rnd.randint(20000, 400000) if signal_lock else 0,
+        'carousel_count': carousel_count,
+        'carousel_status': [rnd.random() < 0.8
+                            for _ in range(carousel_count)],
+    }
+
+
+def request_body(stream, endpoint):
+    """ Return body and headers of a post the way the client script makes
+    them """
+    if endpoint == 'v1':
+        return (urllib.urlencode({'stream': stream}),
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+    headers = {'Content-Type': 'application/octet-stream'}
+    compressed = zlib.compress(stream, 9)
+    if len(compressed) < len(stream):
+        stream = compressed
+        headers['Content-Encoding'] = 'deflate'
+    return stream, headers
+
+
+def post(target, path, body, headers, timeout):
+    """ Post body on a new connection, like ``urlopen()``, return status """
+    host, port = target
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('POST', path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def send(buffer, moment, options, results):
+    """ Post buffered heartbeats, return whether the server accepted them """
+    # Stream timestamps are relative to the time of posting, so heartbeats
+    # keep their age in client time
+    now = time.time()
+    heartbeats = [dict(hb, timestamp=now - (moment - hb['timestamp']))
+                  for hb in buffer]
+    stream = to_stream_str(heartbeats, options['stream_version'])
+    body, headers = request_body(stream, options['endpoint'])
+    start = time.time()
+    try:
+        status = post(options['target'], ENDPOINTS[options['endpoint']],
+                      body, headers, options['timeout'])
+    except socket.timeout:
+        results.statuses['timeout'] += 1
+        return False
+    except (socket.error, httplib.HTTPException):
+        results.statuses['error'] += 1
+        return False
+    results.latencies.append(time.time() - start)
+    results.statuses[str(status)] += 1
+    if status != 200:
+        return False
+    results.heartbeats += len(buffer)
+    results.bytes += len(body)
+    return True
+
+
+def run_client(index, options, clock, deadline, wake, results):
+    rnd = random.Random(options['seed'] * 1000003 + index)
+    client_id = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+    preset = rnd.choice(PRESETS)[1]
+    # Join at a random point of the transmit cycle
+    moment = clock.now()
+    buffer = [heartbeat(rnd, client_id, preset,
+                        moment - i * HEARTBEAT_PERIOD)
+              for i in reversed(range(1, rnd.randint(1, 6)))]
+    moment += rnd.uniform(0, HEARTBEAT_PERIOD)
+    while True:
+        timeout = min(clock.real(moment), deadline) - time.time()
+        woken = wake.wait(max(timeout, 0))
+        if time.time() >= deadline:
+            return
+        if woken:
+            # Reconnecting after an outage, post right away
+            wake.clear()
+            moment = clock.now()
+        buffer.append(heartbeat(rnd, client_id, preset, moment))
+        if woken or moment - buffer[0]['timestamp'] > TRANSMIT_PERIOD:
+            buffer = [hb for hb in buffer
+                      if moment - hb['timestamp'] <= TRANSMIT_PERIOD]
+            results.send_lags.append(max(time.time() - clock.real(moment),
+                                         0))
+            if send(buffer, moment, options, results):
+                buffer = []
+        moment += HEARTBEAT_PERIOD + rnd.uniform(0, options['jitter'])
+
+
+def run_bursts(events, options, clock, deadline):
+    rnd = random.Random(options['seed'])
+    interval = options['burst_interval'] / clock.speedup
+    count = int(len(events) * options['burst_fraction'])
+    while time.time() + interval < deadline:
+        gevent.sleep(interval)
+        for event in rnd.sample(events, count):
+            gevent.spawn_later(rnd.uniform(0, options['burst_spread']),
+                               event.set)
+
+
+def simulate(options, conn):
+    """ Simulate clients of one worker process for one step and send the
+    measurements back over ``conn`` """
+    from gevent import monkey
+    monkey.patch_all()
+    results = Results()
+    clock = Clock(options['start'], options['speedup'])
+    deadline = options['start'] + options['duration']
+    gevent.sleep(max(options['start'] - time.time(), 0))
+    events = []
+    greenlets = []
+    for index in options['indices']:
+        wake = Event()
+        events.append(wake)
+        greenlets.append(gevent.spawn(run_client, index, options, clock,
+                                      deadline, wake, results))
+    if options['burst_interval'] and options['burst_fraction']:
+        greenlets.append(gevent.spawn(run_bursts, events, options, clock,
+                                      deadline))
+    gevent.joinall(greenlets)
+    conn.send(results.as_dict())
+    conn.close()
+
+
+def percentiles(values):
+    """ Return nearest-rank percentiles of sorted values """
+    if not values:
+        return {}
+    result = dict(
+        ('p{:g}'.format(p),
+         values[max(int(math.ceil(p / 100 * len(values))) - 1, 0)])
+        for p in PERCENTILES)
+    result['mean'] = sum(values) / len(values)
+    result['max'] = values[-1]
+    return result
+
+
+def summarize(clients, duration, parts):
+    latencies = sorted(itertools.chain(*[p['latencies'] for p in parts]))
+    send_lags = sorted(itertools.chain(*[p['send_lags'] for p in parts]))
+    statuses = collections.Counter()
+    for part in parts:
+        statuses.update(part['statuses'])
+    requests = sum(statuses.values())
+    heartbeats = sum(p['heartbeats'] for p in parts)
+    return {
+        'clients': clients,
+        'duration_s': duration,
+        'requests': requests,
+        'requests_per_s': requests / duration,
+        'heartbeats': heartbeats,
+        'heartbeats_per_s': heartbeats / duration,
+        'bytes': sum(p['bytes'] for p in parts),
+        'statuses': dict(statuses),
+        'error_rate': (requests - statuses['200']) / (requests or 1),
+        'latency_s': percentiles(latencies),
+        'send_lag_s': percentiles(send_lags),
+    }
+
+
+def count_rows(dsn):
+    """ Return numbers of stored datapoints and known clients """
+    from .database import connect
+    conn, db = connect(dsn)
+    try:
+        return {
+            'stats': db.fetchone('select count(*) from stats;')['count'],
+            'clients': db.fetchone('select count(*) from clients;')['count'],
+        }
+    finally:
+        conn.close()
+
+
+def server_stats(target):
+    host, port = target
+    conn = httplib.HTTPConnection(host, port, timeout=10)
+    try:
+        conn.request('GET', STATS_PATH)
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise httplib.HTTPException('Status {}'.format(response.status))
+    return json.loads(body)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_server(server, target, log_path):
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('Server exited with status {}, see {}'.format(
+                server.returncode, log_path))
+        try:
+            server_stats(target)
+            return
+        except (socket.error, httplib.HTTPException):
+            time.sleep(1)
+    raise RuntimeError('Server did not respond, see {}'.format(log_path))
+
+
+def stop(process):
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+
+
+def parse_settings(values):
+    """ Return (key, value) pairs from SECTION.KEY=VALUE strings """
+    settings = []
+    for value in values:
+        key, _, setting = value.partition('=')
+        if '.' not in key:
+            raise ValueError('Expected SECTION.KEY=VALUE, got {}'.format(
+                value))
+        settings.append((key, setting))
+    return settings
+
+
+def server_config(settings):
+    """ Return config file contents that extend ``monitoring/config.ini``
+    with ``settings``, later ones taking precedence """
+    sections = collections.OrderedDict()
+    for key, value in settings:
+        section, _, name = key.partition('.')
+        sections.setdefault(section, collections.OrderedDict())[name] = value
+    lines = ['[config]', '', 'defaults =', '    monitoring/config.ini']
+    for section, values in sections.items():
+        lines.extend(['', '[{}]'.format(section), ''])
+        lines.extend('{} = {}'.format(name, value).rstrip()
+                     for name, value in values.items())
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def started_server(target, log_path, settings=()):
+    """ Run the server with ``SERVER_SETTINGS`` and ``settings``, and a local
+    SMTP server for its alerts, while the block runs """
+    log = open(log_path, 'a')
+    smtp_port = free_port()
+    sink = subprocess.Popen([sys.executable, '-u', '-m', 'smtpd', '-n', '-c',
+                             'DebuggingServer',
+                             '127.0.0.1:{}'.format(smtp_port)],
+                            stdout=log, stderr=subprocess.STDOUT)
+    fd, conf_path = tempfile.mkstemp(prefix='load-', suffix='.ini', dir='.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(server_config(
+                SERVER_SETTINGS + (('email.port', str(smtp_port)),) +
+                tuple(settings)))
+        server = subprocess.Popen([sys.executable, 'monitoring/app.py',
+                                   '--conf', conf_path],
+                                  stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for_server(server, target, log_path)
+            yield server
+        finally:
+            stop(server)
+    finally:
+        stop(sink)
+        os.remove(conf_path)
+        log.close()
+
+
+def run_step(clients, options, processes, dsn, settle):
+    rows_before = count_rows(dsn) if dsn else None
+    # Give the worker processes time to start so that they begin together
+    start = time.time() + 2
+    tasks = [dict(options, start=start, indices=range(i, clients, processes))
+             for i in range(processes)]
+    workers = []
+    for task in tasks:
+        conn, worker_conn = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=simulate,
+                                         args=(task, worker_conn))
+        worker.start()
+        # Only the worker's end stays open, so reading fails if it dies
+        worker_conn.close()
+        workers.append((worker, conn))
+    try:
+        parts = [conn.recv() for _, conn in workers]
+    finally:
+        for worker, _ in workers:
+            worker.join()
+    result = summarize(clients, options['duration'], parts)
+    # Let queued heartbeats be stored before counting rows
+    time.sleep(settle)
+    if dsn:
+        rows_after = count_rows(dsn)
+        result['rows_stored'] = rows_after['stats'] - rows_before['stats']
+        result['clients_stored'] = (rows_after['clients'] -
+                                    rows_before['clients'])
+    try:
+        result['server'] = server_stats(options['target'])
+    except (socket.error, httplib.HTTPException, ValueError):
+        result['server'] = None
+    return result
+
+
+def run(steps, options, processes, dsn, settle):
+    results = []
+    for clients in steps:
+        result = run_step(clients, options, processes, dsn, settle)
+        results.append(result)
+        latency = result['latency_s']
+        print('{:>7} clients {:>8.1f} req/s  p50 {:>7.3f} s  p99 {:>7.3f} s  '
+              'errors {:>6.2%}'.format(clients, result['requests_per_s'],
+                                       latency.get('p50', 0),
+                                       latency.get('p99', 0),
+                                       result['error_rate']),
+              file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'created': time.time(),
+        'target': '{}:{}'.format(*options['target']),
+        'endpoint': options['endpoint'],
+        'stream_version': options['stream_version'],
+        'speedup': options['speedup'],
+        'processes': processes,
+        'steps': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser('load test heartbeat collection')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='server address')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='server port')
+    parser.add_argument('--start', action='store_true',
+                        help='start the server and stop it when done')
+    parser.add_argument('--server-log', metavar='PATH', default='load.log',
+                        help='file for the output of a started server')
+    parser.add_argument('--set', metavar='SECTION.KEY=VALUE', nargs='+',
+                        default=[], help='settings of a started server')
+    parser.add_argument('--dsn', help='PostgreSQL connection string of the '
+                        'server database, to count stored rows')
+    parser.add_argument('--clients', '-n', metavar='N', type=int, nargs='+',
+                        default=STEPS, help='numbers of clients per step')
+    parser.add_argument('--duration', '-d', type=float, default=300,
+                        help='seconds each step runs')
+    parser.add_argument('--processes', '-p', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of load generating processes')
+    parser.add_argument('--endpoint', choices=sorted(ENDPOINTS),
+                        default='v1', help='heartbeat endpoint to post to')
+    parser.add_argument('--stream-version', type=int,
+                        choices=(STREAM_V1, STREAM_V2), default=STREAM_V1,
+                        help='heartbeat stream format version')
+    parser.add_argument('--jitter', type=float, default=5,
+                        help='maximum collection time of a heartbeat')
+    parser.add_argument('--burst-interval', type=float, default=600,
+                        help='seconds between reconnect bursts (0 for none)')
+    parser.add_argument('--burst-fraction', type=float, default=0.2,
+                        help='fraction of clients posting in a burst')
+    parser.add_argument('--burst-spread', type=float, default=5,
+                        help='seconds over which a burst is spread')
+    parser.add_argument('--speedup', type=float, default=1,
+                        help='how much faster than real time clients run')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a response')
+    parser.add_argument('--settle', type=float, default=10,
+                        help='seconds to wait after a step before counting '
+                        'stored rows')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for simulated clients')
+    parser.add_argument('--output', '-o', metavar='PATH',
+                        help='write JSON results to file (default: stdout)')
+    args = parser.parse_args()
+    try:
+        settings = parse_settings(args.set)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    target = (args.host, args.port)
+    options = {
+        'target': target,
+        'endpoint': args.endpoint,
+        'stream_version': args.stream_version,
+        'duration': args.duration,
+        'jitter': args.jitter,
+        'burst_interval': args.burst_interval,
+        'burst_fraction': args.burst_fraction,
+        'burst_spread': args.burst_spread,
+        'speedup': args.speedup,
+        'timeout': args.timeout,
+        'seed': args.seed,
+    }
+    if args.start:
+        with started_server(target, args.server_log, settings):
+            report = run(args.clients, options, args.processes, args.dsn,
+                         args.settle)
+        report['server_settings'] = dict(settings)
+    else:
+        report = run(args.clients, options, args.processes, args.dsn,
+                     args.settle)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Parity checks of the reporting backends
+
+A synthetic fleet (see ``benchmarks.fleet``) is loaded into a scratch
+schema, and client reports are computed from it with the "sql" backend and
+with the "query" backend, the latter both through the ``check_*()``
+functions and through the vectorized evaluator. All of them run against the
+same frozen clock, so that datapoints at the edge of the recent window count
+the same way everywhere. Reports that differ are printed, and the exit status
+is non-zero if there are any.
+
+Run from the project root::
+
+    python -m benchmarks.parity --dsn 'dbname=monitoring_test' \\
+        --clients 5000 --mix no_carousels=0.1 zero_bitrate=0.1
+
+The scratch schema is dropped at the end. This check requires psycopg2.
+
+With ``--random``, client reports of the vectorized evaluator are compared
+with those of the ``check_*()`` functions instead, without a database, on
+the given number of randomly generated batches of rows. Their values are
+picked to land on the thresholds of the health checks and on the edge of
+the recent window::
+
+    python -m benchmarks.parity --random 1000 --clients 50
+
+This check requires NumPy.
+"""
+
+from __future__ import print_function, division
+
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+from monitoring.monitoring import reporting
+
+
+# Extra seconds added to the generated history for the report interval
+INTERVAL_SLACK = 60 * 60
+
+# Failure rates of random clients, on and around the thresholds of the
+# health checks
+FAILURE_RATES = (0.0, 0.1, 0.2, 0.25, 0.5, 0.75, 0.8, 0.85, 1.0)
+
+
+class FrozenClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@contextlib.contextmanager
+def frozen_time(now):
+    """ Make ``reporting`` see ``now`` as the current time """
+    clock = reporting.time
+    reporting.time = FrozenClock(now)
+    try:
+        yield
+    finally:
+        reporting.time = clock
+
+
+def backend_reports(db, interval, now):
+    """ Return {backend name: {(preset, client ID): client report}} """
+    with frozen_time(now):
+        rows = reporting.get_sat_reports(db, interval)
+        reports = {
+            'sql': reporting.client_reports_from_counts(
+                reporting.get_client_counts(db, interval)),
+            'query': reporting.client_reports_from_rows(rows),
+        }
+        if reporting.numpy is not None:
+            counts = reporting.client_counts_vectorized(rows, now)
+            reports['query_vectorized'] = (
+                reporting.client_reports_from_counts(counts))
+        # Reports are evaluated lazily, so they are collected while the
+        # clock is still frozen
+        return dict((name, dict(((preset, client_id), report)
+                                for preset, clients in sat_reports
+                                for client_id, report in clients))
+                    for name, sat_reports in reports.items())
+
+
+def same_report(a, b, tolerance=1e-9):
+    """ Return whether two client reports match, allowing for rounding of
+    the rates and the average bitrate """
+    health_a, rate_a, bitrate_a, status_a = a
+    health_b, rate_b, bitrate_b, status_b = b
+    return (health_a == health_b and status_a == status_b and
+            abs(rate_a - rate_b) <= tolerance and
+            abs(bitrate_a - bitrate_b) <= tolerance * max(abs(bitrate_a), 1))
+
+
+def compare_reports(reports, reference='query'):
+    """ Print reports that differ from those of the reference backend,
+    return number of differences """
+    expected = reports[reference]
+    differences = 0
+    for name, actual in sorted(reports.items()):
+        if name == reference:
+            continue
+        for key in sorted(set(expected) | set(actual)):
+            a = expected.get(key)
+            b = actual.get(key)
+            if a is not None and b is not None and same_report(a, b):
+                continue
+            differences += 1
+            print('preset {} client {}: {}={} {}={}'.format(
+                key[0], key[1], reference, a, name, b))
+    return differences
+
+
+def check(dsn, clients, history, cadence, mix, seed):
+    """ Load a fleet, compare reports of all backends, return number of
+    differences """
+    # Imported here, so that the randomized check runs without psycopg2
+    from .database import scratch_schema
+    from .fleet import load_fleet
+
+    interval = history + INTERVAL_SLACK
+    with scratch_schema(dsn, 'parity') as (conn, db, _):
+        now = time.time()
+        rows = load_fleet(db, clients, now=now, history=history,
+                          cadence=cadence, mix=mix, seed=seed)
+        reports = backend_reports(db, interval, now)
+    print('Compared reports of {} clients from {} rows: {}'.format(
+        len(reports['query']), rows,
+        ', '.join(sorted(reports))), file=sys.stderr)
+    return compare_reports(reports)
+
+
+def random_rows(rnd, clients, now):
+    """ Return ``stats`` rows of ``clients`` random clients ordered by preset
+    and client """
+    rows = []
+    for client in range(clients):
+        preset = rnd.randint(1, 4)
+        count = rnd.randint(1, 25)
+        rate = rnd.choice(FAILURE_RATES)
+        for _ in range(count):
+            carousels_count = rnd.choice((0, 1, 3))
+            rows.append({
+                'tuner_preset': preset,
+                'client_key': client,
+                'client_id': 'client-{}'.format(client),
+                'bitrate': (0 if rnd.random() < rate
+                            else rnd.randint(1, 600000)),
+                'carousels_count': carousels_count,
+                'carousels_mask': (rnd.randint(0, 7) if carousels_count and
+                                   rnd.random() >= rate else 0),
+                'service_ok': rnd.random() >= rate,
+                'service_lock': rnd.random() >= rate,
+                # Some datapoints are exactly on the edge of the recent
+                # window
+                'timestamp': int(now - rnd.choice((
+                    0, reporting.RECENT_INTERVAL - 1,
+                    reporting.RECENT_INTERVAL, reporting.RECENT_INTERVAL + 1,
+                    rnd.randint(0, reporting.DATAPOINTS_INTERVAL)))),
+            })
+    rows.sort(key=lambda row: (row['tuner_preset'], row['client_key']))
+    return rows
+
+
+def check_random(batches, clients, seed):
+    """ Compare reports of the vectorized evaluator and the ``check_*()``
+    functions on random rows, return number of differences """
+    rnd = random.Random(seed)
+    now = int(time.time())
+    differences = 0
+    for _ in range(batches):
+        rows = random_rows(rnd, rnd.randint(1, clients), now)
+        with frozen_time(now):
+            reports = {
+                'query': reporting.client_reports_from_rows(rows),
+                'query_vectorized': reporting.client_reports_from_counts(
+                    reporting.client_counts_vectorized(rows, now)),
+            }
+            reports = dict((name, dict(((preset, client_id), report)
+                                       for preset, clients in sat_reports
+                                       for client_id, report in clients))
+                           for name, sat_reports in reports.items())
+        differences += compare_reports(reports)
+    print('Compared reports of {} random batches'.format(batches),
+          file=sys.stderr)
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser('check parity of reporting backends')
+    parser.add_argument('--dsn',
+                        help='PostgreSQL connection string')
+    parser.add_argument('--random', metavar='BATCHES', type=int,
+                        help='compare the vectorized evaluator with the '
+                        'check functions on random batches of rows instead')
+    parser.add_argument('--clients', '-n', type=int, default=2000,
+                        help='number of clients')
+    parser.add_argument('--history', type=int, default=1200,
+                        help='seconds of history to generate')
+    parser.add_argument('--cadence', type=int, default=60,
+                        help='seconds between heartbeats of a client')
+    parser.add_argument('--mix', metavar='NAME=FRACTION', nargs='+',
+                        default=[], help='fractions of failing clients')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    args = parser.parse_args()
+
+    if args.random:
+        differences = check_random(args.random, args.clients, args.seed)
+    elif args.dsn:
+        from .fleet import parse_mix
+        mix = parse_mix(args.mix) if args.mix else None
+        differences = check(args.dsn, args.clients, args.history,
+                            args.cadence, mix, args.seed)
+    else:
+        parser.error('either --dsn or --random is required')
+    if differences:
+        print('{} client reports differ'.format(differences),
+              file=sys.stderr)
+        sys.exit(1)
+    print('All backends agree', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
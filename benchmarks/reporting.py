@@ -0,0 +1,213 @@
+"""
+Time and memory benchmarks of reporting at several fleet sizes
+
+For each fleet size a synthetic fleet (see ``benchmarks.fleet``) is loaded
+into a scratch schema, and the following are measured:
+
+- ``get_sat_reports``: the reporting query
+- ``client_report``: evaluation of fetched rows with ``client_report()``
+- ``client_counts_vectorized``: the same with the vectorized evaluator
+- ``get_client_counts``: the grouped query of the "sql" backend
+- ``send_report_query`` and ``send_report_sql``: a whole report run with
+  each backend, without sending alerts
+
+Run from the project root::
+
+    python -m benchmarks.reporting --dsn 'dbname=monitoring_test' \\
+        --output reporting.json
+
+Reports select datapoints from an interval longer than the generated
+history, so that no rows leave the window while the benchmark runs. Memory
+is measured for a single call in a fresh worker process with a connection of
+its own, which is why fleets are committed to the scratch schema. The schema
+is dropped at the end. Results are written as JSON, and ``--baseline``
+compares them with an earlier run like ``benchmarks.serializer`` does.
+
+Requires psycopg2.
+"""
+
+from __future__ import print_function, division
+
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+
+from monitoring.monitoring import reporting
+from monitoring.monitoring.throttle import AlertThrottle
+
+from .database import scratch_schema, drop_schema, connect
+from .fleet import load_fleet, parse_mix
+from .serializer import max_rss_kb, run_isolated, compare
+
+
+SIZES = (1000, 10000, 100000)
+
+CASES = ('get_sat_reports', 'client_report', 'client_counts_vectorized',
+         'get_client_counts', 'send_report_query', 'send_report_sql')
+
+# Extra seconds added to the generated history for the report interval
+INTERVAL_SLACK = 60 * 60
+
+
+class BenchmarkApp(object):
+    def __init__(self, config):
+        self.config = config
+
+
+class BenchmarkExts(object):
+    def __init__(self, db):
+        self.databases = {'monitoring': db}
+
+
+class BenchmarkSupervisor(object):
+    """ Provides the part of the supervisor API that ``send_report`` uses """
+
+    def __init__(self, db, config):
+        self.config = config
+        self.app = BenchmarkApp(config)
+        self.exts = BenchmarkExts(db)
+
+
+def report_config(interval, backend):
+    return {
+        'reporting.datapoints_interval': interval,
+        'reporting.backend': backend,
+        'storage.retention_days': 0,
+        'alert_throttle': AlertThrottle(),
+    }
+
+
+def no_alerts(changes, config):
+    pass
+
+
+def disable_alerts():
+    # Alerts about the synthetic fleet must not be mailed to anyone
+    reporting.send_reports = no_alerts
+    reporting.send_digest = no_alerts
+
+
+def make_case(case, db, interval):
+    """ Return function that runs the case once """
+    if case == 'get_sat_reports':
+        return lambda: reporting.get_sat_reports(db, interval)
+    if case == 'get_client_counts':
+        return lambda: reporting.get_client_counts(db, interval)
+    if case.startswith('send_report_'):
+        backend = case[len('send_report_'):]
+        return lambda: reporting.send_report(BenchmarkSupervisor(
+            db, report_config(interval, backend)))
+    # Evaluation cases run over rows fetched beforehand
+    rows = reporting.get_sat_reports(db, interval)
+    if case == 'client_report':
+        return lambda: list(reporting.client_reports_from_rows(rows))
+    return lambda: reporting.client_counts_vectorized(rows)
+
+
+def measure_time(fn, repeat):
+    timer = timeit.Timer(fn)
+    runs = sorted(timer.repeat(repeat=repeat, number=1))
+    return {'best_s': runs[0], 'median_s': runs[len(runs) // 2]}
+
+
+def measure_memory(dsn, schema, case, interval):
+    """ Return memory used by a single call (run in a worker process) """
+    disable_alerts()
+    conn, db = connect(dsn, schema)
+    try:
+        fn = make_case(case, db, interval)
+        rss_before = max_rss_kb()
+        fn()
+        return {'peak_rss_kb': max(max_rss_kb() - rss_before, 0)}
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def run(dsn, cases, sizes, history, cadence, mix, repeat, memory=True):
+    results = []
+    interval = history + INTERVAL_SLACK
+    for size in sizes:
+        with scratch_schema(dsn, 'report_bench', keep=True) as scratch:
+            conn, db, schema = scratch
+            try:
+                rows = load_fleet(db, size, history=history,
+                                  cadence=cadence, mix=mix)
+                conn.commit()
+                for case in cases:
+                    result = {'case': case, 'size': size, 'rows': rows}
+                    result.update(measure_time(make_case(case, db, interval),
+                                               repeat))
+                    # Snapshots written by report runs are not kept
+                    conn.rollback()
+                    if memory:
+                        result.update(run_isolated(
+                            measure_memory, dsn, schema, case, interval))
+                    results.append(result)
+                    print('{case:<26} {size:>7} {best_s:>12.6f} s'.format(
+                        **result), file=sys.stderr)
+            finally:
+                conn.rollback()
+                drop_schema(dsn, schema)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'created': time.time(),
+        'history': history,
+        'cadence': cadence,
+        'mix': mix,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark reporting')
+    parser.add_argument('--dsn', required=True,
+                        help='PostgreSQL connection string')
+    parser.add_argument('--sizes', '-n', metavar='N', type=int, nargs='+',
+                        default=SIZES, help='numbers of clients')
+    parser.add_argument('--cases', '-c', metavar='NAME', nargs='+',
+                        choices=CASES, default=CASES,
+                        help='functions to benchmark')
+    parser.add_argument('--history', type=int, default=1200,
+                        help='seconds of history to generate')
+    parser.add_argument('--cadence', type=int, default=60,
+                        help='seconds between heartbeats of a client')
+    parser.add_argument('--mix', metavar='NAME=FRACTION', nargs='+',
+                        default=[], help='fractions of failing clients')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='number of timing runs (best one is reported)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip memory measurements')
+    parser.add_argument('--output', '-o', metavar='PATH',
+                        help='write JSON results to file (default: stdout)')
+    parser.add_argument('--baseline', '-b', metavar='PATH',
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against baseline')
+    args = parser.parse_args()
+
+    disable_alerts()
+    mix = parse_mix(args.mix) if args.mix else None
+    report = run(args.dsn, args.cases, args.sizes, args.history,
+                 args.cadence, mix, args.repeat, memory=not args.no_memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Throughput and memory benchmarks for ``monitoring.core.serializer``
+
+Run from the project root::
+
+    python -m benchmarks.serializer --output serializer.json
+
+Timings are the best of several runs with garbage collection disabled, on
+synthetic heartbeats generated from a fixed seed. Memory is measured for a
+single call in a fresh worker process, so results for different cases do not
+influence each other. Results are written as JSON. Passing a previous results
+file with ``--baseline`` prints the change for each case and exits with a
+non-zero status when any case got slower than the allowed tolerance.
+"""
+
+from __future__ import print_function, division
+
+import gc
+import sys
+import json
+import time
+import timeit
+import platform
+import resource
+import argparse
+import multiprocessing
+
+from bitarray import bitarray
+
+from monitoring.core import serializer
+
+from .heartbeats import generate_heartbeats
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+# Minimum duration of a single timing run in seconds
+MIN_RUN_TIME = 0.2
+
+# Heartbeats in a single stream come from a single client
+CLIENTS = 1
+
+
+def bits_of(stream):
+    ba = bitarray()
+    ba.frombytes(stream)
+    return ba
+
+
+def to_stream_str_v2(heartbeats):
+    return serializer.to_stream_str(heartbeats, serializer.STREAM_V2)
+
+
+def iter_stream_str(stream):
+    return list(serializer.iter_stream_str(stream))
+
+
+# Case name: (function, input kind, stream version)
+CASES = {
+    'to_stream': (serializer.to_stream, 'heartbeats', 1),
+    'from_stream': (serializer.from_stream, 'bitarray', 1),
+    'to_stream_str': (serializer.to_stream_str, 'heartbeats', 1),
+    'from_stream_str': (serializer.from_stream_str, 'bytes', 1),
+    'iter_stream_str': (iter_stream_str, 'bytes', 1),
+    'to_stream_str_v2': (to_stream_str_v2, 'heartbeats', 2),
+    'from_stream_str_v2': (serializer.from_stream_str, 'bytes', 2),
+    'from_stream_columns': (serializer.from_stream_columns, 'bytes', 1),
+}
+
+DEFAULT_CASES = ('to_stream', 'from_stream', 'to_stream_str',
+                 'from_stream_str')
+
+
+def make_input(case, size, seed):
+    """ Return input for the case and the length of the encoded stream """
+    _, kind, version = CASES[case]
+    heartbeats = generate_heartbeats(size, clients=CLIENTS, seed=seed)
+    stream = serializer.to_stream_str(heartbeats, version)
+    if kind == 'heartbeats':
+        return heartbeats, len(stream)
+    if kind == 'bitarray':
+        return bits_of(stream), len(stream)
+    return stream, len(stream)
+
+
+def max_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes rather than kilobytes
+        return usage // 1024
+    return usage
+
+
+def measure_time(case, size, seed, repeat):
+    fn = CASES[case][0]
+    arg, stream_len = make_input(case, size, seed)
+    timer = timeit.Timer(lambda: fn(arg))
+    # Pick the number of calls per run so that runs are long enough to be
+    # stable, the same way ``timeit`` does on the command line
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_RUN_TIME or number >= 1000000:
+            break
+        number *= 10
+    runs = sorted(t / number for t in timer.repeat(repeat=repeat,
+                                                   number=number))
+    best = runs[0]
+    return {
+        'bytes': stream_len,
+        'calls_per_run': number,
+        'best_s': best,
+        'median_s': runs[len(runs) // 2],
+        'heartbeats_per_s': size / best if best else None,
+        'mb_per_s': stream_len / best / 1e6 if best else None,
+    }
+
+
+def measure_memory(case, size, seed):
+    """ Return memory used by a single call (run in a worker process)
+
+    ``retained_objects`` is the number of objects tracked by the garbage
+    collector that the call left behind, mostly the containers that make up
+    its result, and is available on Python 2 as well. Traced bytes and
+    allocated blocks need ``tracemalloc`` and are ``None`` on Python 2.
+    """
+    fn = CASES[case][0]
+    arg, _ = make_input(case, size, seed)
+    gc.collect()
+    result = {
+        'peak_rss_kb': None,
+        'peak_traced_bytes': None,
+        'retained_blocks': None,
+        'retained_objects': None,
+    }
+    rss_before = max_rss_kb()
+    objects_before = len(gc.get_objects())
+    if tracemalloc is not None:
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+    out = fn(arg)
+    if tracemalloc is not None:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_traced_bytes'] = peak
+        result['retained_blocks'] = sys.getallocatedblocks() - blocks_before
+    result['peak_rss_kb'] = max(max_rss_kb() - rss_before, 0)
+    gc.collect()
+    result['retained_objects'] = len(gc.get_objects()) - objects_before
+    del out
+    return result
+
+
+def run_isolated(fn, *args):
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(fn, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(cases, sizes, seed, repeat, memory=True):
+    results = []
+    for size in sizes:
+        for case in cases:
+            result = {'case': case, 'size': size}
+            result.update(measure_time(case, size, seed, repeat))
+            if memory:
+                result.update(run_isolated(measure_memory, case, size, seed))
+            results.append(result)
+            print('{case:<20} {size:>7} {best_s:>12.6f} s '
+                  '{heartbeats_per_s:>12.0f} hb/s'.format(**result),
+                  file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'created': time.time(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """ Print timing changes against baseline, return number of regressions
+    """
+    previous = dict(((r['case'], r['size']), r) for r in baseline['results'])
+    regressions = 0
+    for result in report['results']:
+        old = previous.get((result['case'], result['size']))
+        if not old:
+            continue
+        ratio = result['best_s'] / old['best_s']
+        regressed = ratio > 1 + tolerance
+        regressions += regressed
+        print('{:<20} {:>7} {:>+8.1%}{}'.format(
+            result['case'], result['size'], ratio - 1,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark heartbeat serializer')
+    parser.add_argument('--sizes', '-n', metavar='N', type=int, nargs='+',
+                        default=SIZES, help='heartbeats per stream')
+    parser.add_argument('--cases', '-c', metavar='NAME', nargs='+',
+                        choices=sorted(CASES), default=DEFAULT_CASES,
+                        help='functions to benchmark')
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help='number of timing runs (best one is reported)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for synthetic heartbeats')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip memory measurements')
+    parser.add_argument('--output', '-o', metavar='PATH',
+                        help='write JSON results to file (default: stdout)')
+    parser.add_argument('--baseline', '-b', metavar='PATH',
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against baseline')
+    args = parser.parse_args()
+
+    report = run(args.cases, args.sizes, args.seed, args.repeat,
+                 memory=not args.no_memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Check that the reporting query stays index-backed as the stats table grows
+
+The script creates a scratch schema in the given PostgreSQL database, applies
+the ``monitoring`` migrations to it, fills ``stats`` with synthetic history
+in steps and prints the plan of the reporting query after each step. It exits
+with a non-zero status if the query is planned as a sequential scan of any
+``stats`` partition at any size. Run from the project root::
+
+    python -m benchmarks.stats_plan --dsn 'dbname=monitoring_test'
+
+Requires psycopg2.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+
+from monitoring.monitoring.partitions import DAY, create_partitions
+from monitoring.monitoring.reporting import SAT_REPORTS_QUERY
+
+from .database import scratch_schema
+
+# Clients and tuners referenced by the synthetic rows
+CLIENTS_QUERY = """
+insert into clients (id, uuid)
+select i, 'client-' || i from generate_series(0, %(clients)s - 1) as i;
+insert into tuners (id, vendor, model) values (1, '0bda', '2838');
+"""
+
+# Synthetic rows, one heartbeat a minute per client going back in time from
+# ``now``, with the newest rows first
+FILL_QUERY = """
+insert into stats (client_key, signal_lock, service_lock, bitrate, snr,
+                   signal_strength, service_ok, tuner_key, tuner_preset,
+                   carousels_count, carousels_mask, timestamp, reported,
+                   timeslot)
+select
+    i %% %(clients)s,
+    random() < 0.9,
+    random() < 0.8,
+    (random() * 400000)::integer,
+    random() * 3,
+    (random() * 100)::integer,
+    random() < 0.8,
+    1,
+    1 + (i %% %(clients)s) %% 6,
+    3,
+    (random() * 8)::integer %% 8,
+    %(now)s - (i / %(clients)s) * 60,
+    %(now)s - (i / %(clients)s) * 60,
+    (%(now)s - (i / %(clients)s) * 60) / 30
+from generate_series(%(first)s, %(last)s) as i;
+"""
+
+SIZES = (10000, 100000, 1000000, 10000000)
+
+
+def seq_scans(plan, relation='stats'):
+    """ Return sequential scan nodes on relation or its partitions in plan
+    tree, leaving out scans of empty partitions (such as the default one and
+    those created ahead of time) """
+    found = []
+    scanned = (plan.get('Actual Rows', 0) +
+               plan.get('Rows Removed by Filter', 0))
+    if (plan.get('Node Type') == 'Seq Scan' and
+            plan.get('Relation Name', '').startswith(relation) and scanned):
+        found.append(plan)
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child, relation))
+    return found
+
+
+def describe(plan, depth=0):
+    line = '{}{}'.format('  ' * depth, plan['Node Type'])
+    if 'Relation Name' in plan:
+        line += ' on {}'.format(plan['Relation Name'])
+    if 'Index Name' in plan:
+        line += ' using {}'.format(plan['Index Name'])
+    line += ' (rows={}, time={:.2f} ms)'.format(
+        plan.get('Actual Rows'), plan.get('Actual Total Time', 0))
+    lines = [line]
+    for child in plan.get('Plans', []):
+        lines.extend(describe(child, depth + 1))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser('check reporting query plan')
+    parser.add_argument('--dsn', required=True,
+                        help='PostgreSQL connection string')
+    parser.add_argument('--sizes', '-n', metavar='N', type=int, nargs='+',
+                        default=SIZES, help='table sizes to check')
+    parser.add_argument('--clients', type=int, default=5000,
+                        help='number of synthetic clients')
+    parser.add_argument('--interval', type=int, default=600,
+                        help='reporting interval in seconds')
+    args = parser.parse_args()
+
+    failed = False
+    # Nothing is committed, so the scratch schema is dropped at the end
+    with scratch_schema(args.dsn, 'plan_check') as (_, db, _):
+        cursor = db.cursor
+        cursor.execute(CLIENTS_QUERY, {'clients': args.clients})
+        now = int(time.time())
+        # Migrations create partitions from today on, so add daily partitions
+        # for the synthetic history as well
+        history = max(args.sizes) // args.clients * 60
+        create_partitions(db, now - history, now // DAY * DAY)
+        rows = 0
+        for size in sorted(args.sizes):
+            cursor.execute(FILL_QUERY, {'clients': args.clients, 'now': now,
+                                        'first': rows, 'last': size - 1})
+            rows = size
+            cursor.execute('analyze stats;')
+            cursor.execute('explain (analyze, format json) ' +
+                           SAT_REPORTS_QUERY,
+                           {'reported': now - args.interval})
+            plan = list(cursor.fetchone().values())[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            plan = plan[0]['Plan']
+            scans = seq_scans(plan)
+            failed = failed or bool(scans)
+            print('{} rows: {}'.format(
+                size, 'SEQUENTIAL SCAN' if scans else 'index-backed'))
+            print('\n'.join(describe(plan)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
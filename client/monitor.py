@@ -13,6 +13,7 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 import os
 import sys
+import zlib
 import uuid
 import time
 import json
@@ -22,13 +23,13 @@ import syslog
 import hashlib
 import argparse
 from urllib import urlencode
-from urllib2 import urlopen
+from urllib2 import urlopen, Request
 import xml.etree.ElementTree as ET
 from contextlib import contextmanager
 
 import pyudev
 
-from monitoring.core.serializer import to_stream_str
+from monitoring.core.serializer import to_stream_str, STREAM_V1, STREAM_V2
 from monitoring.core.satdata import PRESETS, COMPARE_KEYS
 
 LOG_HANDLE = 'outernet.monitor'
@@ -287,7 +288,19 @@ def clear_buffer(path):
         pass
 
 
-def send_or_buffer(server_url, buffer_path, data):
+def post_raw(server_url, data_stream):
+    """ Post stream as binary request body, deflated if that makes it smaller
+    """
+    headers = {'Content-Type': 'application/octet-stream'}
+    compressed = zlib.compress(data_stream, 9)
+    if len(compressed) < len(data_stream):
+        data_stream = compressed
+        headers['Content-Encoding'] = 'deflate'
+    urlopen(Request(server_url, data_stream, headers))
+
+
+def send_or_buffer(server_url, buffer_path, data,
+                   stream_version=STREAM_V1, raw=False):
     # Get existing data from buffer
     all_data = get_buffer(buffer_path)
     all_data.append(data)
@@ -297,9 +310,12 @@ def send_or_buffer(server_url, buffer_path, data):
                     if time.time() - item['timestamp'] <= TRANSMIT_PERIOD]
         syslog.syslog('Transmitting buffered data')
         try:
-            data_stream = to_stream_str(all_data)
-            http_params = {'stream': data_stream}
-            urlopen(server_url, urlencode(http_params))
+            data_stream = to_stream_str(all_data, stream_version)
+            if raw:
+                post_raw(server_url, data_stream)
+            else:
+                http_params = {'stream': data_stream}
+                urlopen(server_url, urlencode(http_params))
         except IOError as err:
             syslog.syslog('Could not establish connection to {}: {}'.format(
                 server_url, err))
@@ -316,7 +332,7 @@ def is_activator_present(activator):
 
 
 def monitor_loop(server_url, key_path, socket_path, buffer_path, platform,
-                 activator, setup_path):
+                 activator, setup_path, stream_version=STREAM_V1, raw=False):
     client_key = generate_key(key_path)
     try:
         while 1:
@@ -330,7 +346,8 @@ def monitor_loop(server_url, key_path, socket_path, buffer_path, platform,
             data = collect_data(socket_path, setup_path)
             if data:
                 data['client_id'] = client_key
-                send_or_buffer(server_url, buffer_path, data)
+                send_or_buffer(server_url, buffer_path, data,
+                               stream_version, raw)
 
             time.sleep(HEARTBEAT_PERIOD)
     except KeyboardInterrupt:
@@ -361,6 +378,14 @@ def main():
                         'activation file', default=None)
     parser.add_argument('--pid', '-P', metavar='PATH', help='path to PID file',
                         default='/var/run/monitoring.pid')
+    parser.add_argument('--stream-version', '-V', metavar='VERSION',
+                        type=int, choices=(STREAM_V1, STREAM_V2),
+                        help='heartbeat stream format version (2 is more '
+                        'compact but needs an up-to-date server)',
+                        default=STREAM_V1)
+    parser.add_argument('--raw', '-r', action='store_true',
+                        help='post stream as binary request body (use with '
+                        'the /heartbeat/v2/ endpoint)')
     args = parser.parse_args()
     syslog.openlog(LOG_HANDLE)
 
@@ -372,7 +397,8 @@ def main():
     signal.signal(signal.SIGTERM, exiter)
 
     ret = monitor_loop(args.url, args.key, args.socket, args.buffer,
-                       args.platform, args.activator, args.setup)
+                       args.platform, args.activator, args.setup,
+                       args.stream_version, args.raw)
 
     exiter(code=ret)
 
@@ -3,6 +3,9 @@ from __future__ import division
 
 import time
 import uuid
+import logging
+import struct
+import binascii
 import itertools
 
 from bitarray import bitarray
@@ -12,6 +15,65 @@ ENDIAN = 'big'
 START_MARKER = bitarray('01001111' '01001000' '01000100', ENDIAN) #OHD
 END_MARKER = bitarray('01000100' '01001000' '01001111', ENDIAN) #OHD
 
+# Integer values of the start and end markers
+START_MARKER_VALUE = 0x4f4844
+END_MARKER_VALUE = 0x44484f
+
+# Bit layout of the fixed part of a datagram, in stream order. Fields named
+# ``None`` are not exposed in decoded heartbeats.
+DATAGRAM_LAYOUT = (
+    (None, 24),                 # start marker
+    ('client_id', 128),
+    ('timestamp', 4),
+    ('tuner_vendor', 16),
+    ('tuner_model', 16),
+    ('tuner_preset', 5),
+    ('signal_lock', 1),
+    ('service_lock', 1),
+    ('signal_strength', 4),
+    ('snr', 5),
+    ('bitrate', 6),
+    (None, 2),                  # padding for later use
+    ('carousel_count', 5),
+)
+HEADER_BITS = sum(width for _, width in DATAGRAM_LAYOUT)   # 217 bits
+CAROUSEL_SLOT_BITS = 31
+MARKER_BITS = 24
+SLOT_END_BITS = HEADER_BITS + CAROUSEL_SLOT_BITS              # 248 bits
+DATAGRAM_BITS = SLOT_END_BITS + MARKER_BITS                     # 272 bits
+
+# Number of bits accumulated by the packer before full bytes are flushed
+PACK_FLUSH_BITS = 8 * 4096
+
+BOOL_FIELDS = ('signal_lock', 'service_lock')
+
+# Resolution of timestamp deltas in seconds
+TIMESTAMP_RESOLUTION = 5
+
+# Stream format versions
+STREAM_V1 = 1
+STREAM_V2 = 2
+
+# Compact stream format (v2). A stream starts with a magic prefix and is
+# followed by sections, one per run of heartbeats sharing the same client and
+# tuner. Each section is a header and a varint record count, followed by the
+# records. A record is a varint timestamp delta in seconds, 3 bytes of
+# bit-packed sample fields and the carousel status bits padded to full bytes.
+V2_MAGIC = b'OHV\x02'
+V2_SECTION = struct.Struct('>16sHHB')   # client_id, vendor, model, preset
+V2_SECTION_FIELDS = ('client_id', 'tuner_vendor', 'tuner_model',
+                     'tuner_preset')
+V2_RECORD_LAYOUT = (
+    ('signal_lock', 1),
+    ('service_lock', 1),
+    ('signal_strength', 4),
+    ('snr', 5),
+    ('bitrate', 6),
+    ('carousel_count', 5),
+    (None, 2),                  # padding for later use
+)
+V2_RECORD_BYTES = 3
+
 
 def to_stream(heartbeats):
     base_time = time.time()
@@ -54,14 +116,585 @@ def from_stream(stream):
     return heartbeats
 
 
-def to_stream_str(heartbeats):
-    return to_stream(heartbeats).tobytes()
+def to_stream_str(heartbeats, version=STREAM_V1):
+    if version == STREAM_V2:
+        return pack_stream_v2(heartbeats)
+    return pack_stream(heartbeats)
 
 
 def from_stream_str(stream):
-    ba = bitarray()
-    ba.frombytes(bytes(stream))
-    return from_stream(ba)
+    stream = bytes(stream)
+    if is_stream_v2(stream):
+        return list(_iter_records_v2(_read_stream_v2(stream)))
+    heartbeats = unpack_stream(stream)
+    if heartbeats is None:
+        # Stream does not consist of back-to-back datagrams, so let the marker
+        # search sort it out (or reject it)
+        ba = bitarray()
+        ba.frombytes(stream)
+        heartbeats = from_stream(ba)
+    return heartbeats
+
+
+def from_stream_columns(stream):
+    """ Decode stream bytes into a dict of NumPy arrays, one per field
+
+    Meant for bulk analysis of archived streams. Columns are the heartbeat
+    fields with the same denormalization as ``from_stream_str()``, except
+    that ``client_id`` holds raw 16-byte UUID records, ``tuner_vendor`` and
+    ``tuner_model`` are integers rather than hex strings, and
+    ``carousel_status`` is a bitmask in which bit ``i`` is the status of
+    carousel ``i``.
+
+    Datagrams of v1 streams are located and decoded without a per-record
+    Python loop, and datagrams that do not frame are left out. Compact (v2)
+    streams are decoded record by record and then converted to columns.
+
+    Requires NumPy.
+    """
+    import numpy
+
+    stream = bytes(stream)
+    if is_stream_v2(stream):
+        columns = _columns_v2(numpy, stream)
+    else:
+        columns = _columns_v1(numpy, stream)
+    # Timestamp deltas are relative to the following heartbeat, the last one
+    # being relative to the time the stream was created
+    deltas = columns['timestamp']
+    offsets = numpy.cumsum(deltas[::-1])[::-1]
+    columns['timestamp'] = time.time() - offsets * columns.pop('resolution')
+    columns['signal_strength'] = columns['signal_strength'] * 10
+    columns['snr'] = columns['snr'] / 10
+    columns['bitrate'] = columns['bitrate'] * (1000 * 10)
+    return columns
+
+
+def _compile_layout(layout, total_bits):
+    """ Return (name, width, shift, mask) for each field in layout """
+    fields = []
+    offset = total_bits
+    for name, width in layout:
+        offset -= width
+        fields.append((name, width, offset, (1 << width) - 1))
+    return tuple(fields)
+
+
+HEADER_FIELDS = _compile_layout(DATAGRAM_LAYOUT, HEADER_BITS)
+V2_RECORD_FIELDS = tuple(f for f in _compile_layout(V2_RECORD_LAYOUT,
+                                                    V2_RECORD_BYTES * 8)
+                         if f[0] is not None)
+V2_CAROUSEL_COUNT_SHIFT = [shift for name, _, shift, _ in V2_RECORD_FIELDS
+                           if name == 'carousel_count'][0]
+NAMED_HEADER_FIELDS = tuple(f for f in HEADER_FIELDS if f[0] is not None)
+START_MARKER_SHIFT = HEADER_FIELDS[0][2]
+TIMESTAMP_FIELD = [(shift, mask) for name, _, shift, mask in HEADER_FIELDS
+                   if name == 'timestamp'][0]
+# Start marker at each bit shift within a 4-byte window, as (shift, middle
+# two bytes, value, mask) tuples. The middle bytes are whole marker bytes at
+# every shift, so they can be searched for bytewise.
+START_MARKER_SHIFTS = tuple(
+    (shift, struct.pack('>I', START_MARKER_VALUE << (8 - shift))[1:3],
+     START_MARKER_VALUE << (8 - shift), 0xffffff << (8 - shift))
+    for shift in range(8))
+
+
+def pack_stream(heartbeats):
+    """ Encode heartbeats into stream bytes using integer arithmetic
+
+    Output is identical to ``to_stream(heartbeats).tobytes()``.
+    """
+    base_time = time.time()
+    datagrams = []
+    # Reverse iterate over the heartbeats for timestamp delta calculations
+    for h in reversed(heartbeats):
+        h = h.copy()
+        prev_time = h['timestamp']
+        h = _normalize_heartbeat(h, base_time)
+        datagrams.append(_pack_datagram(h))
+        base_time = prev_time
+    # Get back the original order
+    datagrams.reverse()
+    return _join_datagrams(datagrams)
+
+
+def unpack_stream(stream):
+    """ Decode stream bytes made up of back-to-back datagrams
+
+    Returns the same heartbeats as ``from_stream_str()``, or ``None`` if the
+    stream does not have the expected framing.
+    """
+    datagrams, skipped_bits = _frame_stream(stream)
+    if skipped_bits:
+        return None
+    heartbeats = [_datagram_to_heartbeat(header, statuses)
+                  for header, statuses in datagrams]
+
+    base_time = time.time()
+    # Reverse iterate over datagrams in stream because of timestamp deltas
+    for heartbeat in reversed(heartbeats):
+        _denormalize_heartbeat(heartbeat, base_time)
+        base_time = heartbeat['timestamp']
+    return heartbeats
+
+
+def iter_stream_str(stream):
+    """ Return an iterator over heartbeats in stream bytes
+
+    The stream is framed in a single pass that keeps only the raw datagram
+    values, and heartbeats are built as the iterator is consumed. Datagrams
+    that fail to frame are skipped up to the next start marker instead of
+    invalidating the whole stream. Since timestamps are deltas from the
+    following datagram, timestamps preceding a skipped region are off by the
+    time the lost datagrams covered.
+
+    Compact (v2) streams are recognized by their prefix. They carry no
+    markers to resynchronize on, so a malformed v2 stream is rejected.
+
+    Raises ``ValueError`` if a non-empty stream contains no valid datagrams.
+    """
+    stream = bytes(stream)
+    if is_stream_v2(stream):
+        return _iter_records_v2(_read_stream_v2(stream))
+    datagrams, skipped_bits = _frame_stream(stream)
+    if stream and not datagrams:
+        raise ValueError('Stream contains no valid datagrams')
+    if skipped_bits:
+        logging.warning('Skipped %s bits of corrupt heartbeat stream',
+                        skipped_bits)
+    return _iter_datagrams(datagrams)
+
+
+def _frame_stream(stream):
+    """ Return a list of (header, carousel bits) pairs and the number of bits
+    that had to be skipped to find them
+
+    Like ``from_stream()``, datagrams are framed by their markers. A datagram
+    with more than 31 carousels has its end marker at the end of the carousel
+    slot and the remaining carousel bits after it, so bits between such a
+    datagram and the next start marker are taken as its tail rather than as
+    corrupt, as long as they fit its carousel count (see
+    ``_is_carousel_tail()``).
+    """
+    total_bits = len(stream) * 8
+    datagrams = []
+    skipped_bits = 0
+    pos = 0
+    tail_count = None
+    while total_bits - pos >= 8:
+        datagram = _read_datagram(stream, pos)
+        if datagram is None:
+            # Resynchronize on the next start marker
+            next_pos = _find_start_marker(stream, pos + 1)
+            if next_pos is None:
+                next_pos = total_bits
+            if not _is_carousel_tail(stream, pos, next_pos, tail_count):
+                skipped_bits += next_pos - pos
+            pos = next_pos
+            tail_count = None
+            continue
+        header, statuses, length = datagram
+        datagrams.append((header, statuses))
+        pos += length
+        # Only datagrams that end at the end of the slot can have a tail
+        tail_count = header & 0x1f if length == DATAGRAM_BITS else None
+    return datagrams, skipped_bits
+
+
+def _is_carousel_tail(stream, start, end, count):
+    """ Return whether the bits from ``start`` to ``end`` are the carousels
+    beyond the 31-bit slot of the preceding datagram
+
+    The 5-bit carousel count of a datagram with ``n`` carousels holds ``n``
+    modulo 32, and ``n - 31`` carousel bits follow its end marker. At the end
+    of the stream the tail is followed by up to 7 padding bits. A tail
+    cannot contain markers, as the marker search of ``from_stream()`` would
+    not frame the stream either.
+    """
+    if count is None:
+        return False
+    bits = end - start
+    padding = range(8) if end == len(stream) * 8 else (0,)
+    if not any(bits - p > count and (bits - p - count - 1) % 32 == 0
+               for p in padding):
+        return False
+    first = start // 8
+    value = bytes_to_int(stream[first:(end + 7) // 8])
+    value_bits = (end - first * 8 + 7) // 8 * 8
+    value >>= value_bits - (end - first * 8)
+    for shift in range(bits - MARKER_BITS + 1):
+        if (value >> shift) & 0xffffff in (START_MARKER_VALUE,
+                                           END_MARKER_VALUE):
+            return False
+    return True
+
+
+def _find_start_marker(stream, pos):
+    """ Return bit position of the first start marker at or after ``pos`` """
+    last_pos = len(stream) * 8 - HEADER_BITS - MARKER_BITS
+    found = None
+    for shift, needle, value, mask in START_MARKER_SHIFTS:
+        # First byte a marker at this bit shift can start in
+        first = pos // 8 + (1 if shift < pos % 8 else 0)
+        index = stream.find(needle, first + 1)
+        while index != -1:
+            start = (index - 1) * 8 + shift
+            if start > last_pos or (found is not None and start >= found):
+                break
+            if bytes_to_int(stream[index - 1:index + 3]) & mask == value:
+                found = start
+                break
+            index = stream.find(needle, index + 1)
+    return found
+
+
+def _iter_datagrams(datagrams):
+    timestamp_shift, timestamp_mask = TIMESTAMP_FIELD
+    total_delta = sum((header >> timestamp_shift) & timestamp_mask
+                      for header, _ in datagrams)
+    base_time = time.time()
+    for header, statuses in datagrams:
+        heartbeat = _datagram_to_heartbeat(header, statuses)
+        # Timestamp delta from this heartbeat to stream creation time
+        delta = total_delta
+        total_delta -= heartbeat['timestamp']
+        heartbeat['timestamp'] = delta
+        yield _denormalize_heartbeat(heartbeat, base_time)
+
+
+def is_stream_v2(stream):
+    return stream[:len(V2_MAGIC)] == V2_MAGIC
+
+
+def is_stream(stream):
+    """ Return whether bytes start the way a v1 or v2 stream does
+
+    This is only a cheap sanity check that does not decode anything.
+    """
+    return is_stream_v2(stream) or stream[:3] == b'OHD'
+
+
+def pack_stream_v2(heartbeats):
+    """ Encode heartbeats into a compact (v2) stream
+
+    Timestamps are stored as whole seconds between consecutive heartbeats,
+    and between the last heartbeat and the time of encoding, so they do not
+    depend on the clocks of the client and the server agreeing.
+    """
+    base_time = time.time()
+    # Offsets from encoding time are quantized before taking differences so
+    # that rounding errors do not accumulate along the stream
+    offsets = [max(int(base_time - h['timestamp']), 0) for h in heartbeats]
+    offsets.append(0)
+    out = bytearray(V2_MAGIC)
+    section_key = None
+    section = None
+    for i, h in enumerate(heartbeats):
+        h = _normalize_heartbeat(h.copy(), base_time)
+        key = tuple(h[name] for name in V2_SECTION_FIELDS)
+        if key != section_key:
+            if section is not None:
+                _write_section_v2(out, section_key, section)
+            section_key = key
+            section = []
+        h['timestamp'] = max(offsets[i] - offsets[i + 1], 0)
+        section.append(h)
+    if section is not None:
+        _write_section_v2(out, section_key, section)
+    return bytes(out)
+
+
+def _write_section_v2(out, key, records):
+    client_id, vendor, model, preset = key
+    out.extend(V2_SECTION.pack(int_to_bytes(client_id, 16), vendor & 0xffff,
+                               model & 0xffff, preset & 0xff))
+    write_varint(out, len(records))
+    for h in records:
+        write_varint(out, h['timestamp'])
+        count = min(h['carousel_count'], 0x1f)
+        statuses = list(h['carousel_status'][:count])
+        statuses += [False] * (count - len(statuses))
+        h['carousel_count'] = count
+        value = 0
+        for name, _, shift, mask in V2_RECORD_FIELDS:
+            value |= (int(h[name]) & mask) << shift
+        out.extend(int_to_bytes(value, V2_RECORD_BYTES))
+        status_bytes = (count + 7) // 8
+        value = 0
+        for status in statuses:
+            value = (value << 1) | (1 if status else 0)
+        out.extend(int_to_bytes(value << (status_bytes * 8 - count),
+                                status_bytes))
+
+
+def _read_stream_v2(stream):
+    """ Return a list of (section key, timestamp delta, record fields,
+    carousel bits) tuples for records in a compact (v2) stream """
+    data = bytearray(stream)
+    pos = len(V2_MAGIC)
+    records = []
+    try:
+        while pos < len(data):
+            key = V2_SECTION.unpack(bytes(data[pos:pos + V2_SECTION.size]))
+            pos += V2_SECTION.size
+            count, pos = read_varint(data, pos)
+            for _ in range(count):
+                delta, pos = read_varint(data, pos)
+                chunk = bytes(data[pos:pos + V2_RECORD_BYTES])
+                if len(chunk) != V2_RECORD_BYTES:
+                    raise ValueError('Stream ends in the middle of a record')
+                fields = bytes_to_int(chunk)
+                pos += V2_RECORD_BYTES
+                carousel_count = fields >> V2_CAROUSEL_COUNT_SHIFT & 0x1f
+                status_bytes = (carousel_count + 7) // 8
+                chunk = bytes(data[pos:pos + status_bytes])
+                if len(chunk) != status_bytes:
+                    raise ValueError('Stream ends in the middle of a record')
+                pos += status_bytes
+                statuses = bytes_to_int(chunk) if chunk else 0
+                statuses >>= status_bytes * 8 - carousel_count
+                records.append((key, delta, fields, statuses))
+    except (struct.error, IndexError):
+        raise ValueError('Stream ends in the middle of a section')
+    return records
+
+
+def _iter_records_v2(records):
+    total_delta = sum(delta for _, delta, _, _ in records)
+    base_time = time.time()
+    for key, delta, fields, statuses in records:
+        heartbeat = dict()
+        client_id, vendor, model, preset = key
+        heartbeat['client_id'] = uuid_str(bytes_to_int(client_id))
+        heartbeat['tuner_vendor'] = vendor
+        heartbeat['tuner_model'] = model
+        heartbeat['tuner_preset'] = preset
+        for name, _, shift, mask in V2_RECORD_FIELDS:
+            heartbeat[name] = int((fields >> shift) & mask)
+        for name in BOOL_FIELDS:
+            heartbeat[name] = bool(heartbeat[name])
+        count = heartbeat['carousel_count']
+        heartbeat['carousel_status'] = [bool((statuses >> i) & 1)
+                                        for i in range(count - 1, -1, -1)]
+        heartbeat['timestamp'] = total_delta
+        total_delta -= delta
+        yield _denormalize_heartbeat(heartbeat, base_time, resolution=1)
+
+
+def _pack_datagram(heartbeat):
+    """ Return datagram as an (int value, length in bits) pair
+
+    The carousel statuses replace the 31-bit slot in the datagram, and the end
+    marker is written over bits 248-272, so a datagram with fewer than 7 or
+    more than 31 carousels is not 272 bits long. This mirrors the slice
+    assignments in ``_to_datagram()``.
+    """
+    value = START_MARKER_VALUE << START_MARKER_SHIFT
+    for name, _, shift, mask in NAMED_HEADER_FIELDS:
+        value |= (int(heartbeat[name]) & mask) << shift
+    length = HEADER_BITS
+    for status in heartbeat['carousel_status']:
+        value = (value << 1) | (1 if status else 0)
+        length += 1
+    # Zero bits that followed the carousel slot
+    value <<= MARKER_BITS
+    length += MARKER_BITS
+
+    end_pos = SLOT_END_BITS
+    if length <= end_pos:
+        return (value << MARKER_BITS) | END_MARKER_VALUE, length + MARKER_BITS
+    tail_bits = max(length - DATAGRAM_BITS, 0)
+    tail = value & ((1 << tail_bits) - 1)
+    value = (((value >> (length - end_pos)) << MARKER_BITS) |
+             END_MARKER_VALUE)
+    return (value << tail_bits) | tail, DATAGRAM_BITS + tail_bits
+
+
+def _join_datagrams(datagrams):
+    chunks = []
+    acc = 0
+    nbits = 0
+    for value, length in datagrams:
+        acc = (acc << length) | value
+        nbits += length
+        if nbits >= PACK_FLUSH_BITS:
+            keep = nbits % 8
+            chunks.append(int_to_bytes(acc >> keep, nbits // 8))
+            acc &= (1 << keep) - 1
+            nbits = keep
+    pad = -nbits % 8
+    chunks.append(int_to_bytes(acc << pad, (nbits + pad) // 8))
+    return b''.join(chunks)
+
+
+def _read_datagram(stream, pos):
+    """ Return (header, carousel bits, length in bits) for datagram at bit
+    ``pos``, or ``None`` if there is no complete datagram at that position """
+    first = pos // 8
+    offset = pos % 8
+    chunk = stream[first:first + (offset + DATAGRAM_BITS + 7) // 8]
+    chunk_bits = len(chunk) * 8
+    if offset + HEADER_BITS + MARKER_BITS > chunk_bits:
+        return None
+    value = bytes_to_int(chunk)
+
+    header = value >> (chunk_bits - offset - HEADER_BITS)
+    header &= (1 << HEADER_BITS) - 1
+    if header >> START_MARKER_SHIFT != START_MARKER_VALUE:
+        return None
+    count = header & 0x1f
+    # Short carousel lists pull the end marker in, see ``_pack_datagram()``
+    end_pos = min(HEADER_BITS + count + MARKER_BITS, SLOT_END_BITS)
+    if not _has_end_marker(value, chunk_bits, offset + end_pos):
+        # The 5-bit count wraps for more than 31 carousels, but the end
+        # marker of such a datagram is still at the end of the slot
+        if (end_pos == SLOT_END_BITS or
+                not _has_end_marker(value, chunk_bits,
+                                    offset + SLOT_END_BITS)):
+            return None
+        end_pos = SLOT_END_BITS
+    length = end_pos + MARKER_BITS
+
+    statuses = value >> (chunk_bits - offset - HEADER_BITS - count)
+    statuses &= (1 << count) - 1
+    return header, statuses, length
+
+
+def _has_end_marker(value, value_bits, pos):
+    """ Return whether an end marker is at bit ``pos`` of ``value`` """
+    if pos + MARKER_BITS > value_bits:
+        return False
+    end_marker = value >> (value_bits - pos - MARKER_BITS)
+    return end_marker & 0xffffff == END_MARKER_VALUE
+
+
+def _datagram_to_heartbeat(header, statuses):
+    heartbeat = dict()
+    for name, _, shift, mask in NAMED_HEADER_FIELDS:
+        heartbeat[name] = int((header >> shift) & mask)
+    for name in BOOL_FIELDS:
+        heartbeat[name] = bool(heartbeat[name])
+    heartbeat['client_id'] = uuid_str(heartbeat['client_id'])
+    count = heartbeat['carousel_count']
+    heartbeat['carousel_status'] = [bool((statuses >> i) & 1)
+                                    for i in range(count - 1, -1, -1)]
+    return heartbeat
+
+
+def _columns_v1(numpy, stream):
+    bits = numpy.unpackbits(numpy.frombuffer(stream, dtype=numpy.uint8))
+    # Look for whole start markers in the stream realigned at each of the 8
+    # bit offsets, which can be done bytewise
+    marker = [(START_MARKER_VALUE >> shift) & 0xff for shift in (16, 8, 0)]
+    starts = []
+    for offset in range(8):
+        realigned = numpy.packbits(bits[offset:])
+        found = ((realigned[:-2] == marker[0]) &
+                 (realigned[1:-1] == marker[1]) &
+                 (realigned[2:] == marker[2]))
+        starts.append(numpy.flatnonzero(found) * 8 + offset)
+    starts = numpy.sort(numpy.concatenate(starts)).astype(numpy.int64)
+    # Shortest datagram is one with no carousels
+    starts = starts[starts + HEADER_BITS + 2 * MARKER_BITS <= len(bits)]
+
+    count = _gather_bits(numpy, bits, starts + HEADER_BITS - 5, 5)
+    # Short carousel lists pull the end marker in, see ``_pack_datagram()``
+    end_pos = numpy.minimum(HEADER_BITS + count + MARKER_BITS, SLOT_END_BITS)
+    valid = _end_markers_at(numpy, bits, starts + end_pos)
+    # The 5-bit count wraps for more than 31 carousels, but the end marker
+    # of such a datagram is still at the end of the slot
+    wrapped = ~valid & (end_pos < SLOT_END_BITS)
+    wrapped[wrapped] = _end_markers_at(numpy, bits,
+                                       starts[wrapped] + SLOT_END_BITS)
+    end_pos[wrapped] = SLOT_END_BITS
+    valid |= wrapped
+    starts = starts[valid]
+    ends = starts + end_pos[valid] + MARKER_BITS
+    starts = starts[_separate_datagrams(numpy, starts, ends)]
+
+    columns = {}
+    for name, width, shift, _ in NAMED_HEADER_FIELDS:
+        offset = HEADER_BITS - shift - width
+        if name == 'client_id':
+            idx = (starts + offset)[:, None] + numpy.arange(width)
+            records = numpy.packbits(bits[idx], axis=1)
+            columns[name] = numpy.ascontiguousarray(records).view(
+                'V16').reshape(-1)
+        else:
+            columns[name] = _gather_bits(numpy, bits, starts + offset, width)
+    for name in BOOL_FIELDS:
+        columns[name] = columns[name].astype(bool)
+    count = columns['carousel_count']
+    idx = (starts + HEADER_BITS)[:, None] + numpy.arange(CAROUSEL_SLOT_BITS)
+    idx = numpy.minimum(idx, len(bits) - 1)
+    present = numpy.arange(CAROUSEL_SLOT_BITS) < count[:, None]
+    statuses = (bits[idx] & present).astype(numpy.int64)
+    columns['carousel_status'] = statuses.dot(
+        1 << numpy.arange(CAROUSEL_SLOT_BITS, dtype=numpy.int64))
+    columns['resolution'] = TIMESTAMP_RESOLUTION
+    return columns
+
+
+def _columns_v2(numpy, stream):
+    records = _read_stream_v2(stream)
+    keys = [key for key, _, _, _ in records]
+    fields = numpy.array([f for _, _, f, _ in records], dtype=numpy.int64)
+    columns = {}
+    columns['client_id'] = numpy.array([k[0] for k in keys], dtype='V16')
+    for i, name in enumerate(V2_SECTION_FIELDS[1:]):
+        columns[name] = numpy.array([k[i + 1] for k in keys],
+                                    dtype=numpy.int64)
+    for name, _, shift, mask in V2_RECORD_FIELDS:
+        columns[name] = (fields >> shift) & mask
+    for name in BOOL_FIELDS:
+        columns[name] = columns[name].astype(bool)
+    columns['timestamp'] = numpy.array([d for _, d, _, _ in records],
+                                       dtype=numpy.int64)
+    # Carousel bits are stored with the first carousel as the highest bit
+    statuses = [s for _, _, _, s in records]
+    count = columns['carousel_count']
+    shifts = count[:, None] - 1 - numpy.arange(CAROUSEL_SLOT_BITS)
+    bits = ((numpy.array(statuses, dtype=numpy.int64)[:, None] >>
+             numpy.maximum(shifts, 0)) & 1)
+    bits &= shifts >= 0
+    columns['carousel_status'] = bits.dot(
+        1 << numpy.arange(CAROUSEL_SLOT_BITS, dtype=numpy.int64))
+    columns['resolution'] = 1
+    return columns
+
+
+def _end_markers_at(numpy, bits, positions):
+    """ Return whether an end marker is at each of the positions """
+    found = numpy.zeros(len(positions), dtype=bool)
+    inside = positions + MARKER_BITS <= len(bits)
+    found[inside] = (_gather_bits(numpy, bits, positions[inside],
+                                  MARKER_BITS) == END_MARKER_VALUE)
+    return found
+
+
+def _separate_datagrams(numpy, starts, ends):
+    """ Return a mask of the datagrams that do not start inside the last
+    datagram kept before them, which drops marker patterns found in data """
+    keep = numpy.ones(len(starts), dtype=bool)
+    if (starts[1:] >= ends[:-1]).all():
+        return keep
+    # Whether a datagram is kept depends on which ones were kept before it,
+    # so overlaps are resolved one by one. Streams only have them when data
+    # happens to contain a marker.
+    last_end = 0
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if start < last_end:
+            keep[i] = False
+        else:
+            last_end = end
+    return keep
+
+
+def _gather_bits(numpy, bits, positions, width):
+    """ Return integers made of ``width`` bits at each of the positions """
+    idx = positions[:, None] + numpy.arange(width)
+    weights = 1 << numpy.arange(width - 1, -1, -1, dtype=numpy.int64)
+    return bits[idx].astype(numpy.int64).dot(weights)
 
 
 def _normalize_heartbeat(heartbeat, base_time):
@@ -91,9 +724,10 @@ def _normalize_heartbeat(heartbeat, base_time):
     return heartbeat
 
 
-def _denormalize_heartbeat(heartbeat, base_time):
-    # Regain original timestamp (5-second resolution)
-    heartbeat['timestamp'] = base_time - (heartbeat['timestamp'] * 5)
+def _denormalize_heartbeat(heartbeat, base_time,
+                           resolution=TIMESTAMP_RESOLUTION):
+    # Regain original timestamp (5-second resolution by default)
+    heartbeat['timestamp'] = base_time - (heartbeat['timestamp'] * resolution)
 
     # Convert id from int to hex
     heartbeat['tuner_vendor'] = id_hex(heartbeat['tuner_vendor'])
@@ -177,6 +811,42 @@ def from_bitarray(b):
     return from_bytes(b.tobytes())
 
 
+def uuid_str(n):
+    h = '%032x' % n
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def int_to_bytes(n, length):
+    if not length:
+        return b''
+    return binascii.unhexlify('%0*x' % (length * 2, n))
+
+
+def bytes_to_int(b):
+    return int(binascii.hexlify(b), 16)
+
+
+def write_varint(out, n):
+    """ Append unsigned LEB128 encoding of n to bytearray """
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    """ Return (value, next position) for LEB128 number in bytearray """
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
 def to_bytes(n, length):
     h = '%x' % n
     s = ('0'*(len(h) % 2) + h).zfill(length*2).decode('hex')
@@ -0,0 +1,177 @@
+import time
+import heapq
+import logging
+import itertools
+
+import gevent
+from gevent.queue import Queue, Full, Empty
+
+from ..utils.smtpclient import SMTPClient, is_permanent_error
+from .metrics import ALERT_MAILS
+from .throttle import AlertThrottle
+
+
+class AlertQueue(object):
+    """ Bounded queue of alert mails sent by a single worker greenlet
+
+    The worker reuses one SMTP connection, checks that it still works before
+    sending over it, and closes it after ``idle_timeout`` seconds without
+    mail. Mails that fail are set aside and retried on a fresh connection
+    after ``retry_delay`` seconds, doubling the delay up to
+    ``max_retry_delay``, until ``retries`` attempts have failed. Meanwhile
+    the worker goes on with the other mails. Mails the server rejects for
+    good (5xx replies, all recipients refused) are dropped right away.
+    """
+
+    def __init__(self, client, size=100, retries=5, retry_delay=30,
+                 max_retry_delay=900, idle_timeout=300):
+        self.client = client
+        self.queue = Queue(maxsize=size)
+        self.size = size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.idle_timeout = idle_timeout
+        # (time of next attempt, sequence, mail) of mails to be retried
+        self.deferred = []
+        self.sequence = itertools.count()
+        self.last_active = time.time()
+        self.greenlet = None
+        self.enqueued = 0
+        self.rejected = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connects = 0
+        self.last_sent = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.work)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        self.client.close()
+
+    def put(self, recipients, subject, message):
+        """ Queue mail, return ``False`` if the queue is full """
+        try:
+            if len(self.deferred) + self.queue.qsize() >= self.size:
+                raise Full()
+            # mail is (time queued, recipients, subject, message, attempts)
+            self.queue.put_nowait((time.time(), recipients, subject, message,
+                                   0))
+        except Full:
+            self.rejected += 1
+            ALERT_MAILS.inc(outcome='rejected')
+            logging.error('Alert queue is full, dropped mail: %s', subject)
+            return False
+        self.enqueued += 1
+        return True
+
+    def work(self):
+        while True:
+            mail = self.next_mail()
+            if mail is not None:
+                self.deliver(*mail)
+                self.last_active = time.time()
+            elif time.time() - self.last_active >= self.idle_timeout:
+                self.client.close()
+
+    def next_mail(self):
+        """ Return the next mail that is due, or ``None`` if there is none
+        within ``idle_timeout`` seconds or before a deferred mail is due """
+        timeout = self.idle_timeout
+        if self.deferred:
+            wait = self.deferred[0][0] - time.time()
+            if wait <= 0:
+                return heapq.heappop(self.deferred)[2]
+            timeout = min(wait, timeout)
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def defer(self, mail, delay):
+        heapq.heappush(self.deferred, (time.time() + delay,
+                                       next(self.sequence), mail))
+
+    def ensure_connection(self):
+        if self.client.is_connected():
+            return
+        # a connection that no longer responds is dropped and replaced
+        self.client.close()
+        self.client.connect()
+        self.connects += 1
+
+    def deliver(self, queued_at, recipients, subject, message, attempts):
+        try:
+            self.ensure_connection()
+            self.client.send(recipients, subject, message)
+        except Exception as exc:
+            self.client.close()
+            attempts += 1
+            if is_permanent_error(exc):
+                self.failed += 1
+                ALERT_MAILS.inc(outcome='failed')
+                logging.error('Alert mail rejected by the SMTP server, '
+                              'dropped it: %s: %s', subject, exc)
+                return False
+            if attempts > self.retries:
+                self.failed += 1
+                ALERT_MAILS.inc(outcome='failed')
+                logging.exception('Sending alert mail failed after %s '
+                                  'attempts: %s', attempts, subject)
+                return False
+            delay = min(self.retry_delay * 2 ** (attempts - 1),
+                        self.max_retry_delay)
+            self.retried += 1
+            ALERT_MAILS.inc(outcome='retried')
+            logging.warning('Sending alert mail failed, retrying in %s '
+                            'seconds: %s', delay, subject)
+            self.defer((queued_at, recipients, subject, message, attempts),
+                       delay)
+            return False
+        self.sent += 1
+        self.last_sent = time.time()
+        ALERT_MAILS.inc(outcome='sent')
+        logging.debug('Sent alert mail queued %.1f seconds ago: %s',
+                      self.last_sent - queued_at, subject)
+        return True
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize() + len(self.deferred),
+            'deferred': len(self.deferred),
+            'size': self.size,
+            'enqueued': self.enqueued,
+            'rejected': self.rejected,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'connects': self.connects,
+            'connected': self.client.conn is not None,
+            'last_sent': self.last_sent,
+        }
+
+
+def start_alerts(config):
+    """ Start the alert queue and set up the alert throttle """
+    client = SMTPClient(config['email.host'], config['email.port'],
+                        config['email.secure'], config['email.username'],
+                        config['email.password'],
+                        timeout=config['email.timeout'])
+    alerts = AlertQueue(client, size=config['email.queue_size'],
+                        retries=config['email.retries'],
+                        retry_delay=config['email.retry_delay'],
+                        max_retry_delay=config['email.max_retry_delay'],
+                        idle_timeout=config['email.idle_timeout'])
+    alerts.start()
+    config['alert_queue'] = alerts
+    throttle = AlertThrottle(
+        interval=config['reporting.notification_interval'],
+        escalate_after=config['reporting.escalate_after'],
+        recover_after=config['reporting.recover_after'])
+    throttle.restore(config.get('last_state'), config.get('last_alerts'))
+    config['alert_throttle'] = throttle
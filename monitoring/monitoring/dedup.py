@@ -0,0 +1,73 @@
+from ..utils.lru import ExpiringDict
+
+
+class HeartbeatDedup(object):
+    """ Detects resent heartbeats by client ID and timestamp slot
+
+    Keys of recently stored heartbeats are kept in memory so that the common
+    case of a client resending its buffer is caught without a database
+    round-trip. The unique index on ``(client_key, timeslot)`` catches the
+    rest.
+
+    Streams carry timestamps as deltas relative to the time they are sent,
+    so the timestamps rebuilt from a resent stream differ from the first copy
+    by a few seconds and may fall into a neighbouring slot. A heartbeat
+    within ``tolerance`` seconds of one stored in its own or a neighbouring
+    slot is therefore given the slot of the stored one, which keeps the key
+    of a resent heartbeat the same as the one it was first stored under.
+    """
+
+    def __init__(self, cache_size=100000, ttl=900, resolution=30,
+                 tolerance=None):
+        # (client_id, timeslot): timestamp of the stored heartbeat
+        self.recent = ExpiringDict(cache_size, ttl)
+        self.resolution = resolution
+        if tolerance is None:
+            tolerance = resolution / 2.0
+        self.tolerance = tolerance
+        self.checked = 0
+        self.suppressed = 0
+
+    def timeslot(self, client_id, timestamp, pending=None):
+        slot = int(timestamp // self.resolution)
+        for candidate in (slot, slot - 1, slot + 1):
+            key = (client_id, candidate)
+            stored = (pending or {}).get(key)
+            if stored is None:
+                stored = self.recent.get(key)
+            if (stored is not None and
+                    abs(stored - timestamp) <= self.tolerance):
+                return candidate
+        return slot
+
+    def filter(self, payloads):
+        """ Return payloads that were not seen recently and their keys
+
+        Keys are not remembered until ``remember()`` is called, so that
+        heartbeats from a failed write are not suppressed when resent.
+        """
+        fresh = []
+        keys = {}
+        for payload in payloads:
+            self.checked += 1
+            client_id = payload['client_id']
+            timestamp = payload['timestamp']
+            payload['timeslot'] = self.timeslot(client_id, timestamp, keys)
+            key = (client_id, payload['timeslot'])
+            if key in keys or key in self.recent:
+                self.suppressed += 1
+                continue
+            keys[key] = timestamp
+            fresh.append(payload)
+        return fresh, keys
+
+    def remember(self, keys):
+        for key, timestamp in keys.items():
+            self.recent[key] = timestamp
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'suppressed': self.suppressed,
+            'cached_keys': len(self.recent),
+        }
@@ -0,0 +1,116 @@
+"""
+Surrogate keys of clients and tuners
+
+Stats rows reference clients and tuners by integer keys. Keys never change
+once assigned, so they are cached in memory for the lifetime of the process
+and only unknown clients and tuners cost a database round-trip.
+"""
+
+# Both statements return keys of existing rows as well as of inserted ones
+RESOLVE_CLIENTS = """
+insert into clients (uuid)
+select unnest(%(uuids)s::varchar[])
+on conflict (uuid) do update set uuid = excluded.uuid
+returning id, uuid;
+"""
+
+RESOLVE_TUNERS = """
+insert into tuners (vendor, model)
+select * from unnest(%(vendors)s::varchar[], %(models)s::varchar[])
+on conflict (vendor, model) do update set vendor = excluded.vendor
+returning id, vendor, model;
+"""
+
+LOOKUP_CLIENT = """
+select id from clients where uuid = %(uuid)s;
+"""
+
+
+def carousels_mask(statuses):
+    """ Return carousel statuses as a bitmask in which bit ``i`` is the status
+    of carousel ``i`` """
+    mask = 0
+    for i, status in enumerate(statuses or ()):
+        if status:
+            mask |= 1 << i
+    return mask
+
+
+def tuner_id(payload):
+    return (payload['tuner_vendor'] or '', payload['tuner_model'] or '')
+
+
+class DimensionKeys(object):
+    """ In-process cache of client and tuner keys """
+
+    def __init__(self):
+        self.clients = {}
+        self.tuners = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, db, payloads):
+        """ Add ``client_key``, ``tuner_key`` and ``carousels_mask`` to
+        payloads, return keys of clients and tuners that were not cached
+
+        Must be called within the transaction that stores the payloads, so
+        that unknown clients and tuners are only inserted along with them.
+        The returned keys are cached by ``remember()`` once that transaction
+        is committed.
+        """
+        uuids = set(p['client_id'] for p in payloads) - set(self.clients)
+        tuners = set(tuner_id(p) for p in payloads) - set(self.tuners)
+        self.misses += len(uuids) + len(tuners)
+        self.hits += 2 * len(payloads) - len(uuids) - len(tuners)
+        clients = {}
+        tuner_keys = {}
+        if uuids or tuners:
+            clients, tuner_keys = self.fetch(db, sorted(uuids),
+                                             sorted(tuners))
+        for payload in payloads:
+            uuid = payload['client_id']
+            tuner = tuner_id(payload)
+            payload['client_key'] = clients.get(uuid, self.clients.get(uuid))
+            payload['tuner_key'] = tuner_keys.get(tuner,
+                                                  self.tuners.get(tuner))
+            payload['carousels_mask'] = carousels_mask(
+                payload['carousels_status'])
+        return clients, tuner_keys
+
+    def remember(self, keys):
+        clients, tuner_keys = keys
+        self.clients.update(clients)
+        self.tuners.update(tuner_keys)
+
+    def client_key(self, db, uuid):
+        """ Return key of a client, or ``None`` if it has never reported """
+        key = self.clients.get(uuid)
+        if key is None:
+            row = db.fetchone(LOOKUP_CLIENT, {'uuid': uuid})
+            if row is not None:
+                key = self.clients[uuid] = row['id']
+        return key
+
+    def fetch(self, db, uuids, tuners):
+        # Sorted input keeps the order of row locks the same across
+        # concurrent transactions
+        clients = {}
+        tuner_keys = {}
+        if uuids:
+            rows = db.fetchall(RESOLVE_CLIENTS, {'uuids': uuids})
+            clients = dict((row['uuid'], row['id']) for row in rows)
+        if tuners:
+            rows = db.fetchall(RESOLVE_TUNERS, {
+                'vendors': [vendor for vendor, _ in tuners],
+                'models': [model for _, model in tuners]})
+            tuner_keys = dict(((row['vendor'], row['model']), row['id'])
+                              for row in rows)
+        return clients, tuner_keys
+
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'tuners': len(self.tuners),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
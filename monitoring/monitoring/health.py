@@ -0,0 +1,193 @@
+"""
+Incrementally maintained sliding windows of client datapoints
+
+For every (tuner preset, client) pair the engine keeps running counts of the
+failures that the health checks in ``reporting`` look for, over the
+datapoints window and over the shorter window of recent timestamps. Counts
+are updated as batches are stored and as datapoints leave the windows, so a
+report only reads a few numbers per client instead of all their rows.
+"""
+
+import time
+import heapq
+import logging
+import itertools
+import collections
+
+from .reporting import (DATAPOINTS_INTERVAL, RECENT_INTERVAL,
+                        get_sat_reports)
+
+
+# Counts kept over the datapoints window
+WINDOW_COUNTS = ('datapoints', 'failures', 'zero_bitrate', 'errors',
+                 'bitrate')
+
+# Counts kept over datapoints with recent timestamps
+RECENT_COUNTS = ('recent', 'no_carousels', 'no_service_lock')
+
+COUNTS = WINDOW_COUNTS + RECENT_COUNTS
+
+
+def datapoint_counts(row):
+    """ Return contribution of a ``stats`` row to each of ``COUNTS`` """
+    bitrate = row['bitrate']
+    carousels = row['carousels_count'] > 0 and row['carousels_mask'] != 0
+    return (
+        1,
+        int(not (bitrate > 0 and carousels)),
+        int(bitrate == 0),
+        int(not row['service_ok']),
+        bitrate,
+        1,
+        int(bitrate > 0 and not carousels),
+        int(not row['service_lock']),
+    )
+
+
+class ClientWindow(object):
+    """ Counts over a single client's datapoints
+
+    Datapoints are kept in order of arrival, which is also the order of their
+    ``reported`` time, and in a heap ordered by ``timestamp``, which clients
+    do not always send in order.
+    """
+
+    WINDOW = len(WINDOW_COUNTS)
+
+    def __init__(self):
+        self.client_id = None
+        self.counts = [0] * len(COUNTS)
+        self.arrived = collections.deque()
+        self.recent = []
+        self.sequence = itertools.count()
+
+    def add(self, row, recent_since):
+        self.arrived.append(self.count(row, recent_since))
+
+    def merge(self, rows, recent_since):
+        """ Add rows ordered by ``reported`` that may be older than those
+        already added, keeping the datapoints in order of ``reported`` """
+        entries = [self.count(row, recent_since) for row in rows]
+        self.arrived = collections.deque(heapq.merge(self.arrived, entries))
+
+    def count(self, row, recent_since):
+        """ Add row to the counts and return its entry """
+        values = datapoint_counts(row)
+        # Entry is [reported, values, counted as recent]
+        entry = [row['reported'], values, row['timestamp'] >= recent_since]
+        self.update(values, 1, entry[2])
+        if entry[2]:
+            heapq.heappush(self.recent, (row['timestamp'],
+                                         next(self.sequence), entry))
+        return entry
+
+    def update(self, values, sign, recent):
+        end = len(COUNTS) if recent else self.WINDOW
+        for i in range(end):
+            self.counts[i] += sign * values[i]
+
+    def expire(self, reported_since, recent_since):
+        arrived = self.arrived
+        while arrived and arrived[0][0] < reported_since:
+            entry = arrived.popleft()
+            self.update(entry[1], -1, entry[2])
+            entry[2] = False
+        while self.recent and self.recent[0][0] < recent_since:
+            _, _, entry = heapq.heappop(self.recent)
+            if entry[2]:
+                entry[2] = False
+                self.update_recent(entry[1], -1)
+
+    def update_recent(self, values, sign):
+        for i in range(self.WINDOW, len(COUNTS)):
+            self.counts[i] += sign * values[i]
+
+    def as_dict(self):
+        return dict(zip(COUNTS, self.counts))
+
+
+class HealthEngine(object):
+    """ Sliding window counts of all clients seen within the interval
+
+    Only datapoints with signal lock are counted, like in
+    ``reporting.get_sat_reports()``.
+    """
+
+    def __init__(self, interval=DATAPOINTS_INTERVAL, recent=RECENT_INTERVAL):
+        self.interval = interval
+        self.recent = recent
+        self.windows = {}
+        self.started = time.time()
+        self.ready = False
+
+    def window(self, row):
+        key = (row['tuner_preset'], row['client_id'])
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = ClientWindow()
+            window.client_id = row['client_id']
+        return window
+
+    def add(self, rows, now=None):
+        recent_since = (now or time.time()) - self.recent
+        for row in rows:
+            if not row['signal_lock']:
+                continue
+            self.window(row).add(row, recent_since)
+
+    def rebuild(self, db):
+        """ Add datapoints stored before the engine started
+
+        Batches stored while the rebuild query runs have already been added,
+        so the older rows are merged into the windows rather than appended.
+        """
+        rows = [row for row in get_sat_reports(db, self.interval)
+                if row['reported'] < self.started]
+        rows.sort(key=lambda row: row['reported'])
+        by_window = collections.OrderedDict()
+        for row in rows:
+            if row['signal_lock']:
+                by_window.setdefault(self.window(row), []).append(row)
+        recent_since = time.time() - self.recent
+        for window, window_rows in by_window.items():
+            window.merge(window_rows, recent_since)
+        self.ready = True
+        return len(rows)
+
+    def reports(self, now=None):
+        """ Return (tuner preset, [(client ID, counts), ...]) pairs ordered by
+        preset, leaving out clients that have no datapoints left """
+        now = now or time.time()
+        # Same bracket as the one ``get_sat_reports()`` uses
+        reported_since = int(now - self.interval)
+        recent_since = now - self.recent
+        by_preset = {}
+        for key, window in list(self.windows.items()):
+            window.expire(reported_since, recent_since)
+            if not window.arrived:
+                del self.windows[key]
+                continue
+            by_preset.setdefault(key[0], []).append(
+                (window.client_id, window.as_dict()))
+        return sorted(by_preset.items())
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'clients': len(self.windows),
+            'datapoints': sum(len(w.arrived) for w in self.windows.values()),
+        }
+
+
+def rebuild_health(supervisor):
+    config = supervisor.config
+    db = supervisor.exts.databases['monitoring']
+    engine = config['health_engine']
+    start = time.time()
+    try:
+        count = engine.rebuild(db)
+    except Exception:
+        logging.exception('Rebuilding client health windows failed')
+        return
+    logging.info('Rebuilt client health windows from %s data points in '
+                 '%.1f ms', count, (time.time() - start) * 1000)
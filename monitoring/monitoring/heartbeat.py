@@ -3,28 +3,81 @@ import logging
 
 from bottle import request, abort
 
-from ..core.serializer import from_stream_str
+from ..core.serializer import iter_stream_str, from_stream_str, is_stream
+from .metrics import DECODE_SECONDS, DB_WRITE_SECONDS, ROWS_STORED
+from .rollups import update_rollups
+
+
+STATS_COLUMNS = ('client_key', 'signal_lock', 'service_lock',
+                 'signal_strength', 'bitrate', 'snr', 'service_ok',
+                 'tuner_key', 'tuner_preset', 'carousels_count',
+                 'carousels_mask', 'timestamp', 'reported', 'timeslot')
+
+STATS_TYPES = {
+    'client_key': 'integer',
+    'signal_lock': 'boolean',
+    'service_lock': 'boolean',
+    'signal_strength': 'float',
+    'bitrate': 'integer',
+    'snr': 'float',
+    'service_ok': 'boolean',
+    'tuner_key': 'integer',
+    'tuner_preset': 'integer',
+    'carousels_count': 'integer',
+    'carousels_mask': 'integer',
+    'timestamp': 'integer',
+    'reported': 'integer',
+    'timeslot': 'integer',
+}
+
+# The batch is passed as one array per column. Rows whose (client_key,
+# timeslot) is already stored are skipped, and the keys of the rows that
+# were inserted are returned.
+INSERT_STATS = """
+insert into stats ({})
+select * from unnest({})
+on conflict do nothing
+returning client_key, timeslot;
+""".format(', '.join(STATS_COLUMNS),
+           ', '.join('%({})s::{}[]'.format(c, STATS_TYPES[c])
+                     for c in STATS_COLUMNS))
 
 
 def process_heartbeat(data):
     try:
-        data = from_stream_str(data)
+        data = decode_stream(data)
     except (AttributeError, ValueError):
         import traceback
         traceback.print_exc()
         # Request body is either not available at all, or the JSON is malformed
         abort(400, 'Invalid data')
 
-    logging.info('Received %s data points', len(data))
+    count = process_batch(data)
 
-    for d in data:
-        process_data(d)
-
-    logging.info('Finished storing all data points')
+    logging.info('Finished storing %s data points', count)
 
     return 'OK'
 
 
+def decode_stream(stream):
+    """ Return iterator over heartbeats in stream that records decode time """
+    start = time.time()
+    heartbeats = iter_stream_str(stream)
+    return DECODE_SECONDS.time_iter(heartbeats, time.time() - start)
+
+
+def decode_stream_strict(stream):
+    """ Return list of heartbeats in stream, which must decode as a whole
+
+    Raises ``ValueError`` for data that is not a stream, and for truncated or
+    corrupt streams, rather than skipping the parts that do not decode.
+    """
+    with DECODE_SECONDS.time():
+        if stream is None or not is_stream(bytes(stream)):
+            raise ValueError('Data is not a heartbeat stream')
+        return from_stream_str(stream)
+
+
 def service_ok(data):
     signal_lock = data['signal_lock']
     service_lock = data['service_lock']
@@ -50,12 +103,13 @@ def service_ok(data):
     return True
 
 
-def process_data(data):
-    db = request.db.monitoring
+def get_payload(data, reported=None):
+    """ Return a ``stats`` row for the datapoint
 
+    The row still needs its dimension keys resolved before it is stored.
+    """
     status = service_ok(data)
-
-    payload = {
+    return {
         'client_id': data['client_id'],
         'signal_lock': data['signal_lock'],
         'service_lock': data['service_lock'],
@@ -69,9 +123,63 @@ def process_data(data):
         'carousels_count': data['carousel_count'],
         'carousels_status': data['carousel_status'],
         'timestamp': data['timestamp'],
-        'reported': time.time(),
+        'reported': reported or time.time(),
+        'timeslot': None,
     }
 
-    qry = db.Insert('stats', cols=payload.keys())
-    db.execute(qry, payload)
-    return status
+
+def process_batch(datapoints, db=None, dedup=None, dimensions=None,
+                  health=None):
+    """ Store all datapoints in a single transaction and return their count
+
+    All rows are inserted with a single statement, and the rollups are
+    updated with the rows it actually inserted in the same transaction.
+    Datapoints that ``dedup`` recognizes as resent are not stored, nor are
+    those the unique index rejects. Stored datapoints are added to the
+    ``health`` engine windows once committed.
+
+    When no database is passed, the database and the rest of the state are
+    those of the current request's app.
+    """
+    if db is None:
+        db = request.db.monitoring
+        config = request.app.config
+        dedup = config.get('heartbeat_dedup')
+        dimensions = config['dimension_keys']
+        health = config.get('health_engine')
+    start = time.time()
+    payloads = [get_payload(d, start) for d in datapoints]
+    keys = ()
+    if dedup is not None:
+        received = len(payloads)
+        payloads, keys = dedup.filter(payloads)
+        if received != len(payloads):
+            logging.info('Suppressed %s duplicate data points',
+                         received - len(payloads))
+    if not payloads:
+        return 0
+    with DB_WRITE_SECONDS.time():
+        with db.transaction():
+            # Unknown clients and tuners are inserted along with the rows
+            # that refer to them, or not at all
+            fetched = dimensions.resolve(db, payloads)
+            columns = dict((c, [p[c] for p in payloads])
+                           for c in STATS_COLUMNS)
+            rows = db.fetchall(INSERT_STATS, columns)
+            inserted = set((r['client_key'], r['timeslot']) for r in rows)
+            if len(rows) < len(payloads):
+                logging.info('Skipped %s data points that were already '
+                             'stored', len(payloads) - len(rows))
+                payloads = [p for p in payloads
+                            if (p['client_key'], p['timeslot']) in inserted]
+            update_rollups(db, payloads)
+    dimensions.remember(fetched)
+    if dedup is not None:
+        dedup.remember(keys)
+    if health is not None:
+        health.add(payloads)
+    for payload in payloads:
+        ROWS_STORED.inc(preset=payload['tuner_preset'])
+    logging.info('Stored batch of %s data points in %.1f ms', len(payloads),
+                 (time.time() - start) * 1000)
+    return len(payloads)
@@ -1,17 +1,104 @@
+from .alerts import start_alerts
+from .dedup import HeartbeatDedup
+from .dimensions import DimensionKeys
+from .health import HealthEngine, rebuild_health
+from .ingest import IngestQueue
+from .leader import ReportLease, check_lease_ttl, run_report
+from .partitions import maintain_partitions
+from .reportpool import ReportPool, database_options
 from .reporting import send_report
+from .reportworker import ReportWorker, worker_config
+from .snapshots import restore_snapshot, refresh_snapshot
 
 
 def initialize(supervisor):
     config = supervisor.config
 
     report_interval = config['reporting.interval']
-    # schedule an immediate report sending
-    supervisor.exts.tasks.schedule(send_report, args=(supervisor,))
 
-    # schedule periodic report sending
-    supervisor.exts.tasks.schedule(send_report,
+    config['last_check'] = 0
+    config['status_cache'] = {}
+    # restore the last report and alert state before the first report runs
+    restore_snapshot(supervisor)
+
+    health = None
+    shared = config['reporting.shared']
+    if shared:
+        check_lease_ttl(config)
+    if shared and config['reporting.backend'] == 'incremental':
+        # counts kept in memory would only cover this instance's heartbeats
+        config['reporting.backend'] = 'sql'
+
+    if config['reporting.process']:
+        # reports are computed and alerts sent by a separate process, which
+        # stores them as snapshots that are picked up here
+        worker = ReportWorker(worker_config(config))
+        worker.start()
+        config['report_worker'] = worker
+    else:
+        if config['reporting.backend'] == 'incremental':
+            # the windows are filled from stored data first, and reports are
+            # read from the database until that is done
+            interval = config['reporting.datapoints_interval']
+            health = HealthEngine(interval=interval)
+            config['health_engine'] = health
+            supervisor.exts.tasks.schedule(rebuild_health,
+                                           args=(supervisor,))
+        elif config['reporting.workers']:
+            # reports are computed from the database by worker processes
+            pool = ReportPool(config['reporting.workers'],
+                              database_options(config),
+                              timeout=config['reporting.worker_timeout'])
+            pool.start()
+            config['report_pool'] = pool
+
+        # alerts are queued by report runs and mailed in the background
+        start_alerts(config)
+
+        report = send_report
+        if shared:
+            # only the instance holding the reporting lease reports
+            config['report_lease'] = ReportLease(config['reporting.lease_ttl'])
+            report = run_report
+
+        # schedule an immediate report sending
+        supervisor.exts.tasks.schedule(report, args=(supervisor,))
+
+        # schedule periodic report sending
+        supervisor.exts.tasks.schedule(report,
+                                       args=(supervisor,),
+                                       periodic=True,
+                                       delay=report_interval)
+
+    if shared or config['reporting.process']:
+        # show reports stored by other processes as they come in
+        supervisor.exts.tasks.schedule(refresh_snapshot,
+                                       args=(supervisor,),
+                                       periodic=True,
+                                       delay=config['reporting.poll_interval'])
+
+    # create upcoming stats partitions and drop expired ones now and then
+    maintenance_interval = config['storage.maintenance_interval']
+    supervisor.exts.tasks.schedule(maintain_partitions, args=(supervisor,))
+    supervisor.exts.tasks.schedule(maintain_partitions,
                                    args=(supervisor,),
                                    periodic=True,
-                                   delay=report_interval)
+                                   delay=maintenance_interval)
 
-    config['last_check'] = 0
+    dedup = HeartbeatDedup(cache_size=config['ingest.dedup_cache_size'],
+                           ttl=config['ingest.dedup_ttl'],
+                           resolution=config['ingest.dedup_resolution'],
+                           tolerance=config['ingest.dedup_tolerance'])
+    config['heartbeat_dedup'] = dedup
+
+    dimensions = DimensionKeys()
+    config['dimension_keys'] = dimensions
+
+    if config['ingest.async']:
+        queue = IngestQueue(supervisor.exts.databases['monitoring'], dedup,
+                            dimensions, health,
+                            size=config['ingest.queue_size'],
+                            workers=config['ingest.workers'],
+                            batch_size=config['ingest.batch_size'])
+        queue.start()
+        config['ingest_queue'] = queue
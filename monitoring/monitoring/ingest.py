@@ -0,0 +1,116 @@
+import time
+import logging
+
+import gevent
+from gevent.queue import Queue, Full, Empty
+
+from .heartbeat import process_batch, decode_stream_strict
+
+
+class IngestQueue(object):
+    """ Bounded queue of heartbeat streams drained by worker greenlets
+
+    Streams are decoded as they are queued, so that the client is told about
+    a stream that does not decode and can send it again. Workers store
+    datapoints of as many streams as are waiting (up to ``batch_size``
+    datapoints) in a single batch.
+    """
+
+    def __init__(self, db, dedup, dimensions, health=None, size=1000,
+                 workers=4, batch_size=500):
+        self.db = db
+        self.dedup = dedup
+        self.dimensions = dimensions
+        self.health = health
+        self.queue = Queue(maxsize=size)
+        self.size = size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.greenlets = []
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.invalid = 0
+        self.datapoints = 0
+        self.failed_batches = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        for _ in range(self.workers):
+            self.greenlets.append(gevent.spawn(self.work))
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.greenlets = []
+
+    def put(self, stream):
+        """ Queue heartbeats of stream, return ``False`` if the queue is full
+
+        Raises ``ValueError`` if the stream does not decode.
+        """
+        if self.queue.full():
+            self.rejected += 1
+            return False
+        try:
+            heartbeats = decode_stream_strict(stream)
+        except ValueError:
+            self.invalid += 1
+            raise
+        try:
+            self.queue.put_nowait((time.time(), heartbeats))
+        except Full:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def next_batch(self):
+        """ Block until a stream is available and return datapoints of it and
+        any other queued streams that fit into a batch """
+        datapoints = []
+        item = self.queue.get()
+        while True:
+            queued_at, heartbeats = item
+            self.track_lag(time.time() - queued_at)
+            datapoints.extend(heartbeats)
+            self.processed += 1
+            if len(datapoints) >= self.batch_size:
+                return datapoints
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                return datapoints
+
+    def track_lag(self, lag):
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def work(self):
+        while True:
+            datapoints = self.next_batch()
+            try:
+                stored = process_batch(datapoints, self.db, self.dedup,
+                                       self.dimensions, self.health)
+                self.datapoints += stored
+            except Exception:
+                self.failed_batches += 1
+                logging.exception('Storing batch of %s data points failed',
+                                  len(datapoints))
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'size': self.size,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'invalid': self.invalid,
+            'datapoints': self.datapoints,
+            'failed_batches': self.failed_batches,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
@@ -0,0 +1,116 @@
+"""
+Choice of the server instance that reports, when several share a database
+
+With ``reporting.shared`` enabled, any number of instances can store
+heartbeats into one database, but only the one holding the reporting lease
+computes reports and sends alerts. It renews the lease on every report run,
+and once it has not done so for ``reporting.lease_ttl`` seconds, the next
+instance that tries takes the lease over. The other instances show the
+report snapshots the leader stores.
+
+The lease is a row in ``report_leases`` rather than an advisory lock, so
+that holding it does not depend on keeping one database connection open,
+and an instance that stalls loses it. Lease times come from the database
+clock, so the instances' clocks do not have to agree.
+"""
+
+import os
+import time
+import uuid
+import socket
+import logging
+
+from .reporting import send_report
+from .snapshots import refresh_snapshot
+
+
+ACQUIRE_LEASE = """
+insert into report_leases (name, holder, expires)
+values (%(name)s, %(holder)s, extract(epoch from now()) + %(ttl)s)
+on conflict (name) do update set
+holder = excluded.holder,
+expires = excluded.expires
+where report_leases.holder = excluded.holder
+or report_leases.expires < extract(epoch from now())
+returning holder;
+"""
+
+
+class ReportLease(object):
+    """ Reporting lease of this server instance """
+
+    def __init__(self, ttl, name='reporting'):
+        self.ttl = ttl
+        self.name = name
+        self.holder = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                        uuid.uuid4().hex[:8])
+        self.leader = False
+        self.takeovers = 0
+        self.renewals = 0
+        self.errors = 0
+
+    def acquire(self, db):
+        """ Take or renew the lease, return whether this instance holds it """
+        try:
+            with db.transaction():
+                row = db.fetchone(ACQUIRE_LEASE, {'name': self.name,
+                                                  'holder': self.holder,
+                                                  'ttl': self.ttl})
+        except Exception:
+            self.errors += 1
+            logging.exception('Acquiring the reporting lease failed')
+            row = None
+        leader = row is not None
+        if leader and not self.leader:
+            self.takeovers += 1
+            logging.info('Took over reporting as %s', self.holder)
+        elif leader:
+            self.renewals += 1
+        elif self.leader:
+            logging.warning('Lost reporting lease of %s', self.holder)
+        self.leader = leader
+        return leader
+
+    def stats(self):
+        return {
+            'holder': self.holder,
+            'leader': self.leader,
+            'takeovers': self.takeovers,
+            'renewals': self.renewals,
+            'errors': self.errors,
+        }
+
+
+def check_lease_ttl(config):
+    """ Reject a lease that expires between report runs of its holder, which
+    would let another instance take over while the holder still reports """
+    ttl = config['reporting.lease_ttl']
+    interval = config['reporting.interval']
+    if ttl <= interval:
+        raise ValueError('reporting.lease_ttl ({}) must be greater than '
+                         'reporting.interval ({})'.format(ttl, interval))
+
+
+def run_report(supervisor):
+    """ Run ``send_report`` if this instance holds the reporting lease
+
+    ``send_report`` renews the lease again before it sends alerts and
+    before it stores the snapshot, so that an instance that lost the lease
+    while computing the report leaves both to the new leader.
+    """
+    config = supervisor.config
+    db = supervisor.exts.databases['monitoring']
+    lease = config['report_lease']
+    was_leader = lease.leader
+    if not lease.acquire(db):
+        return
+    if not was_leader:
+        # continue from the state the previous leader stored, and leave it
+        # the rest of its interval
+        refresh_snapshot(supervisor)
+        config['alert_throttle'].restore(config.get('last_state'),
+                                         config.get('last_alerts'))
+        since = time.time() - (config.get('last_check') or 0)
+        if since < config['reporting.interval'] / 2.0:
+            return
+    send_report(supervisor)
@@ -0,0 +1,44 @@
+from ..utils.metrics import Registry, Counter, Gauge, Histogram
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram(
+    'monitoring_heartbeat_request_seconds',
+    'Time spent handling heartbeat requests',
+    labelnames=('endpoint',), registry=REGISTRY)
+
+DECODE_SECONDS = Histogram(
+    'monitoring_stream_decode_seconds',
+    'Time spent decoding heartbeat streams',
+    registry=REGISTRY)
+
+DB_WRITE_SECONDS = Histogram(
+    'monitoring_db_write_seconds',
+    'Time spent writing batches of datapoints to the database',
+    registry=REGISTRY)
+
+REPORT_SECONDS = Histogram(
+    'monitoring_report_seconds',
+    'Time spent in each phase of a report run',
+    labelnames=('phase',), registry=REGISTRY)
+
+ROWS_STORED = Counter(
+    'monitoring_rows_stored_total',
+    'Number of datapoints stored per satellite preset',
+    labelnames=('preset',), registry=REGISTRY)
+
+QUEUE_DEPTH = Gauge(
+    'monitoring_ingest_queue_depth',
+    'Number of heartbeat streams waiting in the ingest queue',
+    registry=REGISTRY)
+
+ALERT_MAILS = Counter(
+    'monitoring_alert_mails_total',
+    'Number of alert mails by outcome of sending them',
+    labelnames=('outcome',), registry=REGISTRY)
+
+ALERTS = Counter(
+    'monitoring_alerts_total',
+    'Number of satellite status changes sent, suppressed and digests sent',
+    labelnames=('outcome',), registry=REGISTRY)
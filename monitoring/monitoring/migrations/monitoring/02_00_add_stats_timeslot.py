@@ -0,0 +1,11 @@
+SQL = """
+alter table stats
+    add column timeslot integer;        -- quantized heartbeat timestamp
+
+-- Existing rows have no timeslot and therefore never conflict
+create unique index stats_client_timeslot_idx on stats (client_id, timeslot);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,10 @@
+SQL = """
+-- Serves the reporting query (recent rows with signal lock) as a range scan
+-- over ``reported`` that only touches locked rows
+create index stats_locked_reported_idx on stats (reported)
+    where signal_lock = true;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
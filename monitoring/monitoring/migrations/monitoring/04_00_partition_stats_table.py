@@ -0,0 +1,48 @@
+import time
+
+from ...partitions import DAY, day_start, ensure_partitions
+
+
+SQL = """
+alter table stats rename to stats_legacy;
+alter index stats_client_timeslot_idx
+    rename to stats_legacy_client_timeslot_idx;
+alter index stats_locked_reported_idx
+    rename to stats_legacy_locked_reported_idx;
+
+create table stats (like stats_legacy) partition by range (reported);
+create index stats_locked_reported_idx on stats (reported)
+    where signal_lock = true;
+
+-- Catches rows for which no partition was created in time
+create table stats_default partition of stats default;
+create unique index stats_default_client_timeslot_idx
+    on stats_default (client_id, timeslot);
+"""
+
+# Partitions as of this migration, later ones index other columns
+CREATE_PARTITION = """
+create table {name} partition of stats for values from ({start}) to ({end});
+create unique index {name}_client_timeslot_idx on {name} (client_id, timeslot);
+"""
+
+# Existing rows stay where they are, as the partition for everything up to
+# the end of the day the migration runs on
+ATTACH_LEGACY_SQL = """
+alter table stats attach partition stats_legacy
+    for values from (minvalue) to ({end});
+"""
+
+DROP_LEGACY_SQL = """
+drop table stats_legacy;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
+    if db.fetchone('select 1 from stats_legacy limit 1;'):
+        end = day_start(time.time()) + DAY
+        db.executescript(ATTACH_LEGACY_SQL.format(end=end))
+    else:
+        db.executescript(DROP_LEGACY_SQL)
+    ensure_partitions(db, 1, template=CREATE_PARTITION)
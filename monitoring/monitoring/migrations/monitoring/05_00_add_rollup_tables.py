@@ -0,0 +1,38 @@
+SQL = """
+create table client_rollups
+(
+    granularity integer,                -- bucket size in seconds
+    bucket integer,                     -- bucket start timestamp
+    client_id varchar,                  -- client ID
+    tuner_preset integer,               -- last seen tuner preset id
+    datapoints integer,                 -- number of datapoints
+    signal_locks integer,               -- datapoints with signal lock
+    service_locks integer,              -- datapoints with service lock
+    service_oks integer,                -- datapoints with service ok
+    carousels_active integer,           -- datapoints with active carousels
+    bitrate_sum bigint,                 -- sum of bitrates
+    bitrate_min integer,                -- minimum bitrate
+    bitrate_max integer,                -- maximum bitrate
+    primary key (granularity, client_id, bucket)
+);
+
+create table preset_rollups
+(
+    granularity integer,                -- bucket size in seconds
+    bucket integer,                     -- bucket start timestamp
+    tuner_preset integer,               -- tuner preset id
+    datapoints integer,                 -- number of datapoints
+    signal_locks integer,               -- datapoints with signal lock
+    service_locks integer,              -- datapoints with service lock
+    service_oks integer,                -- datapoints with service ok
+    carousels_active integer,           -- datapoints with active carousels
+    bitrate_sum bigint,                 -- sum of bitrates
+    bitrate_min integer,                -- minimum bitrate
+    bitrate_max integer,                -- maximum bitrate
+    primary key (granularity, tuner_preset, bucket)
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
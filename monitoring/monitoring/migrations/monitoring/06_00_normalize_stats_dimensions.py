@@ -0,0 +1,83 @@
+from ...partitions import PARTITIONS_QUERY
+
+
+SQL = """
+create table clients
+(
+    id serial primary key,              -- surrogate key
+    uuid varchar not null unique        -- client ID
+);
+
+create table tuners
+(
+    id serial primary key,              -- surrogate key
+    vendor varchar not null,            -- tuner vendor id
+    model varchar not null,             -- tuner model id
+    unique (vendor, model)
+);
+
+-- Rows without a client ID cannot be attributed to any client, and would
+-- be left without a client key
+delete from stats where client_id is null or client_id = '';
+delete from client_rollups where client_id = '';
+
+-- Rollups outlive the stats partitions that are dropped after the retention
+-- period, so they may refer to clients no longer in stats
+insert into clients (uuid)
+    select client_id from stats
+    union
+    select client_id from client_rollups;
+insert into tuners (vendor, model)
+    select distinct coalesce(tuner_vendor, ''), coalesce(tuner_model, '')
+    from stats;
+
+alter table stats
+    add column client_key integer,      -- clients.id
+    add column tuner_key integer,       -- tuners.id
+    add column carousels_mask integer;  -- bit i is status of carousel i
+
+update stats set
+    client_key = c.id,
+    tuner_key = t.id,
+    carousels_mask = (
+        select coalesce(sum(1 << (i - 1)::integer), 0)
+        from unnest(stats.carousels_status) with ordinality as u(status, i)
+        where status
+    )
+from clients c, tuners t
+where c.uuid = stats.client_id
+and t.vendor = coalesce(stats.tuner_vendor, '')
+and t.model = coalesce(stats.tuner_model, '');
+
+alter table client_rollups
+    add column client_key integer;      -- clients.id
+
+update client_rollups set client_key = c.id
+from clients c
+where c.uuid = client_rollups.client_id;
+
+alter table client_rollups
+    drop constraint client_rollups_pkey,
+    drop column client_id,
+    alter column client_key set not null,
+    add primary key (granularity, client_key, bucket);
+
+-- Also drops the (client_id, timeslot) indexes of all partitions
+alter table stats
+    drop column client_id,
+    drop column tuner_vendor,
+    drop column tuner_model,
+    drop column carousels_status,
+    alter column client_key set not null,
+    alter column tuner_key set not null;
+"""
+
+CREATE_INDEX = """
+create unique index {name}_client_timeslot_idx on {name} (client_key, timeslot);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
+    for row in db.fetchall(PARTITIONS_QUERY):
+        db.executescript(CREATE_INDEX.format(name=row['name']))
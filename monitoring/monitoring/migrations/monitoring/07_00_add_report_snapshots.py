@@ -0,0 +1,12 @@
+SQL = """
+create table report_snapshots
+(
+    created double precision primary key,   -- report time
+    report json,                            -- satellite status by name
+    state json                              -- alert status by tuner preset
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,14 @@
+SQL = """
+create table report_leases
+(
+    name varchar primary key,               -- leased task
+    holder varchar not null,                -- server instance holding it
+    expires double precision not null       -- end of the lease
+);
+
+alter table report_snapshots add column alerts json;    -- throttle state
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,148 @@
+import re
+import time
+import logging
+
+
+DAY = 24 * 60 * 60
+
+PARTITIONS_QUERY = """
+select c.relname as name, pg_get_expr(c.relpartbound, c.oid) as bound
+from pg_inherits i
+join pg_class c on c.oid = i.inhrelid
+join pg_class p on p.oid = i.inhparent
+where p.relname = 'stats';
+"""
+
+CREATE_PARTITION = """
+create table {name} partition of stats for values from ({start}) to ({end});
+create unique index {name}_client_timeslot_idx
+    on {name} (client_key, timeslot);
+"""
+
+DROP_PARTITION = """
+drop table {name};
+"""
+
+# Rows stored while no partition covered their day end up in the default
+# partition, and a partition cannot be created for a range that rows in the
+# default partition fall into
+COUNT_DEFAULT_ROWS = """
+select count(*) as count from stats_default
+where reported >= %(start)s and reported < %(end)s;
+"""
+
+MOVE_OUT_OF_DEFAULT = """
+create temporary table stats_moved (like stats) on commit drop;
+with moved as (
+    delete from stats_default
+    where reported >= {start} and reported < {end}
+    returning *
+)
+insert into stats_moved select * from moved;
+"""
+
+MOVE_INTO_PARTITION = """
+insert into stats select * from stats_moved;
+"""
+
+UPPER_BOUND_RE = re.compile(r'TO \((-?\d+)\)')
+
+
+def day_start(timestamp):
+    """ Return start of the UTC day the timestamp falls on """
+    return int(timestamp // DAY * DAY)
+
+
+def partition_name(start):
+    return 'stats_{}'.format(time.strftime('%Y%m%d', time.gmtime(start)))
+
+
+def get_partitions(db):
+    """ Return (name, upper bound) pairs of range partitions of stats """
+    partitions = []
+    for row in db.fetchall(PARTITIONS_QUERY):
+        match = UPPER_BOUND_RE.search(row['bound'])
+        if match:
+            partitions.append((row['name'], int(match.group(1))))
+    return partitions
+
+
+def create_partitions(db, start, end, template=CREATE_PARTITION):
+    """ Create daily partitions covering days from start until end
+
+    Rows of a day that are in the default partition are moved into the
+    partition created for it.
+    """
+    created = []
+    start = day_start(start)
+    while start < end:
+        name = partition_name(start)
+        bounds = {'start': start, 'end': start + DAY}
+        script = template.format(name=name, **bounds)
+        rows = db.fetchone(COUNT_DEFAULT_ROWS, bounds)['count']
+        if rows:
+            move_into_partition(db, name, bounds, script, rows)
+        else:
+            db.executescript(script)
+        created.append(name)
+        start += DAY
+    return created
+
+
+def move_into_partition(db, name, bounds, script, rows):
+    """ Create partition with ``script`` and move the rows of its range out
+    of the default partition into it, all in one transaction """
+    logging.info('Moving %s rows from stats_default into new partition %s',
+                 rows, name)
+    try:
+        with db.transaction():
+            db.executescript(MOVE_OUT_OF_DEFAULT.format(**bounds))
+            db.executescript(script)
+            db.executescript(MOVE_INTO_PARTITION)
+    except Exception:
+        logging.error('Could not create stats partition %s: moving its %s '
+                      'rows out of stats_default failed, so heartbeats of '
+                      'that day keep going into stats_default', name, rows)
+        raise
+
+
+def ensure_partitions(db, days_ahead, now=None, template=CREATE_PARTITION):
+    """ Create partitions from the end of the last one until ``days_ahead``
+    days from now
+
+    Migrations pass the ``template`` matching the schema at their point.
+    """
+    now = now or time.time()
+    today = day_start(now)
+    upper_bounds = [upper for _, upper in get_partitions(db)]
+    start = max(upper_bounds + [today])
+    return create_partitions(db, start, today + (days_ahead + 1) * DAY,
+                             template)
+
+
+def drop_old_partitions(db, retention_days, now=None):
+    """ Drop partitions that only hold rows older than ``retention_days`` """
+    if not retention_days:
+        return []
+    cutoff = (now or time.time()) - retention_days * DAY
+    dropped = []
+    for name, upper in get_partitions(db):
+        if upper <= cutoff:
+            db.executescript(DROP_PARTITION.format(name=name))
+            dropped.append(name)
+    return dropped
+
+
+def maintain_partitions(supervisor):
+    config = supervisor.config
+    db = supervisor.exts.databases['monitoring']
+    try:
+        created = ensure_partitions(db, config['storage.partitions_ahead'])
+        dropped = drop_old_partitions(db, config['storage.retention_days'])
+    except Exception:
+        logging.exception('Stats partition maintenance failed')
+        return
+    if created:
+        logging.info('Created stats partitions: %s', ', '.join(created))
+    if dropped:
+        logging.info('Dropped stats partitions: %s', ', '.join(dropped))
@@ -2,10 +2,17 @@ from __future__ import division
 
 import time
 import logging
+import operator
 import itertools
 
-from ..utils.smtpclient import SMTPClient
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..core.satdata import get_sat_name, get_preset_ids
+from .metrics import REPORT_SECONDS
+from .snapshots import save_snapshot
 
 
 # Default interval for which datapoints are used
@@ -17,6 +24,9 @@ NOTIFICATION_INTERVAL = 2 * 60 * 60
 # Interval for which faulty signal from client is considered ok
 SIGNAL_OK_INTERVAL = 20 * 60
 
+# Some checks only look at datapoints with timestamps within this interval
+RECENT_INTERVAL = 10 * 60
+
 # Statuses used for email alerts and dashboard
 STATUS_NORMAL = 'NORMAL'
 STATUS_WARNING = 'WARNING'
@@ -62,16 +72,91 @@ class LowBitrate(ClientError):
     severity = ClientError.WARNING
 
 
-def get_sat_reports(db, interval=DATAPOINTS_INTERVAL):
-    """ Select all records added since last check """
+# Rows are grouped by client key, and the client ID is only joined in for
+# alert messages
+SAT_REPORTS_TEMPLATE = """
+select s.*, c.uuid as client_id from stats s
+join clients c on c.id = s.client_key
+where s.reported >= %(reported)s and s.signal_lock = true{presets}
+order by s.tuner_preset, s.client_key, s.timestamp;
+"""
+
+# Conditions restricting queries to some presets, or to all but some presets
+PRESETS_FILTERS = {
+    False: ' and s.tuner_preset = any(%(presets)s)',
+    True: ' and s.tuner_preset <> all(%(presets)s)',
+}
+
+SAT_REPORTS_QUERY = SAT_REPORTS_TEMPLATE.format(presets='')
+
+
+def presets_query(template, presets, exclude):
+    if presets is None:
+        return template.format(presets='')
+    return template.format(presets=PRESETS_FILTERS[exclude])
+
+
+def get_sat_reports(db, interval=DATAPOINTS_INTERVAL, presets=None,
+                    exclude=False):
+    """ Select all records added since last check
+
+    When ``presets`` are given, only records of those presets are selected,
+    or only records of other presets if ``exclude`` is set.
+    """
     time_bracket = time.time() - interval
     # Note that we are deliberately NOT taking into account any records that do
     # not have a lock. This is intentional. If there is no lock, we can't
     # really assume anything about the signal, so it does not make sense to
     # claim unlocked signal is bad.
-    qry = db.Select('*', 'stats', where=['reported >= %(reported)s', 'signal_lock = True'],
-                    order=['tuner_preset', 'client_id', 'timestamp'])
-    return db.fetchall(qry, {'reported': time_bracket})
+    # The bracket is passed as an integer like the ``reported`` column, so
+    # that the comparison can use the index and prune stats partitions.
+    qry = presets_query(SAT_REPORTS_TEMPLATE, presets, exclude)
+    return db.fetchall(qry, {'reported': int(time_bracket),
+                             'presets': presets})
+
+
+# Counts of the datapoints of each client that ``client_report_from_counts()``
+# needs, for the same rows that ``get_sat_reports()`` selects
+CLIENT_COUNTS_TEMPLATE = """
+select
+    s.tuner_preset,
+    c.uuid as client_id,
+    count(*) as datapoints,
+    count(*) filter (where not (s.bitrate > 0 and s.carousels_count > 0
+                                and s.carousels_mask <> 0)) as failures,
+    count(*) filter (where s.bitrate = 0) as zero_bitrate,
+    count(*) filter (where not s.service_ok) as errors,
+    coalesce(sum(s.bitrate), 0) as bitrate,
+    count(*) filter (where s.timestamp >= %(recent)s) as recent,
+    count(*) filter (where s.timestamp >= %(recent)s and s.bitrate > 0
+                     and (s.carousels_count = 0 or s.carousels_mask = 0))
+        as no_carousels,
+    count(*) filter (where s.timestamp >= %(recent)s and not s.service_lock)
+        as no_service_lock
+from stats s
+join clients c on c.id = s.client_key
+where s.reported >= %(reported)s and s.signal_lock = true{presets}
+group by s.tuner_preset, s.client_key, c.uuid
+order by s.tuner_preset, s.client_key;
+"""
+
+CLIENT_COUNTS_QUERY = CLIENT_COUNTS_TEMPLATE.format(presets='')
+
+
+def get_client_counts(db, interval=DATAPOINTS_INTERVAL, presets=None,
+                      exclude=False):
+    """ Return (tuner preset, [(client ID, counts), ...]) pairs computed by
+    the database from the datapoints added since last check, optionally
+    restricted to ``presets`` like in ``get_sat_reports()`` """
+    now = time.time()
+    qry = presets_query(CLIENT_COUNTS_TEMPLATE, presets, exclude)
+    rows = db.fetchall(qry, {
+        'reported': int(now - interval),
+        'recent': now - RECENT_INTERVAL,
+        'presets': presets,
+    })
+    return [(tuner_preset, [(row['client_id'], row) for row in clients])
+            for tuner_preset, clients in by_sat(rows)]
 
 
 def by_sat(results):
@@ -79,7 +164,7 @@ def by_sat(results):
 
 
 def by_client(results):
-    return itertools.groupby(results, lambda r: r['client_id'])
+    return itertools.groupby(results, lambda r: r['client_key'])
 
 
 def check_ok(datapoints):
@@ -96,7 +181,7 @@ def check_ok(datapoints):
     for d in datapoints:
         datapoints_count += 1
         ok = d['bitrate'] > 0
-        ok = ok and d['carousels_count'] > 0 and any(d['carousels_status'])
+        ok = ok and d['carousels_count'] > 0 and d['carousels_mask']
         if ok:
             continue
         failures_count += 1
@@ -125,9 +210,9 @@ def check_no_carousels(datapoints):
     for d in datapoints:
         datapoints_count += 1
         carousels_count = d['carousels_count']
-        carousels_status = d['carousels_status']
+        carousels_mask = d['carousels_mask']
         bitrate = d['bitrate']
-        if bitrate > 0 and (carousels_count == 0 or not any(carousels_status)):
+        if bitrate > 0 and (carousels_count == 0 or not carousels_mask):
             failures_count += 1
     failure_rate = failures_count / (datapoints_count or 1)
     valid = (failure_rate > 0.8) if datapoints_count else False
@@ -254,6 +339,178 @@ def client_report(results):
     return health, error_rate, avg_bitrate, status
 
 
+def counts_ok(counts):
+    """ Same as ``check_ok()`` over the client's datapoint counts """
+    failure_rate = counts['failures'] / (counts['datapoints'] or 1)
+    valid = (failure_rate <= 0.2) if counts['datapoints'] else False
+    return failure_rate, valid
+
+
+def counts_no_carousels(counts):
+    """ Same as ``check_no_carousels()`` over the client's datapoint counts """
+    failure_rate = counts['no_carousels'] / (counts['recent'] or 1)
+    valid = (failure_rate > 0.8) if counts['recent'] else False
+    return failure_rate, valid
+
+
+def counts_bad_bitrate(counts):
+    """ Same as ``check_bad_bitrate()`` over the client's datapoint counts """
+    failure_rate = counts['zero_bitrate'] / (counts['datapoints'] or 1)
+    valid = (failure_rate > 0.8) if counts['datapoints'] else False
+    return failure_rate, valid
+
+
+def counts_no_service_lock(counts):
+    """ Same as ``check_no_service_lock()`` over the client's datapoint counts
+    """
+    failure_rate = counts['no_service_lock'] / (counts['recent'] or 1)
+    valid = (failure_rate >= 0.5) if counts['recent'] else False
+    return failure_rate, valid
+
+
+counts_transition_map = {
+    HEALTH_OK: (counts_ok, HEALTH_NO_CAROUSELS),
+    HEALTH_NO_CAROUSELS: (counts_no_carousels, HEALTH_BAD_BITRATE),
+    HEALTH_BAD_BITRATE: (counts_bad_bitrate, HEALTH_NO_SERVICE_LOCK),
+    HEALTH_NO_SERVICE_LOCK: (counts_no_service_lock, HEALTH_UNKNOWN),
+}
+
+
+# Names of the counts ``client_report_from_counts()`` uses
+COUNT_NAMES = ('datapoints', 'failures', 'zero_bitrate', 'errors', 'bitrate',
+               'recent', 'no_carousels', 'no_service_lock')
+
+
+def client_report_from_counts(counts):
+    """ Return client report like ``client_report()`` does, from counts of
+    the client's datapoints instead of the datapoints themselves
+
+    Counts over all datapoints are ``datapoints``, ``failures`` (no bitrate
+    or no active carousels), ``zero_bitrate``, ``errors`` (service not ok)
+    and ``bitrate`` (sum). Counts over datapoints with timestamps within
+    ``RECENT_INTERVAL`` are ``recent``, ``no_carousels`` (bitrate but no
+    active carousels) and ``no_service_lock``.
+    """
+    error_rate, health = (0.0, HEALTH_OK)
+
+    while health != HEALTH_UNKNOWN:
+        transition_fn, next_state = counts_transition_map[health]
+        error_rate, valid_state = transition_fn(counts)
+        if not valid_state:
+            health = next_state
+        else:
+            break
+
+    datapoints_count = counts['datapoints']
+    avg_bitrate = counts['bitrate'] / (datapoints_count or 1)
+    if health == HEALTH_OK:
+        status = True
+    elif health == HEALTH_UNKNOWN:
+        error_rate = counts['errors'] / (datapoints_count or 1)
+        status = (error_rate < 0.5)
+    else:
+        status = False
+    return health, error_rate, avg_bitrate, status
+
+
+def client_reports_from_rows(results):
+    """ Return (tuner preset, [(client ID, client report), ...]) pairs from
+    ``stats`` rows ordered by preset and client """
+    for tuner_preset, sat_reports in by_sat(results):
+        clients = []
+        for _, client_reports in by_client(sat_reports):
+            client_reports = list(client_reports)
+            clients.append((client_reports[0]['client_id'],
+                            client_report(client_reports)))
+        yield tuner_preset, clients
+
+
+def client_reports_from_counts(sat_counts):
+    """ Return (tuner preset, [(client ID, client report), ...]) pairs from
+    (tuner preset, [(client ID, counts), ...]) pairs """
+    for tuner_preset, clients in sat_counts:
+        yield tuner_preset, [(client_id, client_report_from_counts(counts))
+                             for client_id, counts in clients]
+
+
+# Fields of ``stats`` rows read by ``client_counts_vectorized()``
+VECTORIZED_FIELDS = ('tuner_preset', 'client_key', 'bitrate',
+                     'carousels_count', 'carousels_mask', 'service_ok',
+                     'service_lock', 'timestamp')
+
+
+def client_counts_vectorized(results, now=None):
+    """ Return (tuner preset, [(client ID, counts), ...]) pairs from
+    ``stats`` rows ordered by preset and client
+
+    Rows are converted into arrays once, and the counts of all clients are
+    computed in a single pass over them against a single reference time,
+    with the same conditions as the ``check_*()`` functions. Per-client
+    arrays would be too small for NumPy to pay off, so clients are told
+    apart by the positions at which the preset or client changes.
+
+    Requires NumPy.
+    """
+    results = list(results)
+    if not results:
+        return []
+    now = now or time.time()
+
+    # All fields of all rows are read in one pass into an integer table
+    fields = operator.itemgetter(*VECTORIZED_FIELDS)
+    table = numpy.fromiter(
+        itertools.chain.from_iterable(itertools.imap(fields, results)),
+        dtype=numpy.int64, count=len(results) * len(VECTORIZED_FIELDS))
+    (presets, client_keys, bitrate, carousels_count, carousels_mask,
+     service_ok, service_lock, timestamp) = table.reshape(
+         len(results), len(VECTORIZED_FIELDS)).T
+
+    has_bitrate = bitrate > 0
+    carousels = (carousels_count > 0) & (carousels_mask != 0)
+    recent = timestamp >= now - RECENT_INTERVAL
+    values = numpy.vstack([
+        numpy.ones(len(results), dtype=numpy.int64),
+        ~(has_bitrate & carousels),
+        bitrate == 0,
+        service_ok == 0,
+        bitrate,
+        recent,
+        recent & has_bitrate & ~carousels,
+        recent & (service_lock == 0),
+    ]).astype(numpy.int64)
+
+    changed = ((presets[1:] != presets[:-1]) |
+               (client_keys[1:] != client_keys[:-1]))
+    starts = numpy.concatenate(([0], numpy.flatnonzero(changed) + 1))
+    totals = numpy.add.reduceat(values, starts, axis=1).T.tolist()
+
+    by_preset = []
+    for start, counts in zip(starts.tolist(), totals):
+        tuner_preset = results[start]['tuner_preset']
+        if not by_preset or by_preset[-1][0] != tuner_preset:
+            by_preset.append((tuner_preset, []))
+        by_preset[-1][1].append((results[start]['client_id'],
+                                 dict(zip(COUNT_NAMES, counts))))
+    return by_preset
+
+
+def get_client_reports(db, backend, interval=DATAPOINTS_INTERVAL,
+                       presets=None, exclude=False):
+    """ Return (tuner preset, [(client ID, client report), ...]) pairs
+    computed from the database with the "sql" or "query" backend
+
+    ``presets`` and ``exclude`` restrict the presets like in
+    ``get_sat_reports()``.
+    """
+    if backend == 'sql':
+        counts = get_client_counts(db, interval, presets, exclude)
+        return client_reports_from_counts(counts)
+    reports = get_sat_reports(db, interval, presets, exclude)
+    if numpy is not None:
+        return client_reports_from_counts(client_counts_vectorized(reports))
+    return client_reports_from_rows(reports)
+
+
 def error_block(title, errors):
     msg = ''
     msg += '{}:\n\n'.format(title)
@@ -282,6 +539,18 @@ def construct_message(sat_status):
     return msg
 
 
+def construct_digest(digest):
+    msg = ''
+    for preset, status, changes in digest:
+        msg += '{}: {}\n\n'.format(get_sat_name(preset), status)
+        for changed, old, new in changes:
+            msg += '{}  {} -> {}\n'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(changed)),
+                old, new)
+        msg += '\n'
+    return msg
+
+
 def get_state(sat_status):
     if sat_status:
         error_rate = sat_status['error_rate']
@@ -295,37 +564,41 @@ def get_state(sat_status):
 
 
 def get_changed_states(sat_errors, config):
-    default = dict((p, STATUS_NORMAL) for p in get_preset_ids())
-    old_state = config.get('last_state', default)
+    """ Return sat_id:errors pairs of satellites whose status changed and
+    should be alerted about now
+
+    Which changes are alerted about, and when, is decided by the alert
+    throttle (see ``throttle.AlertThrottle``).
+    """
+    throttle = config['alert_throttle']
     # prepare current state of sat_id:status pairs
     state = dict((p, get_state(sat_errors.get(p, None)))
                  for p in get_preset_ids())
-    # find difference between current and previous state
-    changes = dict(set(old_state.items()).difference(state.items()))
-    config['last_state'] = state
+    changes = throttle.update(state)
+    config['last_state'] = dict(throttle.states)
     # return changed sat_id:errors pairs (empty error list if it works again)
     changed_states = dict((key, sat_errors.get(key, {})) for key in changes)
-    for preset in changes:
-        changed_states[preset]['alert_status'] = state.get(preset, STATUS_NORMAL)
+    for preset, status in changes.items():
+        changed_states[preset]['alert_status'] = status
     return changed_states
 
 
 def send_reports(sat_errors, config):
-    smtp_host = config['email.host']
-    smtp_port = config['email.port']
-    smtp_ssl = config['email.secure']
-    smtp_user = config['email.username']
-    smtp_pass = config['email.password']
+    queue = config['alert_queue']
     recipients = config['reporting.recipients']
-    c = SMTPClient(smtp_host, smtp_port, smtp_ssl, smtp_user, smtp_pass)
     for preset, sat_status in sat_errors.items():
         sat_name = get_sat_name(preset)
         subject = '[OUTERNET MONITOR ALERT] {}'.format(sat_name)
         message = construct_message(sat_status)
-        try:
-            c.send(recipients, subject, message)
-        except Exception:
-            logging.exception("Mail report sending failed.")
+        queue.put(recipients, subject, message)
+
+
+def send_digest(digest, config):
+    queue = config['alert_queue']
+    recipients = config['reporting.recipients']
+    changes = sum(len(changes) for _, _, changes in digest)
+    subject = '[OUTERNET MONITOR DIGEST] {} status changes'.format(changes)
+    queue.put(recipients, subject, construct_digest(digest))
 
 
 def aggregate_status(sat_status, sat_states):
@@ -342,6 +615,17 @@ def aggregate_status(sat_status, sat_states):
     return aggregate
 
 
+def holds_lease(config, db):
+    """ Return whether this instance may still send alerts and store the
+    report, i.e. it does not share reporting or holds the reporting lease """
+    lease = config.get('report_lease')
+    if lease is None or lease.acquire(db):
+        return True
+    logging.warning('Lost the reporting lease during a report run, '
+                    'discarding the report')
+    return False
+
+
 def send_report(supervisor):
     app = supervisor.app
     config = app.config
@@ -349,25 +633,39 @@ def send_report(supervisor):
     datapoints_interval = config['reporting.datapoints_interval']
 
     db = supervisor.exts.databases['monitoring']
-    reports = get_sat_reports(db, datapoints_interval)
-
-    reports_by_sat = by_sat(reports)
+    engine = config.get('health_engine')
+    pool = config.get('report_pool')
+    backend = config['reporting.backend']
+    start = time.time()
+    if engine is not None and engine.ready:
+        sat_clients = client_reports_from_counts(engine.reports())
+    elif pool is not None:
+        try:
+            sat_clients = pool.client_reports(backend, datapoints_interval,
+                                              get_preset_ids())
+        except Exception:
+            logging.exception('Report workers failed, reporting in process')
+            sat_clients = get_client_reports(db, backend,
+                                              datapoints_interval)
+    else:
+        sat_clients = get_client_reports(db, backend, datapoints_interval)
+    query_done = time.time()
+    REPORT_SECONDS.observe(query_done - start, phase='query')
 
     sat_errors = {}
     sat_status = {}
 
-    for tuner_preset, sat_reports in reports_by_sat:
+    for tuner_preset, client_reports in sat_clients:
 
         clients = 0
         total_bitrate = 0
 
         errors = []
 
-        reports_by_client = by_client(sat_reports)
         receiving_clients = 0
-        for client_id, client_reports in reports_by_client:
+        for client_id, report in client_reports:
             clients += 1
-            health, errate, avg_bitrate, status = client_report(client_reports)
+            health, errate, avg_bitrate, status = report
             if avg_bitrate > 0.0:
                 total_bitrate += avg_bitrate
                 receiving_clients += 1
@@ -389,8 +687,25 @@ def send_report(supervisor):
             sat_errors[tuner_preset] = sat_status[sat_name]
 
     changes = get_changed_states(sat_errors, config)
+    aggregation_done = time.time()
+    REPORT_SECONDS.observe(aggregation_done - query_done, phase='aggregation')
+    if not holds_lease(config, db):
+        return
     if changes:
         send_reports(changes, config)
+    digest = config['alert_throttle'].digest()
+    if digest:
+        send_digest(digest, config)
+    REPORT_SECONDS.observe(time.time() - aggregation_done, phase='email')
 
     config['last_report'] = aggregate_status(sat_status, config['last_state'])
     config['last_check'] = time.time()
+    if not holds_lease(config, db):
+        return
+    try:
+        save_snapshot(db, config['last_check'], config['last_report'],
+                      config['last_state'], config['storage.retention_days'],
+                      config['alert_throttle'].dump())
+    except Exception:
+        logging.exception('Storing report snapshot failed')
+    REPORT_SECONDS.observe(config['last_check'] - start, phase='total')
@@ -0,0 +1,215 @@
+"""
+Pool of worker processes that compute client reports per satellite
+
+Each worker is a separate Python process with a database connection of its
+own. The server sends it one preset at a time, and the worker fetches and
+evaluates that preset's clients. Tasks and results are exchanged as lines of
+JSON over the worker's stdin and stdout. The server only waits on the pipes
+cooperatively, so heartbeats keep being served while a report is computed.
+A worker that exits or does not answer within the timeout is replaced, and
+the task fails, so that the report falls back to computing in process.
+
+Workers connect with psycopg2, which the PostgreSQL database backend
+already depends on.
+"""
+
+import sys
+import json
+import logging
+import contextlib
+
+import gevent
+from gevent import subprocess
+from gevent.queue import Queue
+
+from .reporting import get_client_reports
+
+
+def database_options(config, name='monitoring'):
+    """ Return psycopg2 connection options for the app's database """
+    return {
+        'host': config['database.host'],
+        'port': config['database.port'],
+        'user': config['database.user'],
+        'password': config['database.password'],
+        'dbname': name,
+    }
+
+
+class ReportPool(object):
+    """ Fixed number of report worker processes """
+
+    def __init__(self, size, database, timeout=None):
+        self.size = size
+        self.database = database
+        # Seconds to wait for the result of a task (``None`` for no limit)
+        self.timeout = timeout
+        self.idle = Queue()
+        self.tasks = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def start(self):
+        for _ in range(self.size):
+            self.idle.put(self.spawn())
+
+    def stop(self):
+        while not self.idle.empty():
+            worker = self.idle.get()
+            worker.stdin.close()
+            worker.wait()
+
+    def spawn(self):
+        worker = subprocess.Popen([sys.executable, '-m', __name__],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+        # Connection options are not passed as arguments, so that the
+        # password does not show up in process listings
+        self.send(worker, {'database': self.database})
+        return worker
+
+    def send(self, worker, message):
+        worker.stdin.write(json.dumps(message) + '\n')
+        worker.stdin.flush()
+
+    def call(self, task):
+        """ Run task on the next idle worker and return its result """
+        worker = self.idle.get()
+        timeout = gevent.Timeout(self.timeout)
+        timeout.start()
+        timed_out = False
+        try:
+            self.send(worker, task)
+            line = worker.stdout.readline()
+        except gevent.Timeout as exc:
+            if exc is not timeout:
+                raise
+            timed_out = True
+            line = ''
+        except Exception:
+            line = ''
+        finally:
+            timeout.cancel()
+        if not line:
+            # The worker is gone or stuck, replace it before reporting
+            # failure
+            self.failures += 1
+            if worker.poll() is None:
+                worker.kill()
+            status = worker.wait()
+            self.idle.put(self.spawn())
+            if timed_out:
+                self.timeouts += 1
+                raise RuntimeError('Report worker did not answer within {} '
+                                   'seconds'.format(self.timeout))
+            raise RuntimeError('Report worker exited with status {}'.format(
+                status))
+        self.idle.put(worker)
+        self.tasks += 1
+        result = json.loads(line)
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+        return result['reports']
+
+    def client_reports(self, backend, interval, presets):
+        """ Return (tuner preset, [(client ID, client report), ...]) pairs
+        ordered by preset, with one task per preset in ``presets`` and one
+        for all other presets """
+        tasks = [{'presets': [preset], 'exclude': False}
+                 for preset in presets]
+        tasks.append({'presets': list(presets), 'exclude': True})
+        for task in tasks:
+            task.update(backend=backend, interval=interval)
+        jobs = [gevent.spawn(self.call, task) for task in tasks]
+        gevent.joinall(jobs, raise_error=True)
+        sat_clients = []
+        for job in jobs:
+            for tuner_preset, clients in job.value:
+                sat_clients.append((tuner_preset, [
+                    (client_id, tuple(report)) for client_id, report in clients
+                ]))
+        sat_clients.sort(key=lambda pair: pair[0])
+        return sat_clients
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'idle': self.idle.qsize(),
+            'tasks': self.tasks,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+        }
+
+
+class WorkerDB(object):
+    """ Provides the part of the database API that reporting queries and
+    report snapshots use """
+
+    def __init__(self, options):
+        import psycopg2
+        import psycopg2.extras
+        self.conn = psycopg2.connect(**options)
+        self.conn.autocommit = True
+        self.cursor_factory = psycopg2.extras.RealDictCursor
+
+    def fetchall(self, sql, params=None):
+        cursor = self.conn.cursor(cursor_factory=self.cursor_factory)
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def fetchone(self, sql, params=None):
+        cursor = self.conn.cursor(cursor_factory=self.cursor_factory)
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def execute(self, sql, params=None):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.autocommit = False
+        try:
+            yield
+        except Exception:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self.conn.autocommit = True
+
+
+def evaluate(db, task):
+    reports = get_client_reports(db, task['backend'], task['interval'],
+                                 task['presets'], task['exclude'])
+    return [(tuner_preset, clients) for tuner_preset, clients in reports]
+
+
+def main():
+    options = json.loads(sys.stdin.readline())
+    db = WorkerDB(options['database'])
+    for line in iter(sys.stdin.readline, ''):
+        task = json.loads(line)
+        try:
+            result = {'reports': evaluate(db, task)}
+        except Exception as exc:
+            logging.exception('Computing client reports failed')
+            result = {'error': str(exc)}
+            if db.conn.closed:
+                db = WorkerDB(options['database'])
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
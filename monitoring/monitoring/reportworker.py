@@ -0,0 +1,199 @@
+"""
+Reporting in a process separate from the one serving heartbeats
+
+With ``reporting.process`` enabled, the server does not compute reports
+itself. It runs a single report worker process instead, which computes a
+report every ``reporting.interval`` seconds with a database connection of
+its own, sends the alerts, and stores the result as a report snapshot. The
+server loads new snapshots for the status pages every
+``reporting.poll_interval`` seconds, so all that is left of reporting in
+the process that serves heartbeats is reading a row now and then.
+
+The "incremental" backend keeps counts of the datapoints the server stores,
+which the worker does not see, so the worker uses the "sql" backend instead.
+With ``reporting.shared`` enabled, the worker reports only while it holds
+the reporting lease (see ``leader``).
+
+Report timings and alert counters are recorded in the worker. It writes
+their values to its stdout every ``reporting.poll_interval`` seconds, and
+the server shows them in its own metrics, added to those of the workers
+that ran before it.
+"""
+
+import sys
+import json
+import time
+import logging
+
+import gevent
+from gevent import subprocess
+
+from .alerts import start_alerts
+from .leader import ReportLease, run_report
+from .metrics import REPORT_SECONDS, ALERTS, ALERT_MAILS
+from .reportpool import ReportPool, WorkerDB, database_options
+from .reporting import send_report
+from .snapshots import restore_snapshot
+
+
+# Prefixes of the config keys the worker gets from the server
+CONFIG_PREFIXES = ('reporting.', 'email.', 'storage.')
+
+# Metrics recorded by the worker instead of the server
+WORKER_METRICS = (REPORT_SECONDS, ALERTS, ALERT_MAILS)
+
+
+def worker_config(config):
+    """ Return options for the report worker from the app config """
+    options = dict((key, value) for key, value in config.items()
+                   if key.startswith(CONFIG_PREFIXES))
+    if options['reporting.backend'] == 'incremental':
+        options['reporting.backend'] = 'sql'
+    return {'config': options, 'database': database_options(config)}
+
+
+class ReportWorker(object):
+    """ Report worker process, restarted whenever it exits """
+
+    def __init__(self, options, restart_delay=10):
+        self.options = options
+        self.restart_delay = restart_delay
+        self.process = None
+        self.greenlet = None
+        self.starts = 0
+        self.exits = 0
+        # {metric name: dump} of metrics of workers that exited
+        self.exited_metrics = {}
+        # {metric name: dump} of metrics of the running worker
+        self.metrics = {}
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.watch)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        if self.process is not None and self.process.poll() is None:
+            # the worker exits once its stdin is closed
+            self.process.stdin.close()
+            self.process.wait()
+
+    def spawn(self):
+        process = subprocess.Popen([sys.executable, '-m', __name__],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        # Options are not passed as arguments, so that the database and
+        # email passwords do not show up in process listings
+        process.stdin.write(json.dumps(self.options) + '\n')
+        process.stdin.flush()
+        self.starts += 1
+        return process
+
+    def watch(self):
+        while True:
+            self.process = self.spawn()
+            self.read_metrics(self.process.stdout)
+            status = self.process.wait()
+            self.exits += 1
+            # Keep the counts of this worker when the next one starts over
+            self.exited_metrics = dict((metric.name, metric.dump())
+                                       for metric in WORKER_METRICS)
+            self.metrics = {}
+            logging.error('Report worker exited with status %s, restarting '
+                          'in %s seconds', status, self.restart_delay)
+            gevent.sleep(self.restart_delay)
+
+    def read_metrics(self, stdout):
+        """ Apply metrics the worker writes until it exits """
+        for line in iter(stdout.readline, ''):
+            try:
+                self.metrics = json.loads(line)['metrics']
+            except (ValueError, KeyError, TypeError):
+                logging.error('Invalid metrics from report worker: %r', line)
+                continue
+            for metric in WORKER_METRICS:
+                metric.load(self.exited_metrics.get(metric.name, []),
+                            self.metrics.get(metric.name, []))
+
+    def stats(self):
+        running = self.process is not None and self.process.poll() is None
+        return {
+            'pid': self.process.pid if running else None,
+            'running': running,
+            'starts': self.starts,
+            'exits': self.exits,
+        }
+
+
+class WorkerApp(object):
+    def __init__(self, config):
+        self.config = config
+
+
+class WorkerExts(object):
+    def __init__(self, db):
+        self.databases = {'monitoring': db}
+
+
+class WorkerSupervisor(object):
+    """ Provides the part of the supervisor API that reporting uses """
+
+    def __init__(self, db, config):
+        self.config = config
+        self.app = WorkerApp(config)
+        self.exts = WorkerExts(db)
+
+
+def run_reports(supervisor, report):
+    interval = supervisor.config['reporting.interval']
+    while True:
+        start = time.time()
+        try:
+            report(supervisor)
+        except Exception:
+            logging.exception('Report run failed')
+        gevent.sleep(max(interval - (time.time() - start), 0))
+
+
+def send_metrics(out, interval):
+    """ Write the values of ``WORKER_METRICS`` to ``out`` every ``interval``
+    seconds """
+    while True:
+        gevent.sleep(interval)
+        metrics = dict((metric.name, metric.dump())
+                       for metric in WORKER_METRICS)
+        out.write(json.dumps({'metrics': metrics}) + '\n')
+        out.flush()
+
+
+def main():
+    from gevent import monkey
+    from gevent.fileobject import FileObject
+    monkey.patch_all()
+    logging.basicConfig(level=logging.INFO,
+                        format='report worker: %(levelname)s %(message)s')
+
+    options = json.loads(sys.stdin.readline())
+    config = options['config']
+    supervisor = WorkerSupervisor(WorkerDB(options['database']), config)
+    config['last_check'] = 0
+    restore_snapshot(supervisor)
+    if config['reporting.workers']:
+        pool = ReportPool(config['reporting.workers'], options['database'],
+                          timeout=config['reporting.worker_timeout'])
+        pool.start()
+        config['report_pool'] = pool
+    start_alerts(config)
+    report = send_report
+    if config['reporting.shared']:
+        config['report_lease'] = ReportLease(config['reporting.lease_ttl'])
+        report = run_report
+    gevent.spawn(run_reports, supervisor, report)
+    gevent.spawn(send_metrics, sys.stdout, config['reporting.poll_interval'])
+    # run until the server closes stdin or exits
+    FileObject(sys.stdin).read()
+
+
+if __name__ == '__main__':
+    main()
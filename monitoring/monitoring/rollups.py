@@ -0,0 +1,146 @@
+"""
+Rollups of stored datapoints per client and per satellite preset
+
+Rollups are updated from each stored batch by adding the batch's aggregates
+to the existing rows, so history never has to be recomputed from ``stats``.
+"""
+
+from __future__ import division
+
+import time
+
+
+# Bucket sizes in seconds
+GRANULARITIES = (5 * 60, 60 * 60)
+
+COUNTERS = ('datapoints', 'signal_locks', 'service_locks', 'service_oks',
+            'carousels_active', 'bitrate_sum')
+
+CLIENT_KEY = ('granularity', 'client_key', 'bucket')
+PRESET_KEY = ('granularity', 'tuner_preset', 'bucket')
+
+UPSERT = """
+insert into {table} ({columns}) values ({values})
+on conflict ({key}) do update set
+{counters},
+bitrate_min = least({table}.bitrate_min, excluded.bitrate_min),
+bitrate_max = greatest({table}.bitrate_max, excluded.bitrate_max){extra};
+"""
+
+HISTORY = """
+select * from {table}
+where granularity = %(granularity)s and {column} = %(value)s
+and bucket >= %(since)s
+order by bucket;
+"""
+
+
+def upsert_query(table, key, extra=()):
+    columns = key + tuple(extra) + COUNTERS + ('bitrate_min', 'bitrate_max')
+    return UPSERT.format(
+        table=table,
+        columns=', '.join(columns),
+        values=', '.join('%({})s'.format(c) for c in columns),
+        key=', '.join(key),
+        counters=',\n'.join('{0} = {1}.{0} + excluded.{0}'.format(c, table)
+                            for c in COUNTERS),
+        extra=''.join(',\n{0} = excluded.{0}'.format(c) for c in extra))
+
+
+UPSERT_CLIENT = upsert_query('client_rollups', CLIENT_KEY, ('tuner_preset',))
+UPSERT_PRESET = upsert_query('preset_rollups', PRESET_KEY)
+
+
+def carousels_active(payload):
+    return (payload['carousels_count'] > 0 and
+            any(payload['carousels_status']))
+
+
+def add_to_rollup(rollups, key, payload):
+    rollup = rollups.get(key)
+    bitrate = payload['bitrate']
+    if rollup is None:
+        rollup = rollups[key] = dict((c, 0) for c in COUNTERS)
+        rollup['bitrate_min'] = bitrate
+        rollup['bitrate_max'] = bitrate
+    rollup['datapoints'] += 1
+    rollup['signal_locks'] += bool(payload['signal_lock'])
+    rollup['service_locks'] += bool(payload['service_lock'])
+    rollup['service_oks'] += bool(payload['service_ok'])
+    rollup['carousels_active'] += carousels_active(payload)
+    rollup['bitrate_sum'] += bitrate
+    rollup['bitrate_min'] = min(rollup['bitrate_min'], bitrate)
+    rollup['bitrate_max'] = max(rollup['bitrate_max'], bitrate)
+    rollup['tuner_preset'] = payload['tuner_preset']
+    return rollup
+
+
+def aggregate(payloads, granularities=GRANULARITIES):
+    """ Return client and preset rollup rows for a batch of stats rows
+
+    Client rollups are keyed by ``client_key``, so payloads must have been
+    through ``DimensionKeys.resolve()``.
+
+    Rows are ordered by their conflict keys, so that concurrent batches lock
+    the rollup rows they share in the same order and cannot deadlock.
+    """
+    clients = {}
+    presets = {}
+    for payload in payloads:
+        for granularity in granularities:
+            bucket = int(payload['timestamp'] // granularity * granularity)
+            add_to_rollup(clients, (granularity, payload['client_key'],
+                                    bucket), payload)
+            add_to_rollup(presets, (granularity, payload['tuner_preset'],
+                                    bucket), payload)
+    client_rows = [dict(zip(CLIENT_KEY, key), **rollup)
+                   for key, rollup in sorted(clients.items())]
+    preset_rows = [dict(zip(PRESET_KEY, key), **rollup)
+                   for key, rollup in sorted(presets.items())]
+    return client_rows, preset_rows
+
+
+def update_rollups(db, payloads):
+    """ Add a batch of stats rows to the rollups
+
+    Must be called within the transaction that stores the rows. Client
+    rollups are always updated before preset rollups, each in key order.
+    """
+    client_rows, preset_rows = aggregate(payloads)
+    if client_rows:
+        db.executemany(UPSERT_CLIENT, client_rows)
+    if preset_rows:
+        db.executemany(UPSERT_PRESET, preset_rows)
+
+
+def summarize(row):
+    """ Return a rollup row with ratios and average bitrate """
+    count = row['datapoints'] or 1
+    return {
+        'bucket': row['bucket'],
+        'datapoints': row['datapoints'],
+        'signal_lock_ratio': row['signal_locks'] / count,
+        'service_lock_ratio': row['service_locks'] / count,
+        'service_ok_ratio': row['service_oks'] / count,
+        'carousels_active_ratio': row['carousels_active'] / count,
+        'bitrate_avg': row['bitrate_sum'] / count,
+        'bitrate_min': row['bitrate_min'],
+        'bitrate_max': row['bitrate_max'],
+    }
+
+
+def get_history(db, table, column, value, granularity, period):
+    qry = HISTORY.format(table=table, column=column)
+    rows = db.fetchall(qry, {'granularity': granularity, 'value': value,
+                             'since': int(time.time() - period)})
+    return [summarize(row) for row in rows]
+
+
+def get_client_history(db, client_key, granularity, period):
+    return get_history(db, 'client_rollups', 'client_key', client_key,
+                       granularity, period)
+
+
+def get_preset_history(db, preset, granularity, period):
+    return get_history(db, 'preset_rollups', 'tuner_preset', preset,
+                       granularity, period)
@@ -1,5 +1,7 @@
-from .collect import collect_heartbeat
-from .status import show_status
+from .collect import collect_heartbeat, collect_raw_heartbeat, ingest_stats
+from .status import show_status, show_status_json
+from .metrics import show_metrics
+from .history import show_preset_history, show_client_history
 
 
 EXPORTS = {
@@ -15,11 +17,47 @@ def routes(config):
             'POST',
             '/heartbeat/v1/',
             {}
+        ), (
+            'api:raw_heartbeat',
+            collect_raw_heartbeat,
+            'POST',
+            '/heartbeat/v2/',
+            {}
+        ), (
+            'api:ingest_stats',
+            ingest_stats,
+            'GET',
+            '/heartbeat/stats/',
+            {}
         ), (
             'status:main',
             show_status,
             'GET',
             '/',
             {}
+        ), (
+            'status:json',
+            show_status_json,
+            'GET',
+            '/status.json',
+            {}
+        ), (
+            'metrics:main',
+            show_metrics,
+            'GET',
+            '/metrics',
+            {}
+        ), (
+            'history:preset',
+            show_preset_history,
+            'GET',
+            '/history/preset/<preset:int>',
+            {}
+        ), (
+            'history:client',
+            show_client_history,
+            'GET',
+            '/history/client/<client_id>',
+            {}
         ),
     )
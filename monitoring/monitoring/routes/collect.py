@@ -1,11 +1,118 @@
+import zlib
 import logging
 
-from bottle import request
+from bottle import request, abort, HTTPResponse
 
 from ..heartbeat import process_heartbeat
+from ..metrics import REQUEST_SECONDS
 
 
 def collect_heartbeat():
-    data = request.forms.get('stream')
-    process_heartbeat(data)
+    with REQUEST_SECONDS.time(endpoint='v1'):
+        data = request.forms.get('stream')
+        return store_stream(data)
+
+
+def collect_raw_heartbeat():
+    with REQUEST_SECONDS.time(endpoint='v2'):
+        return read_raw_heartbeat()
+
+
+def read_raw_heartbeat():
+    """ Accept a stream posted as a binary request body
+
+    The body may be compressed with gzip or deflate content encoding. Bodies
+    larger than ``ingest.max_stream_size`` bytes, before or after
+    decompression, are rejected.
+
+    The body is read from the WSGI input rather than ``request.body``, which
+    would buffer all of it first. Bodies with a Content-Length that is too
+    large are rejected without reading them, and bodies of unknown length
+    (chunked transfer encoding, which the server decodes) are read up to one
+    byte over the limit.
+    """
+    content_type = request.content_type.split(';')[0].strip()
+    if content_type != 'application/octet-stream':
+        abort(415, 'Expected application/octet-stream')
+    max_size = request.app.config['ingest.max_stream_size']
+    length = request.content_length
+    if length > max_size:
+        abort(413, 'Stream too large')
+    body = request.environ['wsgi.input']
+    data = body.read(length if length >= 0 else max_size + 1)
+    if len(data) > max_size:
+        abort(413, 'Stream too large')
+
+    encoding = request.get_header('Content-Encoding', 'identity').lower()
+    if encoding == 'gzip':
+        data = decompress(data, zlib.MAX_WBITS | 16, max_size)
+    elif encoding == 'deflate':
+        data = decompress(data, zlib.MAX_WBITS, max_size)
+    elif encoding != 'identity':
+        abort(415, 'Unsupported content encoding')
+    return store_stream(data)
+
+
+def decompress(data, wbits, max_size):
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        data = decompressor.decompress(data, max_size + 1)
+    except zlib.error:
+        abort(400, 'Invalid data')
+    if len(data) > max_size or decompressor.unconsumed_tail:
+        abort(413, 'Stream too large')
+    return data
+
+
+def store_stream(data):
+    queue = request.app.config.get('ingest_queue')
+    if queue is None:
+        process_heartbeat(data)
+        return 'OK'
+
+    # The stream is decoded before responding, so that a client whose
+    # stream was truncated or corrupted sends it again
+    try:
+        queued = queue.put(data)
+    except ValueError:
+        abort(400, 'Invalid data')
+    if not queued:
+        logging.warning('Ingest queue is full, rejecting heartbeat')
+        retry_after = request.app.config['ingest.retry_after']
+        raise HTTPResponse('Server busy', status=503,
+                           headers={'Retry-After': str(retry_after)})
     return 'OK'
+
+
+def ingest_stats():
+    queue = request.app.config.get('ingest_queue')
+    dedup = request.app.config.get('heartbeat_dedup')
+    keys = request.app.config.get('dimension_keys')
+    health = request.app.config.get('health_engine')
+    pool = request.app.config.get('report_pool')
+    worker = request.app.config.get('report_worker')
+    lease = request.app.config.get('report_lease')
+    alerts = request.app.config.get('alert_queue')
+    throttle = request.app.config.get('alert_throttle')
+    if queue is None:
+        stats = {'async': False}
+    else:
+        stats = queue.stats()
+        stats['async'] = True
+    if dedup is not None:
+        stats['duplicates'] = dedup.stats()
+    if keys is not None:
+        stats['dimension_keys'] = keys.stats()
+    if health is not None:
+        stats['health_engine'] = health.stats()
+    if pool is not None:
+        stats['report_pool'] = pool.stats()
+    if worker is not None:
+        stats['report_worker'] = worker.stats()
+    if lease is not None:
+        stats['report_lease'] = lease.stats()
+    if alerts is not None:
+        stats['alerts'] = alerts.stats()
+    if throttle is not None:
+        stats['alert_throttle'] = throttle.stats()
+    return stats
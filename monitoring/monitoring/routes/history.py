@@ -0,0 +1,39 @@
+from bottle import request, abort
+
+from ..rollups import (GRANULARITIES, get_client_history,
+                       get_preset_history)
+
+
+def get_params():
+    config = request.app.config
+    try:
+        granularity = int(request.query.get(
+            'granularity', config['history.granularity']))
+        period = int(request.query.get('period', config['history.period']))
+    except ValueError:
+        abort(400, 'Invalid parameters')
+    if granularity not in GRANULARITIES:
+        abort(400, 'Granularity must be one of {}'.format(
+            ', '.join(str(g) for g in GRANULARITIES)))
+    return granularity, min(period, config['history.max_period'])
+
+
+def show_preset_history(preset):
+    granularity, period = get_params()
+    db = request.db.monitoring
+    return {'tuner_preset': preset,
+            'granularity': granularity,
+            'history': get_preset_history(db, preset, granularity, period)}
+
+
+def show_client_history(client_id):
+    granularity, period = get_params()
+    db = request.db.monitoring
+    keys = request.app.config['dimension_keys']
+    client_key = keys.client_key(db, client_id)
+    if client_key is None:
+        abort(404, 'Unknown client')
+    return {'client_id': client_id,
+            'granularity': granularity,
+            'history': get_client_history(db, client_key, granularity,
+                                          period)}
@@ -0,0 +1,11 @@
+from bottle import request, response
+
+from ..metrics import REGISTRY, QUEUE_DEPTH
+
+
+def show_metrics():
+    queue = request.app.config.get('ingest_queue')
+    if queue is not None:
+        QUEUE_DEPTH.set(queue.queue.qsize())
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return REGISTRY.expose()
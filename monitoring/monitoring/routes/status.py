@@ -1,26 +1,84 @@
+import json
+import hashlib
 import datetime
+import email.utils
 
-from bottle import request
+from bottle import request, response, parse_date, HTTPResponse
 
-from librarian_core.contrib.templates.renderer import view
+from librarian_core.contrib.templates.renderer import template
 
 from ...core.satdata import get_sat_name, get_preset_ids
 
 
-@view('status')
-def show_status():
-    bitrate_threshold = request.app.config['reporting.bitrate_threshold']
-    error_rate_threshold = request.app.config['reporting.error_rate_threshold']
-    last_check = request.app.config.get('last_check')
+def status_context(config):
+    satellites = sorted(set([get_sat_name(pid) for pid in get_preset_ids()]))
+    return dict(satellites=satellites,
+                bitrate_threshold=config['reporting.bitrate_threshold'],
+                error_rate_threshold=config['reporting.error_rate_threshold'],
+                status=config.get('last_report', {}))
+
+
+def render_html(config):
+    context = status_context(config)
+    last_check = config.get('last_check')
     if last_check:
         last_check = datetime.datetime.fromtimestamp(int(last_check))
     else:
         last_check = None
+    return template('status', last_check=last_check, **context)
 
-    satellites = sorted(set([get_sat_name(pid) for pid in get_preset_ids()]))
 
-    return dict(satellites=satellites,
-                bitrate_threshold=bitrate_threshold,
-                error_rate_threshold=error_rate_threshold,
-                status=request.app.config.get('last_report', {}),
-                last_check=last_check)   # fetch report from database and return status page
+def render_json(config):
+    context = status_context(config)
+    context['last_check'] = config.get('last_check') or None
+    return json.dumps(context, sort_keys=True)
+
+
+def cached_page(kind, render, content_type):
+    """ Return the page rendered for the last report, or 304 response if the
+    client already has it
+
+    Pages are rendered once per report run, and carry an ``ETag`` derived
+    from their content and a ``Last-Modified`` time of the report.
+    """
+    config = request.app.config
+    last_check = config.get('last_check') or 0
+    cache = config['status_cache']
+    cached = cache.get(kind)
+    if cached is None or cached[0] != last_check:
+        body = render(config)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        cached = cache[kind] = (last_check, body, etag)
+    _, body, etag = cached
+
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if last_check:
+        headers['Last-Modified'] = email.utils.formatdate(last_check,
+                                                          usegmt=True)
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    if not_modified(etag, last_check):
+        return HTTPResponse(status=304, **headers)
+    response.content_type = content_type
+    return body
+
+
+def not_modified(etag, last_check):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    since = request.headers.get('If-Modified-Since', '').split(';')[0].strip()
+    since = parse_date(since)
+    return bool(last_check and since and since >= int(last_check))
+
+
+def show_status():
+    return cached_page('html', render_html, 'text/html; charset=utf-8')
+
+
+def show_status_json():
+    return cached_page('json', render_json, 'application/json')
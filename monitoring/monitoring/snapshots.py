@@ -0,0 +1,106 @@
+"""
+Report snapshots stored in the database
+
+Every report run stores the dashboard status and the alert state, so that
+both survive restarts and satellites are not alerted about again just
+because the server was restarted. When reports are computed by a separate
+process or by another server instance, snapshots are also how the status
+pages get to see them.
+"""
+
+import json
+import time
+import logging
+
+from .partitions import DAY
+
+
+SAVE_SNAPSHOT = """
+insert into report_snapshots (created, report, state, alerts)
+values (%(created)s, %(report)s, %(state)s, %(alerts)s);
+"""
+
+PRUNE_SNAPSHOTS = """
+delete from report_snapshots where created < %(cutoff)s;
+"""
+
+LATEST_SNAPSHOT_TIME = """
+select max(created) as created from report_snapshots;
+"""
+
+LATEST_SNAPSHOT = """
+select * from report_snapshots order by created desc limit 1;
+"""
+
+
+def save_snapshot(db, created, report, state, retention_days=0, alerts=None):
+    """ Store a report snapshot and drop ones older than the retention """
+    with db.transaction():
+        db.execute(SAVE_SNAPSHOT, {
+            'created': created,
+            'report': json.dumps(report),
+            # JSON object keys are strings, presets are restored as integers
+            'state': json.dumps(state),
+            'alerts': json.dumps(alerts),
+        })
+        if retention_days:
+            db.execute(PRUNE_SNAPSHOTS,
+                       {'cutoff': created - retention_days * DAY})
+
+
+def decode(value):
+    # JSON columns are already decoded by psycopg2
+    if isinstance(value, basestring):
+        return json.loads(value)
+    return value
+
+
+def load_snapshot(db):
+    """ Return (created, report, state, alerts) of the latest snapshot or
+    ``None`` """
+    row = db.fetchone(LATEST_SNAPSHOT)
+    if not row:
+        return None
+    state = dict((int(preset), status)
+                 for preset, status in decode(row['state']).items())
+    return row['created'], decode(row['report']), state, decode(row['alerts'])
+
+
+def apply_snapshot(config, snapshot):
+    created, report, state, alerts = snapshot
+    config['last_check'] = created
+    config['last_report'] = report
+    config['last_state'] = state
+    config['last_alerts'] = alerts
+
+
+def restore_snapshot(supervisor):
+    """ Restore the last report and alert state into the app config """
+    config = supervisor.config
+    db = supervisor.exts.databases['monitoring']
+    try:
+        snapshot = load_snapshot(db)
+    except Exception:
+        logging.exception('Loading the last report snapshot failed')
+        return
+    if snapshot is None:
+        return
+    apply_snapshot(config, snapshot)
+    logging.info('Restored report snapshot from %s',
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(snapshot[0])))
+
+
+def refresh_snapshot(supervisor):
+    """ Load the latest snapshot into the app config if it is newer than the
+    report shown, when reports are stored by another process or instance """
+    config = supervisor.config
+    db = supervisor.exts.databases['monitoring']
+    try:
+        row = db.fetchone(LATEST_SNAPSHOT_TIME)
+        if not row or row['created'] <= config.get('last_check', 0):
+            return
+        snapshot = load_snapshot(db)
+    except Exception:
+        logging.exception('Loading the latest report snapshot failed')
+        return
+    apply_snapshot(config, snapshot)
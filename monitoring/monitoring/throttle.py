@@ -0,0 +1,128 @@
+"""
+Throttling of satellite status alerts
+
+Report runs compute a status per satellite, and a status that hovers around
+a threshold could change on every run. The throttle only takes a new status
+for a satellite after it has been seen on several consecutive runs (more
+when it is an improvement than when it is a degradation). A change is
+mailed right away unless the satellite was alerted about within the
+notification interval. Changes that arrive sooner are held back and mailed
+together in a digest at most once per notification interval.
+"""
+
+import time
+
+from .metrics import ALERTS
+from .reporting import (NOTIFICATION_INTERVAL, STATUS_NORMAL, STATUS_WARNING,
+                        STATUS_CRITICAL)
+
+
+SEVERITY = {
+    STATUS_NORMAL: 0,
+    STATUS_WARNING: 1,
+    STATUS_CRITICAL: 2,
+}
+
+
+class AlertThrottle(object):
+    """ Alert state of every satellite
+
+    ``states`` maps presets to the statuses they were last alerted about,
+    e.g. as restored from a report snapshot.
+    """
+
+    def __init__(self, states=None, interval=NOTIFICATION_INTERVAL,
+                 escalate_after=2, recover_after=3, now=None):
+        self.interval = interval
+        self.escalate_after = escalate_after
+        self.recover_after = recover_after
+        self.states = dict(states or {})
+        # preset: (direction of the pending change, number of runs seen)
+        self.pending = {}
+        # preset: time the satellite was last alerted about
+        self.last_sent = {}
+        # preset: [(time, old status, new status), ...] not yet mailed
+        self.held = {}
+        self.last_digest = now or time.time()
+        self.sent = 0
+        self.suppressed = 0
+        self.digests = 0
+
+    def update(self, states, now=None):
+        """ Apply statuses of a report run and return preset:status pairs of
+        satellites whose changed status should be mailed now """
+        now = now or time.time()
+        changes = {}
+        for preset, status in states.items():
+            old = self.states.get(preset, STATUS_NORMAL)
+            if status == old:
+                self.pending.pop(preset, None)
+                continue
+            direction = cmp(SEVERITY[status], SEVERITY[old])
+            pending_direction, seen = self.pending.get(preset, (0, 0))
+            seen = seen + 1 if pending_direction == direction else 1
+            required = (self.escalate_after if direction > 0
+                        else self.recover_after)
+            if seen < required:
+                self.pending[preset] = (direction, seen)
+                continue
+            self.pending.pop(preset, None)
+            self.states[preset] = status
+            last_sent = self.last_sent.get(preset)
+            if last_sent is None or now - last_sent >= self.interval:
+                self.last_sent[preset] = now
+                changes[preset] = status
+                self.sent += 1
+                ALERTS.inc(outcome='sent')
+            else:
+                self.held.setdefault(preset, []).append((now, old, status))
+                self.suppressed += 1
+                ALERTS.inc(outcome='suppressed')
+        return changes
+
+    def digest(self, now=None):
+        """ Return held back changes as (preset, current status, changes)
+        tuples ordered by preset if a digest is due, or an empty list """
+        now = now or time.time()
+        if not self.held or now - self.last_digest < self.interval:
+            return []
+        digest = []
+        for preset, changes in sorted(self.held.items()):
+            digest.append((preset, self.states[preset], changes))
+            self.last_sent[preset] = now
+        self.held = {}
+        self.last_digest = now
+        self.digests += 1
+        ALERTS.inc(outcome='digest')
+        return digest
+
+    def dump(self):
+        """ Return cooldowns and held back changes for a report snapshot """
+        return {
+            'last_sent': self.last_sent,
+            'held': self.held,
+            'last_digest': self.last_digest,
+        }
+
+    def restore(self, states, saved=None):
+        """ Restore statuses and the state returned by ``dump()`` """
+        self.states = dict(states or {})
+        self.pending = {}
+        if not saved:
+            return
+        # JSON object keys are strings, presets are restored as integers
+        self.last_sent = dict((int(preset), sent) for preset, sent
+                              in saved['last_sent'].items())
+        self.held = dict((int(preset), [tuple(c) for c in changes])
+                         for preset, changes in saved['held'].items())
+        self.last_digest = saved['last_digest']
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'digests': self.digests,
+            'pending': len(self.pending),
+            'held': sum(len(changes) for changes in self.held.values()),
+            'last_digest': self.last_digest,
+        }
@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+
+
+class ExpiringDict(object):
+    """ Mapping bounded in size and in how long items are kept
+
+    When full, the least recently used item is evicted. Items older than
+    ``ttl`` seconds are treated as absent and are evicted as they are found.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key: (value, time added)
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None:
+            return default
+        if time.time() - item[1] > self.ttl:
+            del self.items[key]
+            return default
+        # Mark as recently used
+        del self.items[key]
+        self.items[key] = item
+        return item[0]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.items)
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = (value, time.time())
+        self.evict()
+
+    def evict(self):
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        # Items are ordered by use rather than age, so only the oldest end is
+        # trimmed here and stale items elsewhere expire on lookup
+        now = time.time()
+        while self.items:
+            key, (_, added) = next(iter(self.items.items()))
+            if now - added <= self.ttl:
+                break
+            del self.items[key]
@@ -0,0 +1,171 @@
+"""
+Minimal metrics registry with Prometheus text exposition
+
+Recording a value only touches plain Python objects and never yields, so
+under gevent no locking is needed.
+"""
+
+import copy
+import time
+import bisect
+import contextlib
+
+
+# Default histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """ Return all metrics in Prometheus text format """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def dump(self):
+        """ Return values as a JSON serializable list of (label values,
+        value) pairs """
+        return [[list(key), value]
+                for key, value in sorted(self.values.items())]
+
+    def load(self, *dumps):
+        """ Replace values with the sum of those in ``dump()`` results, e.g.
+        to show values recorded by other processes """
+        values = {}
+        for dump in dumps:
+            for key, value in dump:
+                key = tuple(key)
+                if key in values:
+                    values[key] = self.combine(values[key], value)
+                else:
+                    values[key] = copy.deepcopy(value)
+        self.values = values
+
+    def combine(self, a, b):
+        return b
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                              for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def combine(self, a, b):
+        return a + b
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, self.format_labels(key),
+                                   format_value(value))
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, self.format_labels(key),
+                                   format_value(value))
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), registry=None,
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # Per-bucket counts (last one is +Inf), sum
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def combine(self, a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def time_iter(self, iterable, elapsed=0.0, **labels):
+        """ Yield from iterable and observe the total time spent in it once
+        it is exhausted, plus ``elapsed`` seconds spent before iterating """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.observe(elapsed + time.time() - start, **labels)
+                return
+            elapsed += time.time() - start
+            yield item
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            bounds = [format_value(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, self.format_labels(key, [('le', bound)]),
+                    cumulative)
+            labels = self.format_labels(key)
+            yield '{}_sum{} {}'.format(self.name, labels, format_value(total))
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_value(value):
+    return repr(float(value))
@@ -1,24 +1,48 @@
+import socket
 import smtplib
 import logging
 from email.mime.text import MIMEText
 
 
 class SMTPClient(object):
-    def __init__(self, host, port, use_secure, username, password):
+    def __init__(self, host, port, use_secure, username, password,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
         self.host = host
         self.port = port
         self.use_secure = use_secure
         self.username = username
         self.password = password
+        self.timeout = timeout
         self.smtp_class = smtplib.SMTP_SSL if self.use_secure else smtplib.SMTP
         self.conn = None
 
     def connect(self):
         logging.debug('Connecting to SMTP host: %s:%s', self.host, self.port)
-        self.conn = self.smtp_class(self.host, self.port)
-        self.conn.login(self.username, self.password)
+        self.conn = self.smtp_class(self.host, self.port, timeout=self.timeout)
+        # servers that accept mail without authentication (e.g. a local
+        # relay) are used without credentials
+        if self.username:
+            self.conn.login(self.username, self.password)
         logging.debug('Connected to SMTP host: %s:%s', self.host, self.port)
 
+    def is_connected(self):
+        """ Return whether the connection is open and the server responds """
+        if self.conn is None:
+            return False
+        try:
+            return self.conn.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.conn.close()
+        self.conn = None
+
     def send(self, recipients, subject, message):
         if self.conn is None:
             self.connect()
@@ -27,3 +51,14 @@ class SMTPClient(object):
         msg['From'] = self.username
         msg['To'] = ', '.join(recipients)
         self.conn.sendmail(self.username, recipients, msg.as_string())
+
+
+def is_permanent_error(exc):
+    """ Return whether sending a mail failed in a way that retrying it does
+    not fix, i.e. the server refused all recipients or replied with a 5xx
+    code """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 500 <= exc.smtp_code < 600
+    return False
@@ -33,7 +33,7 @@ setup(
     license='GPLv3',
     keywords='broadcast, outernet, signal, service, monitoring',
     url='https://github.com/Outernet-Project/monitoring',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     long_description=read('README.rst'),
     install_requires=read('requirements.txt').strip().split('\n'),